@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la búsqueda FTS5 (/buscar y /buscar/autocompletar) sobre un catálogo sintético.
+
+Uso:
+    python benchmark_busqueda.py [--productos 10000] [--consultas 500]
+
+Crea una base temporal con el esquema de main_sqlite.py, inserta productos sintéticos
+(los triggers mantienen el índice FTS) y mide la latencia de cada endpoint. Las consultas
+con términos muy comunes (que coinciden con gran parte del catálogo) cuestan más, porque
+bm25 puntúa cada coincidencia antes de aplicar el LIMIT.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+PALABRAS = [
+    'diamantes', 'monedas', 'gemas', 'cristales', 'pase', 'elite', 'batalla', 'tarjeta',
+    'regalo', 'steam', 'xbox', 'playstation', 'roblox', 'robux', 'fire', 'legends', 'mobile',
+    'estrategia', 'accion', 'aventura', 'deportes', 'futbol', 'carreras', 'shooter', 'royale',
+    'semanal', 'mensual', 'premium', 'oro', 'plata', 'bronce', 'recarga', 'dólares', 'créditos',
+]
+CATEGORIAS = ['juegos', 'gift-cards']
+SILABAS = ['ka', 'lo', 'mi', 'ra', 'tu', 'ne', 'zo', 'vi', 'pa', 'xe', 'dro', 'gan', 'sul', 'ter', 'fin', 'bor']
+
+
+def vocabulario(rnd, n=3000):
+    """Palabras comunes del dominio más nombres propios sintéticos (títulos, marcas, personajes)"""
+    inventadas = {''.join(rnd.choice(SILABAS) for _ in range(rnd.randint(2, 4))) for _ in range(n)}
+    return PALABRAS + sorted(inventadas)
+
+
+def frase(rnd, n, palabras=None):
+    palabras = palabras or VOCABULARIO
+    return ' '.join(rnd.choice(palabras) for _ in range(n))
+
+
+VOCABULARIO = vocabulario(random.Random(7))
+
+
+def poblar(ruta, total, rnd):
+    """Inserta `total` productos con 5 paquetes cada uno"""
+    from main_sqlite import configurar_conexion_sqlite
+
+    conn = sqlite3.connect(ruta)
+    configurar_conexion_sqlite(conn)
+    cur = conn.cursor()
+    for i in range(total):
+        cur.execute(
+            'INSERT INTO juegos (nombre, descripcion, imagen, categoria, orden, etiquetas) VALUES (?, ?, ?, ?, ?, ?)',
+            (f'{frase(rnd, 2).title()} {i}', frase(rnd, 25), '', rnd.choice(CATEGORIAS), i % 10, frase(rnd, 4, PALABRAS))
+        )
+        juego_id = cur.lastrowid
+        cur.executemany(
+            'INSERT INTO paquetes (juego_id, nombre, precio, orden) VALUES (?, ?, ?, ?)',
+            [(juego_id, f'{rnd.randint(10, 5000)} {rnd.choice(PALABRAS)}', rnd.randint(1, 100), n) for n in range(5)]
+        )
+    conn.commit()
+    conn.close()
+
+
+def medir(cliente, rutas):
+    tiempos = []
+    for ruta in rutas:
+        inicio = time.perf_counter()
+        r = cliente.get(ruta)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        if r.status_code != 200:
+            raise RuntimeError(f'{ruta} -> {r.status_code}')
+    tiempos.sort()
+    return {
+        'p50': statistics.median(tiempos),
+        'p95': tiempos[int(len(tiempos) * 0.95) - 1],
+        'max': tiempos[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--productos', type=int, default=10000)
+    parser.add_argument('--consultas', type=int, default=500)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'busqueda.db')
+        salida_real = sys.stdout
+        sys.stdout = open(os.devnull, 'w')  # la app imprime mensajes de arranque
+        try:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            from main_sqlite import app
+
+            inicio = time.perf_counter()
+            poblar(os.environ['DATABASE_PATH'], args.productos, rnd)
+            duracion_carga = time.perf_counter() - inicio
+
+            cliente = app.test_client()
+            cliente.get('/productos')  # calentar el snapshot del catálogo
+
+            consultas = [frase(rnd, rnd.randint(1, 2)) for _ in range(args.consultas)]
+            prefijos = [rnd.choice(VOCABULARIO)[:rnd.randint(2, 4)] for _ in range(args.consultas)]
+
+            resultados = {
+                '/buscar': medir(cliente, [f'/buscar?q={q}' for q in consultas]),
+                '/buscar/autocompletar': medir(cliente, [f'/buscar/autocompletar?q={p}' for p in prefijos]),
+            }
+        finally:
+            sys.stdout.close()
+            sys.stdout = salida_real
+
+    print("🔎 BENCHMARK DE BÚSQUEDA FTS5")
+    print("=" * 60)
+    print(f"   Productos: {args.productos} (carga + índice en {duracion_carga:.1f}s)")
+    print(f"   Consultas por endpoint: {args.consultas}")
+    for endpoint, t in resultados.items():
+        print(f"   {endpoint:<24} p50 {t['p50']:6.2f} ms | p95 {t['p95']:6.2f} ms | máx {t['max']:6.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
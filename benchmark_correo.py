@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Benchmark del envío de correo: una sesión SMTP por correo frente a PoolSMTP.
+
+Uso:
+    python benchmark_correo.py [--correos 200] [--hilos 4] [--latencia-ms 20] [--handshake-ms 60]
+                               [--renderizados 10000]
+
+Levanta un servidor SMTP local de prueba que responde cada comando tras `latencia-ms`
+(ida y vuelta a smtp.gmail.com) y cobra `handshake-ms` extra al abrir cada sesión, en
+lugar del STARTTLS y el handshake TLS que aquí no se hacen. Los correos no salen de la
+máquina.
+
+También mide cuánto cuesta armar los correos (plantillas precompiladas de
+templates/correos, multipart/alternative HTML + texto) frente a lo que tarda el envío.
+"""
+
+import argparse
+import os
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+class ServidorSMTPPrueba(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latencia, handshake):
+        self.latencia = latencia
+        self.handshake = handshake
+        self.sesiones = 0
+        self.mensajes = 0
+        self._lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), ManejadorSMTP)
+
+    def contar(self, campo):
+        with self._lock:
+            setattr(self, campo, getattr(self, campo) + 1)
+
+
+class ManejadorSMTP(socketserver.StreamRequestHandler):
+    """Lo justo de SMTP para smtplib: EHLO, AUTH PLAIN, MAIL, RCPT, DATA, NOOP, RSET, QUIT"""
+
+    def responder(self, *lineas):
+        time.sleep(self.server.latencia)
+        self.wfile.write(''.join(f'{linea}\r\n' for linea in lineas).encode())
+
+    def handle(self):
+        self.server.contar('sesiones')
+        time.sleep(self.server.handshake)
+        self.responder('220 prueba ESMTP')
+        while True:
+            linea = self.rfile.readline()
+            if not linea:
+                return
+            comando = linea.decode(errors='replace').strip().upper()
+            if comando.startswith(('EHLO', 'HELO')):
+                self.responder('250-prueba', '250-AUTH PLAIN', '250 8BITMIME')
+            elif comando.startswith('AUTH'):
+                self.responder('235 2.7.0 Autenticado')
+            elif comando.startswith(('MAIL', 'RCPT', 'NOOP', 'RSET')):
+                self.responder('250 2.0.0 OK')
+            elif comando == 'DATA':
+                self.responder('354 Continuar')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                self.server.contar('mensajes')
+                self.responder('250 2.0.0 En cola')
+            elif comando == 'QUIT':
+                self.responder('221 2.0.0 Adiós')
+                return
+            else:
+                self.responder('502 5.5.2 No implementado')
+
+
+def crear_mensaje(n):
+    mensaje = MIMEMultipart()
+    mensaje['From'] = 'tienda@prueba.local'
+    mensaje['To'] = f'cliente{n}@prueba.local'
+    mensaje['Subject'] = f'Orden #{n} - Inefable Store'
+    mensaje.attach(MIMEText('Tu recarga está lista.\n' * 20, 'plain'))
+    return mensaje
+
+
+TIPOS_ORDEN = ('nueva_orden', 'recarga_completada', 'gift_card_completada', 'orden_rechazada')
+
+
+def orden_prueba(n):
+    return {
+        'id': n, 'juego_nombre': 'Free Fire', 'paquete': f'{100 + n % 900} diamantes', 'monto': 4.99 + n % 50,
+        'usuario_email': f'cliente{n}@prueba.local', 'usuario_id': str(10000 + n), 'usuario_telefono': '0414-0000000',
+        'metodo_pago': 'pago_movil', 'referencia_pago': f'REF{n:08d}', 'estado': 'procesando',
+        'fecha': '2026-10-18 12:00:00', 'codigo_producto': f'GIFT-{n:06d}',
+    }
+
+
+def medir_renderizado(armar, total):
+    """Microsegundos por correo de armar(tipo, orden), rotando los cuatro tipos"""
+    inicio = time.perf_counter()
+    for n in range(total):
+        armar(TIPOS_ORDEN[n % len(TIPOS_ORDEN)], orden_prueba(n))
+    return (time.perf_counter() - inicio) / total * 1e6
+
+
+def medir(enviar, correos, hilos):
+    latencias = []
+
+    def uno(n):
+        inicio = time.perf_counter()
+        enviar(crear_mensaje(n))
+        latencias.append((time.perf_counter() - inicio) * 1000)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        list(ejecutor.map(uno, range(correos)))
+    duracion = time.perf_counter() - inicio
+    latencias.sort()
+    return {
+        'por_segundo': correos / duracion,
+        'p50': statistics.median(latencias),
+        'p95': latencias[int(len(latencias) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--correos', type=int, default=200)
+    parser.add_argument('--hilos', type=int, default=4)
+    parser.add_argument('--latencia-ms', type=float, default=20)
+    parser.add_argument('--handshake-ms', type=float, default=60)
+    parser.add_argument('--renderizados', type=int, default=10000)
+    args = parser.parse_args()
+
+    servidor = ServidorSMTPPrueba(args.latencia_ms / 1000, args.handshake_ms / 1000)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    host, puerto = servidor.server_address
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'correo.db')
+        salida_real = sys.stdout
+        sys.stdout = open(os.devnull, 'w')  # la app imprime mensajes de arranque
+        try:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import smtplib
+            from main_sqlite import PLANTILLAS_CORREO, PlantillasCorreo, PoolSMTP
+        finally:
+            sys.stdout.close()
+            sys.stdout = salida_real
+
+        def sin_pool(mensaje):
+            # Lo que hacía cada función de envío: conectar, autenticar, enviar y cerrar
+            smtp = smtplib.SMTP(host, puerto, timeout=30)
+            smtp.login('tienda@prueba.local', 'clave')
+            smtp.sendmail(mensaje['From'], [mensaje['To']], mensaje.as_string())
+            smtp.quit()
+
+        resultados = {}
+        for nombre, hilos, crear_envio in [
+            ('sesión por correo', 1, lambda: sin_pool),
+            (f'sesión por correo ({args.hilos} hilos)', args.hilos, lambda: sin_pool),
+            ('PoolSMTP (1 sesión)', 1, lambda: PoolSMTP(host, puerto, 'tienda@prueba.local', 'clave', tamano=1, starttls=False)),
+            (f'PoolSMTP ({args.hilos} sesiones)', args.hilos,
+             lambda: PoolSMTP(host, puerto, 'tienda@prueba.local', 'clave', tamano=args.hilos, starttls=False)),
+        ]:
+            envio = crear_envio()
+            sesiones_antes = servidor.sesiones
+            enviar = envio.enviar if isinstance(envio, PoolSMTP) else envio
+            resultados[nombre] = medir(enviar, args.correos, hilos)
+            if isinstance(envio, PoolSMTP):
+                envio.cerrar()
+            resultados[nombre]['sesiones'] = servidor.sesiones - sesiones_antes
+
+        # Serializado como lo recibe sendmail (la codificación MIME cuesta más que Jinja)
+        def precompiladas(tipo, orden):
+            return PLANTILLAS_CORREO.mensaje(tipo, orden, 'tienda@prueba.local', orden['usuario_email']).as_string()
+
+        def compilando_cada_vez(tipo, orden):
+            return PlantillasCorreo().mensaje(tipo, orden, 'tienda@prueba.local', orden['usuario_email']).as_string()
+
+        renderizado = {
+            'solo plantillas (Jinja)': medir_renderizado(PLANTILLAS_CORREO.renderizar, args.renderizados),
+            'precompiladas + MIME': medir_renderizado(precompiladas, args.renderizados),
+            # Cada correo carga y compila sus plantillas: basta una muestra para ver la diferencia
+            'compilando en cada correo + MIME': medir_renderizado(compilando_cada_vez, max(1, args.renderizados // 50)),
+        }
+
+    servidor.shutdown()
+
+    print("📧 BENCHMARK DE ENVÍO SMTP")
+    print("=" * 72)
+    print(f"   Correos por escenario: {args.correos} | latencia {args.latencia_ms:.0f} ms por comando "
+          f"| handshake {args.handshake_ms:.0f} ms")
+    for nombre, r in resultados.items():
+        print(f"   {nombre:<30} {r['por_segundo']:7.1f} correos/s | p50 {r['p50']:6.1f} ms "
+              f"| p95 {r['p95']:6.1f} ms | {r['sesiones']} sesiones")
+
+    envio_us = resultados['PoolSMTP (1 sesión)']['p50'] * 1000
+    print()
+    print(f"🧩 ARMADO DE CORREOS ({args.renderizados} correos, HTML + texto, 4 tipos)")
+    print("=" * 72)
+    for nombre, us in renderizado.items():
+        print(f"   {nombre:<34} {us:8.1f} µs/correo | {us / envio_us * 100:6.2f} % del envío con PoolSMTP")
+
+
+if __name__ == '__main__':
+    main()
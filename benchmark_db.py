@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la capa de conexiones SQLite: compara req/s en /productos y /orden
+entre el modo anterior (NullPool + rollback journal) y el pool con WAL.
+
+Uso:
+    python benchmark_db.py [--segundos 5] [--hilos 8]
+
+Trabaja sobre una copia temporal de inefablestore.db, nunca sobre la base real.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODOS = {
+    'antes (NullPool + DELETE)': {'DB_POOL_SIZE': '0', 'DB_JOURNAL_MODE': 'DELETE'},
+    'después (pool + WAL)': {'DB_POOL_SIZE': '5', 'DB_JOURNAL_MODE': 'WAL'},
+}
+
+BENCH_EMAIL = 'benchmark@inefablestore.local'
+
+
+def preparar_base(origen, destino):
+    """Copia la base de datos y crea un usuario de prueba para /orden"""
+    from werkzeug.security import generate_password_hash
+
+    shutil.copy(origen, destino)
+    conn = sqlite3.connect(destino)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.execute("DELETE FROM usuarios WHERE email = ?", (BENCH_EMAIL,))
+    conn.execute(
+        "INSERT INTO usuarios (nombre, email, telefono, password_hash) VALUES (?, ?, ?, ?)",
+        ('Benchmark', BENCH_EMAIL, '0000', generate_password_hash('benchmark'))
+    )
+    conn.commit()
+    conn.close()
+
+
+def medir(app, ruta, segundos, hilos, metodo='GET', payload=None):
+    """Lanza `hilos` clientes contra `ruta` durante `segundos` y devuelve req/s"""
+    conteos = [0] * hilos
+    errores = [0] * hilos
+    fin = time.perf_counter() + segundos
+
+    def cliente(i):
+        c = app.test_client()
+        if metodo == 'POST':
+            c.post('/login', json={'email': BENCH_EMAIL, 'password': 'benchmark'})
+        while time.perf_counter() < fin:
+            if metodo == 'POST':
+                r = c.post(ruta, json=payload)
+            else:
+                r = c.get(ruta)
+            if r.status_code == 200:
+                conteos[i] += 1
+            else:
+                errores[i] += 1
+
+    threads = [threading.Thread(target=cliente, args=(i,)) for i in range(hilos)]
+    inicio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracion = time.perf_counter() - inicio
+    return sum(conteos) / duracion, sum(errores)
+
+
+def ejecutar_modo(segundos, hilos):
+    """Se ejecuta en un subproceso con las variables de entorno del modo ya aplicadas"""
+    salida_real = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # la app imprime mucho por petición
+    try:
+        from main_sqlite import app
+        app.config['TESTING'] = True
+
+        with sqlite3.connect(os.environ['DATABASE_PATH']) as conn:
+            juego_id = conn.execute('SELECT id FROM juegos ORDER BY id LIMIT 1').fetchone()[0]
+
+        orden = {
+            'juego_id': juego_id, 'paquete': 'Benchmark', 'monto': 1.0,
+            'usuario_id': '123', 'metodo_pago': 'Pago Móvil', 'referencia_pago': 'BENCH'
+        }
+        resultados = {
+            '/productos': medir(app, '/productos', segundos, hilos),
+            '/orden': medir(app, '/orden', segundos, hilos, metodo='POST', payload=orden),
+        }
+    finally:
+        sys.stdout.close()
+        sys.stdout = salida_real
+    print(json.dumps(resultados))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--segundos', type=float, default=5)
+    parser.add_argument('--hilos', type=int, default=8)
+    parser.add_argument('--base', default='inefablestore.db')
+    parser.add_argument('--modo-interno', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.modo_interno:
+        ejecutar_modo(args.segundos, args.hilos)
+        return
+
+    print("⏱️  BENCHMARK DE CONEXIONES SQLITE")
+    print("=" * 60)
+    print(f"   Hilos: {args.hilos} | Duración por endpoint: {args.segundos}s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for nombre, entorno in MODOS.items():
+            ruta = os.path.join(tmp, 'bench.db')
+            for sufijo in ('', '-wal', '-shm'):
+                if os.path.exists(ruta + sufijo):
+                    os.remove(ruta + sufijo)
+            preparar_base(args.base, ruta)
+
+            env = dict(os.environ, DATABASE_PATH=ruta, GMAIL_APP_PASSWORD='', **entorno)
+            proceso = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--modo-interno',
+                 '--segundos', str(args.segundos), '--hilos', str(args.hilos)],
+                env=env, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+            if proceso.returncode != 0:
+                print(f"❌ Error en modo {nombre}:\n{proceso.stderr}")
+                continue
+
+            resultados = json.loads(proceso.stdout.strip().splitlines()[-1])
+            print(f"\n📊 {nombre}")
+            for endpoint, (rps, errores) in resultados.items():
+                print(f"   {endpoint:<12} {rps:8.1f} req/s  ({errores} errores)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Fixtures compartidas por las pruebas: main_sqlite sobre una base temporal
+"""
+
+import importlib
+
+import pytest
+
+ADMIN_EMAIL = 'admin@prueba.com'
+ADMIN_PASSWORD = 'clave-prueba'
+
+@pytest.fixture(scope='session')
+def main_sqlite(tmp_path_factory):
+    """El módulo de la app importado una sola vez sobre una base (y archivo) temporales.
+
+    Importarlo no arranca hilos en segundo plano.
+    """
+    with pytest.MonkeyPatch.context() as entorno:
+        entorno.setenv('DATABASE_PATH', str(tmp_path_factory.mktemp('db') / 'prueba.db'))
+        entorno.setenv('ADMIN_EMAIL', ADMIN_EMAIL)
+        entorno.setenv('ADMIN_PASSWORD', ADMIN_PASSWORD)
+        entorno.setenv('GMAIL_APP_PASSWORD', '')
+        modulo = importlib.import_module('main_sqlite')
+    modulo.app.config.update(TESTING=True)
+    return modulo
+
+@pytest.fixture
+def cliente(main_sqlite):
+    return main_sqlite.app.test_client()
+
+@pytest.fixture
+def cliente_admin(cliente):
+    respuesta = cliente.post('/login', json={'email': ADMIN_EMAIL, 'password': ADMIN_PASSWORD})
+    assert respuesta.status_code == 200
+    return cliente
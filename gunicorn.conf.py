@@ -0,0 +1,13 @@
+"""
+Configuración de Gunicorn (se carga sola al arrancar gunicorn desde este directorio)
+
+Los hilos de fondo de la app (mantenimiento y despachador del outbox) no arrancan al
+importar main_sqlite: cada worker los arranca aquí, después del fork, para que no los
+hereden a medias ni los arranquen los comandos CLI, benchmarks o mail_worker.py.
+MANTENIMIENTO_EN_WEB=0 / OUTBOX_DISPATCHER_EN_WEB=0 desactivan cada uno.
+"""
+
+
+def post_fork(server, worker):
+    from main_sqlite import iniciar_hilos_servidor
+    iniciar_hilos_servidor()
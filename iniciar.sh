@@ -0,0 +1,58 @@
+#!/usr/bin/env bash
+# Arranque en Render: Gunicorn y el mail worker en el mismo contenedor (la base SQLite
+# es un archivo local). Este script es el proceso principal y hace de supervisor:
+#   - SIGTERM/SIGINT se reenvía a los dos hijos y se espera a que terminen (el mail
+#     worker acaba su lote, Gunicorn drena sus peticiones)
+#   - si el mail worker falla se relanza a los 5 s; si sale con 0 (terminó a propósito)
+#     no se relanza
+#   - si Gunicorn termina, se detiene también el mail worker y se sale con su estado
+#     para que la plataforma reinicie el servicio
+
+set -u
+cd "$(dirname "$0")"
+
+detener=0
+
+mail_worker_supervisado() {
+    local hijo='' estado
+    trap 'detener=1; [ -n "$hijo" ] && kill -TERM "$hijo" 2>/dev/null' TERM
+    while [ "$detener" = 0 ]; do
+        python mail_worker.py &
+        hijo=$!
+        wait "$hijo"
+        estado=$?
+        # wait vuelve en cuanto llega la señal: esperar a que el worker termine de verdad
+        while kill -0 "$hijo" 2>/dev/null; do
+            wait "$hijo"
+            estado=$?
+        done
+        if [ "$detener" = 1 ] || [ "$estado" = 0 ]; then
+            break
+        fi
+        echo "⚠️ mail_worker.py terminó con estado $estado, se relanza en 5 s"
+        sleep 5
+    done
+}
+
+mail_worker_supervisado &
+mail_pid=$!
+
+gunicorn main:app --config gunicorn.conf.py --bind "0.0.0.0:${PORT:-5000}" --worker-class gthread --threads 8 &
+gunicorn_pid=$!
+
+# La trampa se instala después de lanzar los hijos para que no la hereden
+trap 'detener=1; kill -TERM "$mail_pid" "$gunicorn_pid" 2>/dev/null' TERM INT
+
+wait "$gunicorn_pid"
+estado=$?
+while kill -0 "$gunicorn_pid" 2>/dev/null; do
+    wait "$gunicorn_pid"
+    estado=$?
+done
+
+if [ "$detener" = 0 ]; then
+    echo "❌ Gunicorn terminó con estado $estado, deteniendo el mail worker"
+    kill -TERM "$mail_pid" 2>/dev/null
+fi
+wait "$mail_pid"
+exit "$estado"
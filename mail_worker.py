@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Proceso de envío de correos de Inefable Store, separado de los workers web.
+
+Uso:
+    python mail_worker.py [--una-vez] [--espera 2]
+
+Reclama los correos del outbox, los arma con las mismas funciones de envío de
+main_sqlite.py y los envía por el pool SMTP. Puede correr junto a varios workers de
+Gunicorn y a otros mail workers sin duplicar envíos: cada correo lo reclama un solo
+proceso (BEGIN IMMEDIATE en reclamar_correos). Para que la web solo encole, arrancar
+Gunicorn con OUTBOX_DISPATCHER_EN_WEB=0.
+
+SIGTERM o Ctrl+C terminan el lote en curso y salen; lo que no se llegó a enviar vuelve a
+la cola al vencer su visibilidad (OUTBOX_VISIBILIDAD_SEGUNDOS).
+"""
+
+import argparse
+import os
+import signal
+import sys
+import threading
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--una-vez', action='store_true',
+                        help='Enviar lo que ya toca y salir (para cron o pruebas)')
+    parser.add_argument('--espera', type=float, default=2,
+                        help='Segundos entre sondeos del outbox cuando no hay correos (por defecto 2)')
+    args = parser.parse_args()
+
+    # Importar la app no arranca hilos de fondo: el mantenimiento sigue en los workers web
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main_sqlite
+
+    if not os.environ.get('GMAIL_APP_PASSWORD'):
+        print("⚠️ GMAIL_APP_PASSWORD no configurada: los correos quedan en el outbox")
+        if args.una_vez:
+            return 1
+
+    if args.una_vez:
+        enviados = fallidos = 0
+        while True:
+            lote = main_sqlite.procesar_outbox()
+            if not sum(lote):
+                break
+            enviados += lote[0]
+            fallidos += lote[1]
+        print(f"📧 Outbox: {enviados} correos enviados, {fallidos} fallidos")
+        return 0 if not fallidos else 1
+
+    detener = threading.Event()
+
+    def al_recibir_senal(signum, frame):
+        # Solo marca el Event: el bucle lo ve al terminar el lote o la espera en curso
+        print(f"🛑 Señal {signal.Signals(signum).name}: terminando el lote en curso")
+        detener.set()
+
+    signal.signal(signal.SIGTERM, al_recibir_senal)
+    signal.signal(signal.SIGINT, al_recibir_senal)
+
+    main_sqlite.OUTBOX_ESPERA_SEGUNDOS = args.espera
+    print(f"📮 Mail worker (pid {os.getpid()}) despachando el outbox de {main_sqlite.DATABASE_PATH}")
+    main_sqlite.bucle_despachador_outbox(detener)
+
+    estadisticas = main_sqlite.pool_smtp().estadisticas
+    print(f"👋 Mail worker detenido: {estadisticas['enviados']} enviados, "
+          f"{estadisticas['conexiones']} sesiones SMTP abiertas")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,11 +3,12 @@ Punto de entrada principal para la aplicación Inefable Store
 Este archivo importa la aplicación Flask desde main_sqlite.py para compatibilidad con Render
 """
 
-from main_sqlite import app
+from main_sqlite import app, iniciar_hilos_servidor
 
 if __name__ == '__main__':
-    # Solo para desarrollo local
+    # Solo para desarrollo local (con Gunicorn los hilos los arranca gunicorn.conf.py)
     import os
+    iniciar_hilos_servidor()
     port = int(os.environ.get('PORT', 5000))
     print(f'🚀 Iniciando servidor en puerto {port}')
     app.run(host='0.0.0.0', port=port, debug=False)
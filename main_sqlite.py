@@ -1,12 +1,13 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template, session, redirect, url_for, g, has_request_context
 import os
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, text, event, bindparam
+from sqlalchemy.pool import NullPool, QueuePool
 import secrets
-from datetime import datetime, timedelta
+import hashlib
+from datetime import datetime, timedelta, timezone
 import uuid
 from pathlib import Path
 import time
@@ -14,13 +15,36 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import threading
+import atexit
+import random
 from dotenv import load_dotenv
 import json
+import csv
+import io
+import re
+import gzip
+import shutil
+import tempfile
+import contextlib
+import base64
+import bisect
+import urllib.parse
+import concurrent.futures
+from collections import OrderedDict, deque
+try:
+    import fcntl  # flock entre workers (no existe en Windows: ahí solo bloquea entre hilos)
+except ImportError:
+    fcntl = None
+import click
+import jinja2
+from markupsafe import Markup
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'tu_clave_secreta_aqui')
 app.config['UPLOAD_FOLDER'] = 'static/images'
+# Exponer el número de sentencias SQL por petición en la cabecera X-Consultas-SQL
+app.config['CONTAR_CONSULTAS_SQL'] = os.environ.get('CONTAR_CONSULTAS_SQL', '0') == '1'
 
 # Configuración de sesión mejorada
 from datetime import timedelta
@@ -32,22 +56,77 @@ app.config['SESSION_COOKIE_NAME'] = 'inefablestore_session'  # Nombre específic
 app.config['SESSION_COOKIE_PATH'] = '/'  # Disponible en toda la aplicación
 
 # Configuración de SQLite
-DATABASE_PATH = 'inefablestore.db'
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'inefablestore.db')
+
+# Pool de conexiones por proceso (DB_POOL_SIZE=0 desactiva el pool: una conexión nueva por petición)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_READ_POOL_SIZE = int(os.environ.get('DB_READ_POOL_SIZE', 5))
+DB_JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL').upper()
+
+# PRAGMAs aplicados a cada conexión nueva (escritura y lectura)
+SQLITE_PRAGMAS = [
+    ('busy_timeout', int(os.environ.get('DB_BUSY_TIMEOUT_MS', 30000))),
+    # NORMAL es seguro en modo WAL; en modo rollback-journal mantenemos FULL
+    ('synchronous', 'NORMAL' if DB_JOURNAL_MODE == 'WAL' else 'FULL'),
+    ('cache_size', -int(os.environ.get('DB_CACHE_SIZE_KB', 16000))),  # negativo = KiB
+    ('mmap_size', int(os.environ.get('DB_MMAP_SIZE', 128 * 1024 * 1024))),
+    ('temp_store', 'MEMORY'),
+    # INSERT OR REPLACE borra la fila en conflicto; con esto dispara los triggers de DELETE
+    ('recursive_triggers', 'ON'),
+]
+
+def configurar_conexion_sqlite(dbapi_connection, solo_lectura=False):
+    """Aplica journal mode y PRAGMAs de rendimiento a una conexión sqlite3 recién abierta"""
+    cursor = dbapi_connection.cursor()
+    try:
+        if not solo_lectura:
+            # journal_mode es persistente en el archivo; repetirlo es barato
+            cursor.execute(f'PRAGMA journal_mode={DB_JOURNAL_MODE}')
+        for pragma, valor in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {pragma}={valor}')
+        if solo_lectura:
+            cursor.execute('PRAGMA query_only=1')
+    finally:
+        cursor.close()
+
+def create_db_engine(solo_lectura=False):
+    """Crear engine de SQLAlchemy para SQLite con pool de conexiones"""
+    if solo_lectura:
+        ruta = urllib.parse.quote(os.path.abspath(DATABASE_PATH))
+        database_url = f"sqlite:///file:{ruta}?mode=ro&uri=true"
+        pool_size = DB_READ_POOL_SIZE
+    else:
+        database_url = f"sqlite:///{DATABASE_PATH}"
+        pool_size = DB_POOL_SIZE
+
+    print(f"🔗 Conectando a SQLite: {database_url} ({'lectura' if solo_lectura else 'escritura'}, pool={pool_size})")
+
+    if pool_size > 0:
+        pool_args = {
+            'poolclass': QueuePool,
+            'pool_size': pool_size,
+            'max_overflow': DB_POOL_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+        }
+    else:
+        pool_args = {'poolclass': NullPool}
 
-def create_db_engine():
-    """Crear engine de SQLAlchemy para SQLite"""
-    database_url = f"sqlite:///{DATABASE_PATH}"
-    
-    print(f"🔗 Conectando a SQLite: {database_url}")
-    
     try:
         engine = create_engine(
             database_url,
-            poolclass=NullPool,  # Para evitar problemas de conexión
-            pool_pre_ping=True,  # Para verificar conexiones antes de usarlas
-            echo=False  # Cambiar a True para debug SQL
+            connect_args={'check_same_thread': False, 'timeout': 30},
+            echo=False,  # Cambiar a True para debug SQL
+            **pool_args
         )
 
+        @event.listens_for(engine, 'connect')
+        def _on_connect(dbapi_connection, connection_record):
+            configurar_conexion_sqlite(dbapi_connection, solo_lectura=solo_lectura)
+
+        event.listen(engine, 'before_cursor_execute', _contar_consulta_sql)
+
         # Probar la conexión
         with engine.connect() as conn:
             conn.execute(text('SELECT 1'))
@@ -58,570 +137,2238 @@ def create_db_engine():
         print(f"❌ Error conectando a SQLite: {e}")
         raise e
 
-# Engine global
+def _contar_consulta_sql(conn, cursor, statement, parameters, context, executemany):
+    """Cuenta las sentencias SQL ejecutadas durante la petición actual"""
+    if has_request_context():
+        g.consultas_sql = g.get('consultas_sql', 0) + 1
+
+# Engines globales (uno por proceso): escritura y solo lectura
 db_engine = None
+db_read_engine = None
+_engine_lock = threading.Lock()
 
 def get_db_connection():
     """Obtener conexión a la base de datos usando SQLAlchemy"""
     global db_engine
     if db_engine is None:
-        db_engine = create_db_engine()
+        with _engine_lock:
+            if db_engine is None:
+                db_engine = create_db_engine()
     return db_engine.connect()
 
+def get_db_read_connection():
+    """Obtener conexión de solo lectura para endpoints públicos.
+
+    Con WAL los lectores no bloquean a los escritores; sin pool se usa la conexión normal.
+    """
+    global db_read_engine
+    if DB_POOL_SIZE <= 0 or DB_READ_POOL_SIZE <= 0:
+        return get_db_connection()
+    if db_read_engine is None:
+        with _engine_lock:
+            if db_read_engine is None:
+                db_read_engine = create_db_engine(solo_lectura=True)
+    return db_read_engine.connect()
+
 def get_sqlite_connection():
-    """Obtener conexión directa con sqlite3 para funciones que lo requieren"""
+    """Obtener conexión directa con sqlite3 para tareas de mantenimiento (fuera del pool)"""
     try:
         conn = sqlite3.connect(DATABASE_PATH, timeout=30)
+        configurar_conexion_sqlite(conn)
         conn.row_factory = sqlite3.Row  # Para acceder por nombre de columna
         return conn
     except Exception as e:
         print(f"❌ Error en conexión sqlite3: {e}")
         raise e
 
-def enviar_correo_gift_card_completada(orden_info):
-    """Envía correo al usuario con el código de la Gift Card"""
-    try:
-        # Configuración del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"🎁 Enviando Gift Card completada para orden #{orden_info['id']}")
-        print(f"📧 Destinatario: {orden_info['usuario_email']}")
+# CACHÉS EN MEMORIA VERSIONADAS
+# Cada worker guarda un snapshot en memoria; la tabla versiones_datos (mantenida por triggers)
+# indica cuándo otro worker o proceso modificó los datos.
+CACHE_VERIFICACION_SEGUNDOS = float(os.environ.get('CACHE_VERIFICACION_SEGUNDOS', 1.0))
 
-        if not email_password:
-            print("❌ ERROR: No se encontró la contraseña de Gmail")
-            return False
+_versiones_verificadas = {}  # clave -> (version, actualizado, verificado_en)
 
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = orden_info['usuario_email']
-        mensaje['Subject'] = f"🎁 ¡Tu Gift Card está lista! - Orden #{orden_info['id']} - Inefable Store"
-
-        # Cuerpo del mensaje específico para Gift Cards
-        cuerpo = f"""
-        ¡Hola! 🎁
-
-        ¡Excelentes noticias! Tu Gift Card ha sido procesada exitosamente.
-
-        📋 Detalles de tu orden:
-        • Orden #: {orden_info['id']}
-        • Producto: {orden_info.get('juego_nombre', 'Gift Card')}
-        • Paquete: {orden_info['paquete']}
-        • Monto: ${orden_info['monto']}
-        • Estado: ✅ COMPLETADA
-        • Fecha de procesamiento: {datetime.now().strftime('%d/%m/%Y a las %H:%M')}
-
-        🎯 CÓDIGO DE TU GIFT CARD:
-        ════════════════════════════════════
-        🔑 {orden_info.get('codigo_producto', 'CÓDIGO NO DISPONIBLE')}
-        ════════════════════════════════════
-
-        📝 Instrucciones de uso:
-        • Guarda este código en un lugar seguro
-        • Utiliza este código en la plataforma correspondiente
-        • El código es de un solo uso
-        • Si tienes problemas para canjearlo, contáctanos
-
-        ⚠️ IMPORTANTE: Este código es personal e intransferible.
-        No lo compartas con nadie para evitar fraudes.
-
-        ¡Gracias por confiar en Inefable Store! 🚀
-
-        ---
-        Equipo de Inefable Store
-        """
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("📤 Enviando Gift Card con código al usuario...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(email_usuario, email_password)
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, orden_info['usuario_email'], texto)
-        server.quit()
+def leer_version_datos(clave):
+    """Devuelve (version, actualizado) de una clave de versiones_datos.
 
-        print(f"✅ Gift Card enviada exitosamente a: {orden_info['usuario_email']}")
-        return True
+    El resultado se reutiliza durante CACHE_VERIFICACION_SEGUNDOS, así que la mayoría
+    de las llamadas no tocan la base de datos.
+    """
+    verificada = _versiones_verificadas.get(clave)
+    if verificada and time.monotonic() - verificada[2] < CACHE_VERIFICACION_SEGUNDOS:
+        return verificada[0], verificada[1]
 
-    except Exception as e:
-        print(f"❌ Error al enviar Gift Card: {str(e)}")
-        return False
+    conn = get_db_read_connection()
+    try:
+        result = conn.execute(text('SELECT version, actualizado FROM versiones_datos WHERE clave = :clave'),
+                              {'clave': clave})
+        fila = result.fetchone()
+    finally:
+        conn.close()
 
-def enviar_correo_recarga_completada(orden_info):
-    """Envía correo al usuario confirmando que su recarga ha sido completada"""
+    version, actualizado = (fila[0], fila[1]) if fila else (0, None)
+    _versiones_verificadas[clave] = (version, actualizado, time.monotonic())
+    return version, actualizado
+
+def invalidar_version_datos(clave):
+    """Fuerza a releer la versión en la próxima consulta (escrituras de este worker)"""
+    _versiones_verificadas.pop(clave, None)
+
+class CacheVersionada:
+    """Snapshot en memoria que se reconstruye solo cuando cambia la versión de sus datos.
+
+    La reconstrucción es single-flight: si varios hilos encuentran la caché vencida a la
+    vez, solo uno consulta SQLite y el resto espera y reutiliza su resultado.
+    """
+
+    def __init__(self, clave, constructor):
+        self.clave = clave
+        self.constructor = constructor
+        self._snapshot = None  # (valor, version, actualizado), se reemplaza de forma atómica
+        self._lock = threading.Lock()
+
+    def invalidar(self):
+        invalidar_version_datos(self.clave)
+
+    def obtener(self):
+        """Devuelve (valor, version, actualizado)"""
+        version, actualizado = leer_version_datos(self.clave)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[1] == version:
+            return snapshot
+
+        with self._lock:
+            # Otro hilo pudo haber reconstruido mientras esperábamos
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot[1] == version:
+                return snapshot
+
+            # La versión se leyó antes de construir: si hay una escritura en medio, el
+            # snapshot queda etiquetado con una versión anterior y se reconstruye de nuevo
+            self._snapshot = (self.constructor(), version, actualizado)
+            return self._snapshot
+
+# PETICIONES CONDICIONALES (ETag / Last-Modified)
+def _fecha_http(actualizado):
+    """Convierte el CURRENT_TIMESTAMP de SQLite (UTC) en datetime con zona horaria"""
+    if not actualizado:
+        return None
     try:
-        # Configuración del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
+        return datetime.strptime(str(actualizado)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def _no_modificado(etag, ultima_modificacion):
+    """Evalúa If-None-Match / If-Modified-Since según RFC 9110 (If-None-Match tiene prioridad)"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and ultima_modificacion:
+        return ultima_modificacion <= request.if_modified_since
+    return False
+
+# CUERPOS DE RESPUESTA PRECOMPRIMIDOS
+# Para cada (clave, versión) se serializa el JSON una sola vez y se guardan sus variantes
+# comprimidas; en un acierto la petición solo hace una búsqueda en diccionario.
+try:
+    import brotli  # Opcional: pip install brotli
+except ImportError:
+    brotli = None
+
+CODIFICACIONES_DISPONIBLES = (['br'] if brotli else []) + ['gzip', 'identity']
+CACHE_CUERPOS_MAX_ENTRADAS = int(os.environ.get('CACHE_CUERPOS_MAX_ENTRADAS', 512))
+
+class CacheCuerpos:
+    """LRU de cuerpos JSON serializados y comprimidos, indexados por clave y versión"""
+
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()  # clave -> (version, {codificacion: bytes})
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, version, construir_datos):
+        entrada = self._entradas.get(clave)
+        if entrada is not None and entrada[0] == version:
+            return entrada[1]
+
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[0] == version:
+                return entrada[1]
+
+            cuerpo = app.json.dumps(construir_datos()).encode('utf-8')
+            variantes = {'identity': cuerpo, 'gzip': gzip.compress(cuerpo, compresslevel=6)}
+            if brotli:
+                variantes['br'] = brotli.compress(cuerpo, quality=9)
+
+            self._entradas[clave] = (version, variantes)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+            return variantes
+
+    def invalidar(self, clave):
+        self._entradas.pop(clave, None)
+
+cache_cuerpos = CacheCuerpos(CACHE_CUERPOS_MAX_ENTRADAS)
+
+def _elegir_codificacion():
+    """Mejor codificación aceptada por el cliente entre las que tenemos precalculadas"""
+    if 'Accept-Encoding' not in request.headers:
+        return 'identity'
+    return request.accept_encodings.best_match(CODIFICACIONES_DISPONIBLES, default='identity')
+
+def respuesta_json_cacheada(clave, version, actualizado, construir_datos):
+    """Respuesta JSON condicional servida desde cache_cuerpos.
+
+    Cada codificación tiene su propio ETag fuerte; si el cliente ya tiene la versión se
+    devuelve 304 sin serializar ni consultar la base de datos.
+    """
+    codificacion = _elegir_codificacion()
+    etag = f'{clave}-{version}' if codificacion == 'identity' else f'{clave}-{version}-{codificacion}'
+    ultima_modificacion = _fecha_http(actualizado)
+
+    if _no_modificado(etag, ultima_modificacion):
+        response = app.response_class(status=304)
+    else:
+        variantes = cache_cuerpos.obtener(clave, version, construir_datos)
+        response = app.response_class(variantes[codificacion], mimetype='application/json')
+        if codificacion != 'identity':
+            response.headers['Content-Encoding'] = codificacion
+
+    response.set_etag(etag)
+    if ultima_modificacion:
+        response.last_modified = ultima_modificacion
+    response.vary.add('Accept-Encoding')
+    # El navegador puede guardar la respuesta pero debe revalidarla en cada uso
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-        print(f"📨 Enviando confirmación de recarga completada para orden #{orden_info['id']}")
-        print(f"📧 Destinatario: {orden_info['usuario_email']}")
+# ENVÍO DE CORREO (sesiones SMTP reutilizables por proceso)
+# Abrir una sesión cuesta conexión + EHLO + STARTTLS (handshake TLS) + EHLO + LOGIN; con el
+# pool se paga una vez por sesión y cada correo solo cuesta MAIL/RCPT/DATA.
+SMTP_SERVIDOR = os.environ.get('SMTP_SERVIDOR', 'smtp.gmail.com')
+SMTP_PUERTO = int(os.environ.get('SMTP_PUERTO', 587))
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT_SEGUNDOS = float(os.environ.get('SMTP_TIMEOUT_SEGUNDOS', 30))
+SMTP_POOL_TAMANO = int(os.environ.get('SMTP_POOL_TAMANO', 2))
+# Una sesión inactiva más de esto se comprueba con NOOP antes de reutilizarla
+SMTP_VERIFICAR_TRAS_SEGUNDOS = float(os.environ.get('SMTP_VERIFICAR_TRAS_SEGUNDOS', 10))
+# Gmail corta las sesiones inactivas a los pocos minutos: pasado esto se abre otra sin probar
+SMTP_INACTIVIDAD_MAXIMA_SEGUNDOS = float(os.environ.get('SMTP_INACTIVIDAD_MAXIMA_SEGUNDOS', 240))
+SMTP_MENSAJES_POR_SESION = int(os.environ.get('SMTP_MENSAJES_POR_SESION', 100))
+EMAIL_TIENDA = os.environ.get('SMTP_USUARIO', '1yorbi1@gmail.com')
+
+class PoolSMTP:
+    """Sesiones SMTP autenticadas y reutilizables, compartidas por los hilos del proceso.
+
+    Como mucho `tamano` sesiones a la vez; se reutiliza primero la usada más recientemente.
+    Si una sesión reutilizada resulta estar cerrada, el envío se repite una vez con una
+    sesión nueva.
+    """
+
+    def __init__(self, servidor, puerto, usuario, password, tamano=SMTP_POOL_TAMANO,
+                 starttls=SMTP_STARTTLS, timeout=SMTP_TIMEOUT_SEGUNDOS,
+                 verificar_tras=SMTP_VERIFICAR_TRAS_SEGUNDOS,
+                 inactividad_maxima=SMTP_INACTIVIDAD_MAXIMA_SEGUNDOS,
+                 mensajes_por_sesion=SMTP_MENSAJES_POR_SESION):
+        self.servidor = servidor
+        self.puerto = puerto
+        self.usuario = usuario
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.verificar_tras = verificar_tras
+        self.inactividad_maxima = inactividad_maxima
+        self.mensajes_por_sesion = mensajes_por_sesion
+        self._libres = []  # [(smtp, ultimo_uso, enviados)], la última es la más reciente
+        self._cupos = threading.BoundedSemaphore(tamano)
+        self._lock = threading.Lock()
+        self.estadisticas = {'conexiones': 0, 'reutilizadas': 0, 'descartadas': 0, 'enviados': 0, 'errores': 0}
+
+    def _contar(self, clave):
+        with self._lock:
+            self.estadisticas[clave] += 1
+
+    def _conectar(self):
+        smtp = smtplib.SMTP(self.servidor, self.puerto, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.password:
+                smtp.login(self.usuario, self.password)
+        except Exception:
+            self._cerrar(smtp)
+            raise
+        self._contar('conexiones')
+        return smtp
+
+    @staticmethod
+    def _cerrar(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
 
-        if not email_password:
-            print("❌ ERROR: No se encontró la contraseña de Gmail")
+    def _sesion_activa(self, smtp, ultimo_uso):
+        inactiva = time.monotonic() - ultimo_uso
+        if inactiva > self.inactividad_maxima:
             return False
+        if inactiva > self.verificar_tras:
+            try:
+                return smtp.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                return False
+        return True
 
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = orden_info['usuario_email']
-        mensaje['Subject'] = f"🎉 ¡Tu recarga está lista! - Orden #{orden_info['id']} - Inefable Store"
-
-        # Cuerpo del mensaje personalizado para el usuario
-        cuerpo = f"""
-        ¡Hola! 🎮
-
-        ¡Excelentes noticias! Tu recarga ha sido procesada exitosamente.
-
-        📋 Detalles de tu orden:
-        • Orden #: {orden_info['id']}
-        • Juego: {orden_info.get('juego_nombre', 'N/A')}
-        • Paquete: {orden_info['paquete']}
-        • Monto: ${orden_info['monto']}
-        • Tu ID en el juego: {orden_info.get('usuario_id', 'No especificado')}
-        • Estado: ✅ COMPLETADA
-        • Fecha de procesamiento: {datetime.now().strftime('%d/%m/%Y a las %H:%M')}
-
-        🎯 Tu recarga ya está disponible en tu cuenta del juego.
-        Si tienes algún problema, no dudes en contactarnos.
-
-        ¡Gracias por confiar en Inefable Store! 🚀
-
-        ---
-        Equipo de Inefable Store
-        """
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("📤 Enviando correo de confirmación al usuario...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(email_usuario, email_password)
+    def _tomar(self):
+        """(smtp, enviados, reutilizada); se debe llamar con un cupo adquirido"""
+        while True:
+            with self._lock:
+                if not self._libres:
+                    break
+                smtp, ultimo_uso, enviados = self._libres.pop()
+            if self._sesion_activa(smtp, ultimo_uso):
+                self._contar('reutilizadas')
+                return smtp, enviados, True
+            self._contar('descartadas')
+            self._cerrar(smtp)
+        return self._conectar(), 0, False
+
+    def _devolver(self, smtp, enviados):
+        if enviados >= self.mensajes_por_sesion:
+            self._cerrar(smtp)
+            return
+        with self._lock:
+            self._libres.append((smtp, time.monotonic(), enviados))
+
+    @staticmethod
+    def _sesion_caida(error):
+        """True si el error indica que la conexión ya no sirve (no un rechazo del mensaje)"""
+        if isinstance(error, smtplib.SMTPServerDisconnected):
+            return True
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code == 421  # el servidor cierra la sesión
+        # smtplib.SMTPException hereda de OSError; aquí solo cuentan los errores de socket
+        return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+    def enviar(self, mensaje, remitente=None, destinatarios=None):
+        """Envía un email.message (o MIMEMultipart) usando una sesión del pool"""
+        remitente = remitente or mensaje['From'] or self.usuario
+        destinatarios = destinatarios or [mensaje['To']]
         texto = mensaje.as_string()
-        server.sendmail(email_usuario, orden_info['usuario_email'], texto)
-        server.quit()
+        with self._cupos:
+            smtp, enviados, reutilizada = self._tomar()
+            try:
+                smtp.sendmail(remitente, destinatarios, texto)
+            except Exception as e:
+                caida = self._sesion_caida(e)
+                if caida:
+                    self._cerrar(smtp)
+                if not (caida and reutilizada):
+                    # Rechazo del mensaje (la sesión sigue sirviendo) o fallo de una sesión
+                    # recién abierta: reintentar no ayudaría
+                    if not caida:
+                        self._devolver(smtp, enviados)
+                    self._contar('errores')
+                    raise
+                # Sesión cerrada por el servidor entre el NOOP y el envío: una sesión nueva
+                self._contar('descartadas')
+                smtp, enviados = self._conectar(), 0
+                try:
+                    smtp.sendmail(remitente, destinatarios, texto)
+                except Exception:
+                    self._cerrar(smtp)
+                    self._contar('errores')
+                    raise
+            self._contar('enviados')
+            self._devolver(smtp, enviados + 1)
+
+    def cerrar(self):
+        """Cierra (QUIT) las sesiones libres"""
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for smtp, _, _ in libres:
+            self._cerrar(smtp)
+
+_pool_smtp = None
+_pool_smtp_lock = threading.Lock()
+
+def pool_smtp():
+    """Pool SMTP del proceso; se crea al primer envío (después del fork de Gunicorn)"""
+    global _pool_smtp
+    if _pool_smtp is None:
+        with _pool_smtp_lock:
+            if _pool_smtp is None:
+                _pool_smtp = PoolSMTP(SMTP_SERVIDOR, SMTP_PUERTO, EMAIL_TIENDA,
+                                      os.environ.get('GMAIL_APP_PASSWORD'))
+                atexit.register(_pool_smtp.cerrar)
+    return _pool_smtp
+
+# EJECUTORES EN SEGUNDO PLANO (hilos con cola acotada)
+# Todo el trabajo de fondo de un proceso pasa por aquí en lugar de abrir un hilo por tarea:
+# el número de hilos y la cola tienen techo, y /admin/ejecutores muestra cómo van.
+EJECUTOR_HILOS = int(os.environ.get('EJECUTOR_HILOS', 4))
+EJECUTOR_COLA_MAXIMA = int(os.environ.get('EJECUTOR_COLA_MAXIMA', 200))
+EJECUTOR_POLITICA = os.environ.get('EJECUTOR_POLITICA', 'bloquear')
+EJECUTOR_HILOS_CPU = int(os.environ.get('EJECUTOR_HILOS_CPU', 2))
+# Al apagar el worker se espera como mucho esto a que terminen los trabajos en cola
+# (Gunicorn mata al worker a los 30 s de graceful_timeout)
+EJECUTOR_DRENADO_SEGUNDOS = float(os.environ.get('EJECUTOR_DRENADO_SEGUNDOS', 25))
+
+class EjecutorAcotado:
+    """Pool de hilos con cola de tamaño fijo. `enviar` devuelve un concurrent.futures.Future.
+
+    Con la cola llena aplica `politica`: 'bloquear' (quien encola espera un hueco),
+    'descartar_antiguo' (cancela el trabajo más viejo de la cola) o 'en_linea' (lo ejecuta
+    el propio hilo que encola).
+    """
+
+    POLITICAS = ('bloquear', 'descartar_antiguo', 'en_linea')
+
+    def __init__(self, nombre, hilos=EJECUTOR_HILOS, cola_maxima=EJECUTOR_COLA_MAXIMA,
+                 politica=EJECUTOR_POLITICA):
+        if politica not in self.POLITICAS:
+            raise ValueError(f'Política de desborde no válida: {politica}')
+        self.nombre = nombre
+        self.cola_maxima = cola_maxima
+        self.politica = politica
+        self._cola = deque()  # (futuro, funcion, args, kwargs, encolado)
+        self._condicion = threading.Condition()
+        self._cerrado = False
+        self.estadisticas = {'encolados': 0, 'en_curso': 0, 'completados': 0, 'fallidos': 0,
+                             'descartados': 0, 'en_linea': 0, 'espera_total_ms': 0.0, 'espera_maxima_ms': 0.0}
+        self._hilos = [threading.Thread(target=self._trabajar, name=f'{nombre}-{i + 1}', daemon=True)
+                       for i in range(hilos)]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def enviar(self, funcion, *args, **kwargs):
+        futuro = concurrent.futures.Future()
+        with self._condicion:
+            while True:
+                if self._cerrado:
+                    raise RuntimeError(f'El ejecutor {self.nombre} está cerrado')
+                if len(self._cola) < self.cola_maxima:
+                    self._cola.append((futuro, funcion, args, kwargs, time.monotonic()))
+                    self.estadisticas['encolados'] += 1
+                    self._condicion.notify_all()
+                    return futuro
+                if self.politica == 'bloquear':
+                    self._condicion.wait()
+                elif self.politica == 'descartar_antiguo':
+                    self._cola.popleft()[0].cancel()
+                    self.estadisticas['descartados'] += 1
+                else:
+                    self.estadisticas['en_linea'] += 1
+                    break
+        self._ejecutar(futuro, funcion, args, kwargs, time.monotonic())
+        return futuro
+
+    def _trabajar(self):
+        while True:
+            with self._condicion:
+                while not self._cola and not self._cerrado:
+                    self._condicion.wait()
+                if not self._cola:
+                    return  # cerrado y sin trabajo pendiente
+                trabajo = self._cola.popleft()
+                self._condicion.notify_all()
+            self._ejecutar(*trabajo)
+
+    def _ejecutar(self, futuro, funcion, args, kwargs, encolado):
+        if not futuro.set_running_or_notify_cancel():
+            return
+        espera_ms = (time.monotonic() - encolado) * 1000
+        with self._condicion:
+            self.estadisticas['en_curso'] += 1
+            self.estadisticas['espera_total_ms'] += espera_ms
+            self.estadisticas['espera_maxima_ms'] = max(self.estadisticas['espera_maxima_ms'], espera_ms)
+        try:
+            resultado = funcion(*args, **kwargs)
+        except Exception as e:
+            with self._condicion:
+                self.estadisticas['en_curso'] -= 1
+                self.estadisticas['fallidos'] += 1
+            print(f"❌ Error en un trabajo de {self.nombre} ({getattr(funcion, '__name__', funcion)}): {e}")
+            futuro.set_exception(e)
+        else:
+            with self._condicion:
+                self.estadisticas['en_curso'] -= 1
+                self.estadisticas['completados'] += 1
+            futuro.set_result(resultado)
+
+    def estado(self):
+        with self._condicion:
+            estado = dict(self.estadisticas)
+            estado['en_cola'] = len(self._cola)
+        iniciados = estado['completados'] + estado['fallidos'] + estado['en_curso']
+        estado['espera_media_ms'] = round(estado['espera_total_ms'] / iniciados, 2) if iniciados else 0.0
+        estado['espera_total_ms'] = round(estado['espera_total_ms'], 2)
+        estado['espera_maxima_ms'] = round(estado['espera_maxima_ms'], 2)
+        estado.update(hilos=len(self._hilos), cola_maxima=self.cola_maxima, politica=self.politica)
+        return estado
+
+    def cerrar(self, timeout=EJECUTOR_DRENADO_SEGUNDOS):
+        """No acepta más trabajos y espera (como mucho `timeout`) a que se vacíe la cola"""
+        with self._condicion:
+            self._cerrado = True
+            self._condicion.notify_all()
+        limite = time.monotonic() + timeout
+        for hilo in self._hilos:
+            hilo.join(max(0.0, limite - time.monotonic()))
+        with self._condicion:
+            pendientes = len(self._cola) + self.estadisticas['en_curso']
+        if pendientes:
+            print(f"⚠️ Ejecutor {self.nombre}: {pendientes} trabajos sin terminar al apagar")
+
+_ejecutores = {}
+_ejecutores_lock = threading.Lock()
+
+def _ejecutor(nombre, **opciones):
+    """Ejecutor `nombre` del proceso; se crea al primer uso (después del fork de Gunicorn)"""
+    ejecutor = _ejecutores.get(nombre)
+    if ejecutor is None:
+        with _ejecutores_lock:
+            ejecutor = _ejecutores.get(nombre)
+            if ejecutor is None:
+                ejecutor = _ejecutores[nombre] = EjecutorAcotado(nombre, **opciones)
+                atexit.register(ejecutor.cerrar)
+    return ejecutor
+
+def ejecutor_fondo():
+    """Hilos para trabajo de E/S (envío de correos)"""
+    return _ejecutor('fondo')
+
+def ejecutor_cpu():
+    """Hilos para la compresión de archivos; si la cola se llena, en línea.
+
+    Hilos y no procesos: zlib suelta el GIL mientras comprime, así que los meses se sellan
+    en paralelo, y un pool de procesos con fork creado en un worker que ya tiene hilos
+    puede heredar locks tomados y colgarse.
+    """
+    return _ejecutor('cpu', hilos=EJECUTOR_HILOS_CPU, cola_maxima=EJECUTOR_HILOS_CPU * 4,
+                     politica='en_linea')
+
+# PLANTILLAS DE CORREO (templates/correos/<tipo>.html y <tipo>.txt, con Jinja2)
+# Se cargan y compilan una sola vez al importar el módulo. El pie no depende de la orden:
+# se renderiza una vez y las plantillas lo reciben ya armado.
+DIRECTORIO_PLANTILLAS_CORREO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'correos')
+
+class PlantillasCorreo:
+    """Registro de correos: asunto, cuerpo HTML y cuerpo de texto por tipo"""
+
+    ASUNTOS = {
+        'nueva_orden': '🛒 Nueva Orden #{{ orden.id }} - Inefable Store',
+        'resumen_ordenes': '🛒 {{ ordenes|length }} nuevas órdenes (#{{ ordenes[0].id }} a #{{ ordenes[-1].id }}) - Inefable Store',
+        'recarga_completada': '🎉 ¡Tu recarga está lista! - Orden #{{ orden.id }} - Inefable Store',
+        'gift_card_completada': '🎁 ¡Tu Gift Card está lista! - Orden #{{ orden.id }} - Inefable Store',
+        'orden_rechazada': '⚠️ Orden Rechazada - Datos Incorrectos - Orden #{{ orden.id }} - Inefable Store',
+    }
 
-        print(f"✅ Correo de confirmación enviado exitosamente a: {orden_info['usuario_email']}")
-        return True
+    def __init__(self, directorio=DIRECTORIO_PLANTILLAS_CORREO):
+        cargador = jinja2.FileSystemLoader(directorio)
+        opciones = {'loader': cargador, 'trim_blocks': True, 'lstrip_blocks': True, 'auto_reload': False}
+        self._entorno_html = jinja2.Environment(autoescape=True, **opciones)
+        self._entorno_texto = jinja2.Environment(autoescape=False, keep_trailing_newline=True, **opciones)
+        self._entorno_html.globals['pie_html'] = Markup(self._entorno_html.get_template('_pie.html').render())
+        self._entorno_texto.globals['pie_texto'] = self._entorno_texto.get_template('_pie.txt').render()
+        self._plantillas = {
+            tipo: (self._entorno_texto.from_string(asunto),
+                   self._entorno_html.get_template(f'{tipo}.html'),
+                   self._entorno_texto.get_template(f'{tipo}.txt'))
+            for tipo, asunto in self.ASUNTOS.items()
+        }
 
+    @staticmethod
+    def contexto(tipo, datos):
+        """Variables de la plantilla: una orden, o la lista de órdenes del resumen"""
+        fecha = datetime.now().strftime('%d/%m/%Y a las %H:%M')
+        if tipo == 'resumen_ordenes':
+            return {'ordenes': datos, 'total': sum(float(orden.get('monto') or 0) for orden in datos), 'fecha': fecha}
+        return {'orden': datos, 'fecha': fecha}
+
+    def renderizar(self, tipo, datos):
+        """(asunto, html, texto) del correo `tipo` para `datos`"""
+        asunto, plantilla_html, plantilla_texto = self._plantillas[tipo]
+        contexto = self.contexto(tipo, datos)
+        return asunto.render(contexto), plantilla_html.render(contexto), plantilla_texto.render(contexto)
+
+    def mensaje(self, tipo, datos, remitente, destinatario):
+        """multipart/alternative con texto y HTML (los clientes muestran la última parte que entienden)"""
+        asunto, cuerpo_html, cuerpo_texto = self.renderizar(tipo, datos)
+        mensaje = MIMEMultipart('alternative')
+        mensaje['From'] = remitente
+        mensaje['To'] = destinatario
+        mensaje['Subject'] = asunto
+        mensaje.attach(MIMEText(cuerpo_texto, 'plain', 'utf-8'))
+        mensaje.attach(MIMEText(cuerpo_html, 'html', 'utf-8'))
+        return mensaje
+
+PLANTILLAS_CORREO = PlantillasCorreo()
+
+def enviar_correo_plantilla(tipo, datos, destinatario):
+    """Arma el correo `tipo` con su plantilla y lo envía por el pool SMTP. True si salió"""
+    if not os.environ.get('GMAIL_APP_PASSWORD'):
+        print("❌ ERROR: No se encontró la contraseña de Gmail")
+        print("💡 Solución: Agrega la variable de entorno 'GMAIL_APP_PASSWORD'")
+        return False
+    try:
+        pool_smtp().enviar(PLANTILLAS_CORREO.mensaje(tipo, datos, EMAIL_TIENDA, destinatario))
+    except smtplib.SMTPAuthenticationError as e:
+        print(f"❌ ERROR DE AUTENTICACIÓN: {str(e)}")
+        print("💡 Verifica que tengas una contraseña de aplicación válida")
+        return False
     except Exception as e:
-        print(f"❌ Error al enviar correo de confirmación: {str(e)}")
+        print(f"❌ Error al enviar correo {tipo} a {destinatario}: {str(e)}")
+        print(f"🔍 Tipo de error: {type(e).__name__}")
         return False
+    print(f"✅ Correo {tipo} enviado exitosamente a: {destinatario}")
+    return True
+
+def enviar_correo_gift_card_completada(orden_info):
+    """Envía correo al usuario con el código de la Gift Card"""
+    print(f"🎁 Enviando Gift Card completada para orden #{orden_info['id']}")
+    return enviar_correo_plantilla('gift_card_completada', orden_info, orden_info['usuario_email'])
+
+def enviar_correo_recarga_completada(orden_info):
+    """Envía correo al usuario confirmando que su recarga ha sido completada"""
+    print(f"📨 Enviando confirmación de recarga completada para orden #{orden_info['id']}")
+    return enviar_correo_plantilla('recarga_completada', orden_info, orden_info['usuario_email'])
 
 def enviar_correo_orden_rechazada(orden_info):
     """Envía correo al usuario notificando que su orden ha sido rechazada por datos incorrectos"""
+    print(f"📧 Enviando notificación de orden rechazada para orden #{orden_info['id']}")
+    return enviar_correo_plantilla('orden_rechazada', orden_info, orden_info['usuario_email'])
+
+# ARCHIVO DE ÓRDENES FRÍAS (una base SQLite por mes, comprimida al sellarse)
+ARCHIVO_DIRECTORIO = os.environ.get(
+    'ARCHIVO_DIRECTORIO', os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), 'archivo')
+)
+ARCHIVO_DIAS = int(os.environ.get('ARCHIVO_DIAS', 180))  # 0 = no archivar por antigüedad
+ARCHIVO_COMPRIMIR = os.environ.get('ARCHIVO_COMPRIMIR', '1') == '1'
+ARCHIVO_INTERVALO_SEGUNDOS = float(os.environ.get('ARCHIVO_INTERVALO_SEGUNDOS', 6 * 3600))
+ARCHIVO_LOTE = 500
+# Reintentos de DELETE /admin/producto si entran órdenes del producto mientras se archiva
+ELIMINAR_PRODUCTO_INTENTOS = 3
+# SQLite admite 10 bases adjuntas por conexión; las consultas históricas van por tandas
+ARCHIVO_ADJUNTOS_POR_CONSULTA = 8
+ARCHIVO_PATRON = re.compile(r'^ordenes_(\d{4}-\d{2}|sin-fecha)\.db(\.gz)?$')
+
+COLUMNAS_ORDEN = ('id, juego_id, paquete, monto, usuario_email, usuario_id, usuario_telefono, '
+                  'metodo_pago, referencia_pago, estado, fecha, codigo_producto')
+
+ESQUEMA_ARCHIVO = [
+    # juego_nombre y categoria se copian: el producto puede dejar de existir
+    '''
+    CREATE TABLE IF NOT EXISTS archivo.ordenes (
+        id INTEGER PRIMARY KEY,
+        juego_id INTEGER,
+        paquete TEXT,
+        monto REAL,
+        usuario_email TEXT,
+        usuario_id TEXT,
+        usuario_telefono TEXT,
+        metodo_pago TEXT,
+        referencia_pago TEXT,
+        estado TEXT,
+        fecha TIMESTAMP,
+        codigo_producto TEXT,
+        juego_nombre TEXT,
+        categoria TEXT,
+        motivo TEXT,
+        archivada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archivo.idx_ordenes_fecha ON ordenes(fecha)',
+    'CREATE INDEX IF NOT EXISTS archivo.idx_ordenes_usuario_fecha ON ordenes(usuario_email, fecha)',
+]
+
+def ruta_archivo_mes(mes):
+    return os.path.join(ARCHIVO_DIRECTORIO, f'ordenes_{mes}.db')
+
+_bloqueos_meses = {}
+_bloqueos_meses_lock = threading.Lock()
+
+@contextlib.contextmanager
+def bloqueo_archivo_mes(ruta):
+    """Exclusión por mes al sellar, reabrir o descomprimir un archivo: entre hilos con un
+    Lock y entre workers con flock sobre ordenes_AAAA-MM.db.lock"""
+    base = ruta[:-3] if ruta.endswith('.gz') else ruta
+    with _bloqueos_meses_lock:
+        bloqueo = _bloqueos_meses.setdefault(base, threading.Lock())
+    with bloqueo, open(base + '.lock', 'a') as archivo_bloqueo:
+        if fcntl:
+            fcntl.flock(archivo_bloqueo, fcntl.LOCK_EX)
+        yield
+
+def _copiar_a_temporal(destino, copiar):
+    """Escribe `destino` vía un temporal único en su carpeta (mkstemp) y lo reemplaza al final"""
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(destino) or '.',
+                                            prefix=os.path.basename(destino) + '.', suffix='.tmp')
     try:
-        # Configuración del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"📧 Enviando notificación de orden rechazada para orden #{orden_info['id']}")
-        print(f"📧 Destinatario: {orden_info['usuario_email']}")
-
-        if not email_password:
-            print("❌ ERROR: No se encontró la contraseña de Gmail")
-            return False
-
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = orden_info['usuario_email']
-        mensaje['Subject'] = f"⚠️ Orden Rechazada - Datos Incorrectos - Orden #{orden_info['id']} - Inefable Store"
-
-        # Cuerpo del mensaje para orden rechazada
-        cuerpo = f"""
-        Hola,
-
-        Lamentamos informarte que tu orden ha sido rechazada debido a datos incorrectos.
-
-        📋 Detalles de la orden rechazada:
-        • Orden #: {orden_info['id']}
-        • Juego: {orden_info.get('juego_nombre', 'N/A')}
-        • Paquete: {orden_info['paquete']}
-        • Monto: ${orden_info['monto']}
-        • Método de pago: {orden_info['metodo_pago']}
-        • Referencia proporcionada: {orden_info['referencia_pago']}
-        • Estado: ❌ RECHAZADA
-        • Fecha de rechazo: {datetime.now().strftime('%d/%m/%Y a las %H:%M')}
-
-        ⚠️ Motivo del rechazo:
-        No pudimos encontrar la referencia de pago proporcionada en nuestro sistema. 
-        Esto puede deberse a:
-        
-        • Referencia de pago incorrecta o incompleta
-        • El pago aún no se ha procesado
-        • Error al escribir la referencia
+        with os.fdopen(descriptor, 'wb') as salida:
+            copiar(salida)
+        os.replace(temporal, destino)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporal)
+        raise
+
+def sellar_archivo_mes(ruta):
+    """Comprime un archivo mensual cerrado (ordenes_AAAA-MM.db -> .db.gz) y borra el original"""
+    def comprimir(salida):
+        with open(ruta, 'rb') as origen, gzip.GzipFile(fileobj=salida, mode='wb', compresslevel=6) as destino:
+            shutil.copyfileobj(origen, destino, 1024 * 1024)
+
+    with bloqueo_archivo_mes(ruta):
+        if not os.path.exists(ruta):
+            return  # ya lo selló otro worker
+        _copiar_a_temporal(ruta + '.gz', comprimir)
+        os.remove(ruta)
+
+def _descomprimir_archivo(ruta_gz, destino):
+    def descomprimir(salida):
+        with gzip.open(ruta_gz, 'rb') as origen:
+            shutil.copyfileobj(origen, salida, 1024 * 1024)
+
+    _copiar_a_temporal(destino, descomprimir)
+
+def preparar_archivo_mes(mes):
+    """Ruta escribible del archivo del mes; si estaba sellado se descomprime primero"""
+    os.makedirs(ARCHIVO_DIRECTORIO, exist_ok=True)
+    ruta = ruta_archivo_mes(mes)
+    if not os.path.exists(ruta) and os.path.exists(ruta + '.gz'):
+        with bloqueo_archivo_mes(ruta):
+            # Otro hilo o worker pudo reabrirlo mientras se esperaba el bloqueo
+            if not os.path.exists(ruta):
+                _descomprimir_archivo(ruta + '.gz', ruta)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(ruta + '.gz')
+    return ruta
+
+def conectar_archivador():
+    """Conexión sqlite3 en modo autocommit (transacciones explícitas) para mover órdenes"""
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
+    configurar_conexion_sqlite(conn)
+    return conn
+
+def archivar_ordenes(conn, ids, motivo):
+    """Mueve las órdenes `ids` de la base viva a sus archivos mensuales. Devuelve cuántas movió.
+
+    Con WAL, un COMMIT que abarca varias bases adjuntas no es atómico en conjunto, así
+    que cada mes se hace en dos pasos: copiar y confirmar en el archivo (INSERT OR IGNORE)
+    y después borrar de ordenes solo lo que ya está archivado. Un corte entre ambos deja
+    la orden duplicada, que la siguiente ejecución resuelve; nunca se pierde.
+    """
+    movidas = 0
+    for inicio in range(0, len(ids), ARCHIVO_LOTE):
+        tanda = ids[inicio:inicio + ARCHIVO_LOTE]
+        marcadores = ','.join('?' * len(tanda))
+        meses = conn.execute(f'''
+            SELECT IFNULL(strftime('%Y-%m', fecha), 'sin-fecha'), group_concat(id)
+            FROM ordenes WHERE id IN ({marcadores}) GROUP BY 1
+        ''', tanda).fetchall()
+
+        for mes, ids_mes in meses:
+            ids_mes = [int(i) for i in ids_mes.split(',')]
+            marcadores = ','.join('?' * len(ids_mes))
+            conn.execute('ATTACH DATABASE ? AS archivo', (preparar_archivo_mes(mes),))
+            try:
+                conn.execute('PRAGMA archivo.journal_mode = DELETE')
+                for sentencia in ESQUEMA_ARCHIVO:
+                    conn.execute(sentencia)
+
+                conn.execute('BEGIN')
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO archivo.ordenes ({COLUMNAS_ORDEN}, juego_nombre, categoria, motivo)
+                    SELECT {', '.join('o.' + c.strip() for c in COLUMNAS_ORDEN.split(','))},
+                           j.nombre, j.categoria, ?
+                    FROM main.ordenes o
+                    LEFT JOIN main.juegos j ON j.id = o.juego_id
+                    WHERE o.id IN ({marcadores})
+                ''', [motivo] + ids_mes)
+                conn.execute('COMMIT')
+
+                conn.execute('BEGIN')
+                movidas += conn.execute(f'''
+                    DELETE FROM main.ordenes
+                    WHERE id IN ({marcadores}) AND id IN (SELECT id FROM archivo.ordenes)
+                ''', ids_mes).rowcount
+                conn.execute('COMMIT')
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            finally:
+                conn.execute('DETACH DATABASE archivo')
+    return movidas
+
+def archivar_ordenes_antiguas(dias=None):
+    """Archiva las órdenes con más de `dias` días y sella los meses ya cerrados.
+
+    Devuelve (filas, duracion_ms).
+    """
+    dias = ARCHIVO_DIAS if dias is None else dias
+    inicio = time.perf_counter()
+    total = 0
+    if dias <= 0:
+        return total, 0.0
+
+    corte = (datetime.now(timezone.utc) - timedelta(days=dias)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = conectar_archivador()
+    try:
+        while True:
+            ids = [fila[0] for fila in conn.execute(
+                'SELECT id FROM ordenes WHERE fecha < ? ORDER BY fecha LIMIT ?', (corte, ARCHIVO_LOTE)
+            )]
+            total += archivar_ordenes(conn, ids, 'antiguedad')
+            if len(ids) < ARCHIVO_LOTE:
+                break
+            time.sleep(RETENCION_PAUSA_ENTRE_LOTES)
+    finally:
+        conn.close()
 
-        🔄 ¿Qué puedes hacer?
-        1. Verifica que la referencia de pago sea correcta
-        2. Asegúrate de que el pago se haya completado exitosamente
-        3. Contacta con nosotros si estás seguro de que los datos son correctos
-        4. Realiza una nueva orden con la información correcta
+    if ARCHIVO_COMPRIMIR:
+        # Un mes está cerrado cuando todo él quedó antes del corte: ya no recibirá órdenes.
+        # La compresión es CPU pura (zlib suelta el GIL): los meses se sellan en paralelo
+        sellados = [ejecutor_cpu().enviar(sellar_archivo_mes, ruta) for mes, ruta in meses_archivados()
+                    if ruta.endswith('.db') and mes != 'sin-fecha' and f'{mes}-31 23:59:59' < corte]
+        for futuro in sellados:
+            futuro.result()
+
+    return total, (time.perf_counter() - inicio) * 1000
+
+def ejecutar_archivo_ordenes():
+    filas, duracion_ms = archivar_ordenes_antiguas()
+    registrar_ejecucion_tarea('archivar_ordenes', filas, duracion_ms)
+    print(f"🗄️ Archivo de órdenes: {filas} órdenes con más de {ARCHIVO_DIAS} días archivadas "
+          f"en {duracion_ms:.0f} ms")
+    return filas, duracion_ms
+
+def meses_archivados(desde=None, hasta=None):
+    """[(mes, ruta)] de los archivos existentes, del más reciente al más antiguo"""
+    if not os.path.isdir(ARCHIVO_DIRECTORIO):
+        return []
+    rutas = {}
+    for nombre in os.listdir(ARCHIVO_DIRECTORIO):
+        coincidencia = ARCHIVO_PATRON.match(nombre)
+        if not coincidencia:
+            continue
+        mes = coincidencia.group(1)
+        if mes != 'sin-fecha' and ((desde and mes < desde[:7]) or (hasta and mes > hasta[:7])):
+            continue
+        # Si conviven .db y .db.gz (mes reabierto) manda el .db
+        if mes not in rutas or nombre.endswith('.db'):
+            rutas[mes] = os.path.join(ARCHIVO_DIRECTORIO, nombre)
+    return sorted(rutas.items(), reverse=True)
+
+def _ruta_consultable(ruta):
+    """Para un archivo sellado devuelve una copia descomprimida en caché (se reutiliza)"""
+    if not ruta.endswith('.gz'):
+        return ruta
+    cache = os.path.join(ARCHIVO_DIRECTORIO, '.cache')
+    os.makedirs(cache, exist_ok=True)
+    destino = os.path.join(cache, os.path.basename(ruta)[:-3])
+    with bloqueo_archivo_mes(ruta):
+        if not os.path.exists(ruta):
+            # Se reabrió (o se volvió a sellar) mientras tanto: vale el .db del mes
+            return ruta[:-3]
+        if not os.path.exists(destino) or os.path.getmtime(destino) < os.path.getmtime(ruta):
+            _descomprimir_archivo(ruta, destino)
+    return destino
+
+def consultar_historial_ordenes(condiciones, params, limite):
+    """Órdenes vivas y archivadas que cumplen `condiciones`, de la más reciente a la más antigua.
+
+    Adjunta los archivos mensuales con ATTACH (solo lectura) por tandas y corta en cuanto
+    los meses restantes ya no pueden aportar órdenes más recientes que las encontradas.
+    """
+    where = ('WHERE ' + ' AND '.join(condiciones)) if condiciones else ''
+    params = dict(params, limite=limite)
+    conn = sqlite3.connect(f'file:{os.path.abspath(DATABASE_PATH)}?mode=ro', uri=True, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        configurar_conexion_sqlite(conn, solo_lectura=True)
+        filas = [dict(f) for f in conn.execute(f'''
+            SELECT {', '.join('o.' + c.strip() for c in COLUMNAS_ORDEN.split(','))},
+                   j.nombre as juego_nombre, j.categoria, 0 as archivada
+            FROM ordenes o LEFT JOIN juegos j ON j.id = o.juego_id
+            {where}
+            ORDER BY o.fecha DESC, o.id DESC LIMIT :limite
+        ''', params)]
+
+        meses = meses_archivados(params.get('desde'), params.get('hasta'))
+        consultados = []
+        for inicio in range(0, len(meses), ARCHIVO_ADJUNTOS_POR_CONSULTA):
+            tanda = meses[inicio:inicio + ARCHIVO_ADJUNTOS_POR_CONSULTA]
+            mes_mas_reciente = tanda[0][0]
+            filas.sort(key=lambda f: (f['fecha'] or '', f['id']), reverse=True)
+            if len(filas) >= limite and mes_mas_reciente != 'sin-fecha' and (filas[limite - 1]['fecha'] or '') > f'{mes_mas_reciente}-99':
+                break
+
+            alias = []
+            for n, (mes, ruta) in enumerate(tanda):
+                uri = 'file:' + urllib.parse.quote(os.path.abspath(_ruta_consultable(ruta))) + '?mode=ro'
+                conn.execute(f'ATTACH DATABASE ? AS a{n}', (uri,))
+                alias.append(f'a{n}')
+                consultados.append(mes)
+            try:
+                union = ' UNION ALL '.join(
+                    f'SELECT {COLUMNAS_ORDEN}, juego_nombre, categoria, 1 as archivada FROM {a}.ordenes o {where}'
+                    for a in alias
+                )
+                filas += [dict(f) for f in conn.execute(
+                    f'SELECT * FROM ({union}) ORDER BY fecha DESC, id DESC LIMIT :limite', params
+                )]
+            finally:
+                for a in alias:
+                    conn.execute(f'DETACH DATABASE {a}')
+
+        filas.sort(key=lambda f: (f['fecha'] or '', f['id']), reverse=True)
+        return filas[:limite], consultados
+    finally:
+        conn.close()
 
-        📞 Contacto:
-        Si tienes alguna duda o necesitas ayuda, no dudes en contactarnos a través de nuestros canales de atención.
+# RETENCIÓN DE ÓRDENES (tarea en segundo plano, fuera del checkout)
+RETENCION_ORDENES_POR_USUARIO = int(os.environ.get('RETENCION_ORDENES_POR_USUARIO', 40))
+RETENCION_INTERVALO_SEGUNDOS = float(os.environ.get('RETENCION_INTERVALO_SEGUNDOS', 600))
+RETENCION_LOTE = int(os.environ.get('RETENCION_LOTE', 200))
+RETENCION_PAUSA_ENTRE_LOTES = 0.05
+# Cada cuánto revisa cada worker si le toca ejecutar alguna tarea de mantenimiento
+MANTENIMIENTO_REVISION_SEGUNDOS = 60
+
+SQL_ORDENES_EXCEDENTES = '''
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY usuario_email ORDER BY fecha DESC, id DESC
+        ) AS posicion
+        FROM ordenes
+        WHERE usuario_email IN (
+            SELECT usuario_email FROM ordenes
+            GROUP BY usuario_email HAVING COUNT(*) > :maximo
+        )
+    )
+    WHERE posicion > :maximo
+    LIMIT :lote
+'''
+
+def aplicar_retencion_ordenes(maximo=None, lote=None):
+    """Conserva solo las últimas `maximo` órdenes por usuario. Devuelve (filas, duracion_ms).
+
+    Selecciona por lotes con ROW_NUMBER() y mueve cada lote al archivo mensual en
+    transacciones cortas; entre lotes se cede el bloqueo de escritura para que los
+    checkouts no esperen.
+    """
+    maximo = maximo or RETENCION_ORDENES_POR_USUARIO
+    lote = lote or RETENCION_LOTE
+    inicio = time.perf_counter()
+    total = 0
+
+    conn = conectar_archivador()
+    try:
+        while True:
+            ids = [fila[0] for fila in conn.execute(SQL_ORDENES_EXCEDENTES, {'maximo': maximo, 'lote': lote})]
+            total += archivar_ordenes(conn, ids, 'retencion')
+            if len(ids) < lote:
+                break
+            time.sleep(RETENCION_PAUSA_ENTRE_LOTES)
+    finally:
+        conn.close()
 
-        Gracias por tu comprensión.
+    return total, (time.perf_counter() - inicio) * 1000
 
-        ---
-        Equipo de Inefable Store
-        """
+def reclamar_tarea(nombre, intervalo):
+    """Reserva la próxima ejecución de una tarea; solo un worker la obtiene por intervalo"""
+    conn = get_db_connection()
+    try:
+        ahora = time.time()
+        reclamada = conn.execute(text('''
+            UPDATE tareas_mantenimiento SET proxima_ejecucion = :proxima
+            WHERE nombre = :nombre AND proxima_ejecucion <= :ahora
+        '''), {'nombre': nombre, 'ahora': ahora, 'proxima': ahora + intervalo}).rowcount == 1
+        conn.commit()
+        return reclamada
+    finally:
+        conn.close()
 
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
+def registrar_ejecucion_tarea(nombre, filas, duracion_ms):
+    conn = get_db_connection()
+    try:
+        conn.execute(text('''
+            UPDATE tareas_mantenimiento SET
+                ultima_ejecucion = CURRENT_TIMESTAMP, ultima_duracion_ms = :duracion_ms,
+                ultimas_filas = :filas, filas_totales = filas_totales + :filas,
+                ejecuciones = ejecuciones + 1
+            WHERE nombre = :nombre
+        '''), {'nombre': nombre, 'filas': filas, 'duracion_ms': round(duracion_ms, 1)})
+        conn.commit()
+    finally:
+        conn.close()
 
-        print("📤 Enviando correo de orden rechazada al usuario...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(email_usuario, email_password)
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, orden_info['usuario_email'], texto)
-        server.quit()
+def ejecutar_retencion_ordenes():
+    filas, duracion_ms = aplicar_retencion_ordenes()
+    registrar_ejecucion_tarea('retencion_ordenes', filas, duracion_ms)
+    print(f"🧹 Retención de órdenes: {filas} archivadas en {duracion_ms:.0f} ms "
+          f"(máximo {RETENCION_ORDENES_POR_USUARIO} por usuario)")
+    return filas, duracion_ms
+
+# CLAVES DE IDEMPOTENCIA (POST /orden con cabecera Idempotency-Key)
+IDEMPOTENCIA_TTL_SEGUNDOS = float(os.environ.get('IDEMPOTENCIA_TTL_SEGUNDOS', 24 * 3600))
+IDEMPOTENCIA_CLAVE_MAXIMA = 255
+
+def huella_solicitud(datos):
+    """Hash estable del cuerpo: una clave reutilizada con otro contenido es un error"""
+    crudo = json.dumps(datos, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(crudo.encode('utf-8')).hexdigest()
+
+def reclamar_clave_idempotencia(conn, usuario_email, clave, huella):
+    """Registra la clave como primera escritura de la transacción. True si es nuestra.
+
+    La escritura toma el bloqueo de escritura de SQLite: un duplicado concurrente espera
+    (busy_timeout) hasta que la primera transacción confirma y entonces encuentra la
+    clave ya guardada con su respuesta. Una clave vencida se puede reutilizar.
+    """
+    ahora = time.time()
+    return conn.execute(text('''
+        INSERT INTO claves_idempotencia (usuario_email, clave, huella, creada)
+        VALUES (:usuario_email, :clave, :huella, :ahora)
+        ON CONFLICT(usuario_email, clave) DO UPDATE SET
+            huella = excluded.huella, estado_http = NULL, respuesta = NULL, creada = excluded.creada
+        WHERE claves_idempotencia.creada < :vencimiento
+    '''), {'usuario_email': usuario_email, 'clave': clave, 'huella': huella,
+           'ahora': ahora, 'vencimiento': ahora - IDEMPOTENCIA_TTL_SEGUNDOS}).rowcount == 1
+
+def guardar_respuesta_idempotente(conn, usuario_email, clave, cuerpo, estado_http=200):
+    conn.execute(text('''
+        UPDATE claves_idempotencia SET estado_http = :estado_http, respuesta = :respuesta
+        WHERE usuario_email = :usuario_email AND clave = :clave
+    '''), {'usuario_email': usuario_email, 'clave': clave, 'estado_http': estado_http,
+           'respuesta': json.dumps(cuerpo, ensure_ascii=False)})
+
+def respuesta_idempotente_guardada(conn, usuario_email, clave, huella):
+    """Respuesta Flask para una clave ya usada (repetición, conflicto o aún en curso)"""
+    fila = conn.execute(text('''
+        SELECT huella, estado_http, respuesta FROM claves_idempotencia
+        WHERE usuario_email = :usuario_email AND clave = :clave
+    '''), {'usuario_email': usuario_email, 'clave': clave}).fetchone()
+
+    if not fila or fila[1] is None:
+        return jsonify({'error': 'Hay una solicitud en curso con esta Idempotency-Key'}), 409
+    if fila[0] != huella:
+        return jsonify({'error': 'La Idempotency-Key ya se usó con datos diferentes'}), 422
+
+    response = app.response_class(fila[2], status=fila[1], mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
 
-        print(f"✅ Correo de orden rechazada enviado exitosamente a: {orden_info['usuario_email']}")
+def purgar_claves_idempotencia():
+    conn = get_db_connection()
+    try:
+        inicio = time.perf_counter()
+        filas = conn.execute(text('DELETE FROM claves_idempotencia WHERE creada < :vencimiento'),
+                             {'vencimiento': time.time() - IDEMPOTENCIA_TTL_SEGUNDOS}).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    registrar_ejecucion_tarea('purgar_idempotencia', filas, (time.perf_counter() - inicio) * 1000)
+    return filas
+
+# OUTBOX DE CORREOS
+# Los handlers solo insertan en outbox dentro de su transacción; un hilo despachador
+# reclama lotes, envía por el pool SMTP y reintenta con backoff exponencial. La cuota por
+# minuto se cuenta en la base, así que se respeta entre todos los workers.
+OUTBOX_LOTE = 20
+OUTBOX_CUOTA_POR_MINUTO = int(os.environ.get('OUTBOX_CUOTA_POR_MINUTO', 20))
+OUTBOX_MAX_INTENTOS = int(os.environ.get('OUTBOX_MAX_INTENTOS', 8))
+OUTBOX_BACKOFF_BASE_SEGUNDOS = 30
+OUTBOX_BACKOFF_MAXIMO_SEGUNDOS = 3600
+OUTBOX_VISIBILIDAD_SEGUNDOS = 300
+OUTBOX_ESPERA_SEGUNDOS = float(os.environ.get('OUTBOX_ESPERA_SEGUNDOS', 5))
+OUTBOX_RETENCION_DIAS = 7
+# Los avisos de nueva orden al admin se agrupan en un resumen: con la ventana en calma
+# salen tras RESUMEN_ORDENES_CALMA_SEGUNDOS sin órdenes nuevas (un carrito de varias
+# órdenes llega en un solo correo); si hubo un aviso hace menos de la ventana, esperan a
+# que la más antigua cumpla RESUMEN_ORDENES_VENTANA_SEGUNDOS o a juntar RESUMEN_ORDENES_MAXIMO.
+RESUMEN_ORDENES_VENTANA_SEGUNDOS = float(os.environ.get('RESUMEN_ORDENES_VENTANA_SEGUNDOS', 30))
+RESUMEN_ORDENES_MAXIMO = int(os.environ.get('RESUMEN_ORDENES_MAXIMO', 25))
+RESUMEN_ORDENES_CALMA_SEGUNDOS = float(os.environ.get('RESUMEN_ORDENES_CALMA_SEGUNDOS', 3))
+
+TIPOS_CORREO = ('nueva_orden', 'recarga_completada', 'gift_card_completada', 'orden_rechazada')
+
+_outbox_despertar = threading.Event()
+
+def encolar_correo(conn, tipo, orden_dict):
+    """Agrega un correo al outbox en la transacción de `conn`: sale solo si se confirma"""
+    ahora = time.time()
+    conn.execute(text('''
+        INSERT INTO outbox (tipo, orden_id, destinatario, datos, proximo_intento, creado)
+        VALUES (:tipo, :orden_id, :destinatario, :datos, :ahora, :ahora)
+    '''), {
+        'tipo': tipo,
+        'orden_id': orden_dict.get('id'),
+        'destinatario': EMAIL_TIENDA if tipo == 'nueva_orden' else orden_dict.get('usuario_email'),
+        'datos': json.dumps(orden_dict, ensure_ascii=False, default=str),
+        'ahora': ahora
+    })
+
+def despertar_despachador():
+    """Avisa al despachador de este proceso que hay correos nuevos (tras el commit)"""
+    _outbox_despertar.set()
+
+def backoff_outbox(intentos):
+    """Segundos hasta el siguiente intento: 30 s, 1 min, 2 min... hasta 1 h, con ±20 %"""
+    espera = min(OUTBOX_BACKOFF_BASE_SEGUNDOS * 2 ** (intentos - 1), OUTBOX_BACKOFF_MAXIMO_SEGUNDOS)
+    return espera * random.uniform(0.8, 1.2)
+
+def _resumen_ordenes_listo(conn, filas, ahora):
+    """True si los avisos de nueva orden pendientes (`filas`, con su `creado`) ya deben salir"""
+    creados = [fila[3] for fila in filas]
+    if len(filas) >= RESUMEN_ORDENES_MAXIMO or min(creados) <= ahora - RESUMEN_ORDENES_VENTANA_SEGUNDOS:
         return True
+    ultimo_aviso = conn.execute("SELECT MAX(reclamado) FROM outbox WHERE tipo = 'nueva_orden'").fetchone()[0]
+    en_calma = ultimo_aviso is None or ultimo_aviso <= ahora - RESUMEN_ORDENES_VENTANA_SEGUNDOS
+    return en_calma and max(creados) <= ahora - RESUMEN_ORDENES_CALMA_SEGUNDOS
+
+def reclamar_correos(limite=OUTBOX_LOTE):
+    """Reclama hasta `limite` correos vencidos sin pasar la cuota del último minuto.
+
+    BEGIN IMMEDIATE serializa a los despachadores de todos los workers: cada correo lo
+    reclama uno solo. Los avisos de nueva orden que ya toca enviar se reclaman juntos como
+    un solo correo 'resumen_ordenes' (datos = lista JSON de órdenes). Devuelve
+    [(ids, tipo, datos, intentos)].
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
+    try:
+        configurar_conexion_sqlite(conn)
+        # Sondeo de solo lectura: con la cola vacía no se toma el bloqueo de escritura
+        if not conn.execute("SELECT 1 FROM outbox WHERE estado = 'pendiente' AND proximo_intento <= ? LIMIT 1",
+                            (time.time(),)).fetchone():
+            return []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ahora = time.time()
+            # Un resumen cuenta como un correo: sus filas comparten el mismo `reclamado`
+            usados = conn.execute('''
+                SELECT IFNULL(SUM(tipo != 'nueva_orden'), 0)
+                       + COUNT(DISTINCT CASE WHEN tipo = 'nueva_orden' THEN reclamado END)
+                FROM outbox WHERE reclamado >= ?
+            ''', (ahora - 60,)).fetchone()[0]
+            cupo = min(limite, OUTBOX_CUOTA_POR_MINUTO - usados)
+            envios = []
+            if cupo > 0:
+                avisos = conn.execute('''
+                    SELECT id, datos, intentos + 1, creado FROM outbox
+                    WHERE estado = 'pendiente' AND proximo_intento <= ? AND tipo = 'nueva_orden'
+                    ORDER BY id
+                    LIMIT ?
+                ''', (ahora, RESUMEN_ORDENES_MAXIMO)).fetchall()
+                if avisos and _resumen_ordenes_listo(conn, avisos, ahora):
+                    envios.append(([fila[0] for fila in avisos], 'resumen_ordenes',
+                                   '[' + ','.join(fila[1] for fila in avisos) + ']',
+                                   max(fila[2] for fila in avisos)))
+                    cupo -= 1
+            if cupo > 0:
+                envios += [([fila[0]], fila[1], fila[2], fila[3]) for fila in conn.execute('''
+                    SELECT id, tipo, datos, intentos + 1 FROM outbox
+                    WHERE estado = 'pendiente' AND proximo_intento <= ? AND tipo != 'nueva_orden'
+                    ORDER BY proximo_intento
+                    LIMIT ?
+                ''', (ahora, cupo))]
+            ids = [outbox_id for envio in envios for outbox_id in envio[0]]
+            if ids:
+                marcadores = ','.join('?' * len(ids))
+                conn.execute(f'''
+                    UPDATE outbox SET proximo_intento = ?, reclamado = ?, intentos = intentos + 1
+                    WHERE id IN ({marcadores})
+                ''', [ahora + OUTBOX_VISIBILIDAD_SEGUNDOS, ahora] + ids)
+            conn.execute('COMMIT')
+            return envios
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+
+def enviar_correo_outbox(tipo, datos):
+    """Envía un correo del outbox con su función de envío. True si salió"""
+    funciones = {
+        'nueva_orden': enviar_notificacion_orden,
+        'resumen_ordenes': enviar_resumen_ordenes,
+        'recarga_completada': enviar_correo_recarga_completada,
+        'gift_card_completada': enviar_correo_gift_card_completada,
+        'orden_rechazada': enviar_correo_orden_rechazada,
+    }
+    return funciones[tipo](datos)
 
+def despachar_correo(ids, tipo, datos, intentos):
+    """Envía un correo reclamado (filas `ids` del outbox) y registra el resultado. True si salió"""
+    try:
+        ok = enviar_correo_outbox(tipo, json.loads(datos))
+        error = None if ok else 'El envío falló (detalle en el log del worker)'
     except Exception as e:
-        print(f"❌ Error al enviar correo de orden rechazada: {str(e)}")
-        return False
+        ok, error = False, f'{type(e).__name__}: {e}'
 
-def limpiar_ordenes_antiguas(usuario_email):
-    """Mantiene solo las últimas 40 órdenes por usuario, eliminando las más antiguas"""
     conn = get_db_connection()
     try:
-        # Contar órdenes del usuario
-        result = conn.execute(text('''
-            SELECT COUNT(*) FROM ordenes WHERE usuario_email = :email
-        '''), {'email': usuario_email})
-
-        total_ordenes = result.fetchone()[0]
-
-        # Si tiene más de 40 órdenes, eliminar las más antiguas
-        if total_ordenes > 40:
-            ordenes_a_eliminar = total_ordenes - 40
-
-            # Obtener IDs de las órdenes más antiguas
-            result = conn.execute(text('''
-                SELECT id FROM ordenes 
-                WHERE usuario_email = :email 
-                ORDER BY fecha ASC 
-                LIMIT :limit
-            '''), {'email': usuario_email, 'limit': ordenes_a_eliminar})
-
-            ids_a_eliminar = [row[0] for row in result.fetchall()]
-
-            if ids_a_eliminar:
-                # Eliminar las órdenes más antiguas
-                for orden_id in ids_a_eliminar:
-                    conn.execute(text('DELETE FROM ordenes WHERE id = :id'), {'id': orden_id})
+        if ok:
+            conn.execute(text('''
+                UPDATE outbox SET estado = 'enviado', enviado = :ahora, ultimo_error = NULL WHERE id IN :ids
+            ''').bindparams(bindparam('ids', expanding=True)), {'ids': ids, 'ahora': time.time()})
+        else:
+            agotado = intentos >= OUTBOX_MAX_INTENTOS
+            conn.execute(text('''
+                UPDATE outbox SET estado = :estado, proximo_intento = :proximo, ultimo_error = :error
+                WHERE id IN :ids
+            ''').bindparams(bindparam('ids', expanding=True)),
+                {'ids': ids, 'estado': 'fallido' if agotado else 'pendiente',
+                 'proximo': time.time() + backoff_outbox(intentos), 'error': error})
+            print(f"⚠️ Correo {tipo} #{ids[0]} falló (intento {intentos}/{OUTBOX_MAX_INTENTOS})"
+                  + (": sin más reintentos" if agotado else ""))
+        conn.commit()
+    finally:
+        conn.close()
+    return ok
 
-                conn.commit()
-                print(f"🧹 Limpieza automática: Eliminadas {len(ids_a_eliminar)} órdenes antiguas del usuario {usuario_email}")
+def procesar_outbox():
+    """Una pasada del despachador: envía el lote reclamado en paralelo por el ejecutor de fondo.
 
+    Devuelve (enviados, fallidos). Un correo que el ejecutor descarta sigue reclamado y
+    vuelve a la cola al vencer su visibilidad.
+    """
+    futuros = [ejecutor_fondo().enviar(despachar_correo, *fila) for fila in reclamar_correos()]
+    enviados, fallidos = 0, 0
+    for futuro in futuros:
+        try:
+            ok = futuro.result()
+        except (concurrent.futures.CancelledError, Exception):
+            ok = False
+        if ok:
+            enviados += 1
+        else:
+            fallidos += 1
+    return enviados, fallidos
+
+def bucle_despachador_outbox(detener=None):
+    """Despachador: vacía el outbox y espera a que lleguen más correos, hasta que se active
+    el Event `detener` (el hilo de la web no lo usa; mail_worker.py sí)"""
+    detener = detener or threading.Event()
+    sin_password_avisado = False
+    while not detener.is_set():
+        procesados = 0
+        if not os.environ.get('GMAIL_APP_PASSWORD'):
+            # Sin credenciales los correos esperan en el outbox en lugar de agotar reintentos
+            if not sin_password_avisado:
+                print("⚠️ GMAIL_APP_PASSWORD no configurada: los correos quedan en el outbox")
+                sin_password_avisado = True
+        else:
+            try:
+                procesados = sum(procesar_outbox())
+            except Exception as e:
+                print(f"❌ Error en el despachador de correos: {e}")
+        if not procesados:
+            _outbox_despertar.wait(OUTBOX_ESPERA_SEGUNDOS)
+            _outbox_despertar.clear()
+
+def iniciar_despachador_outbox():
+    """Arranca el despachador en este proceso (desactivable con OUTBOX_DISPATCHER_EN_WEB=0)"""
+    if os.environ.get('OUTBOX_DISPATCHER_EN_WEB', '1') != '1':
+        return
+    threading.Thread(target=bucle_despachador_outbox, name='despachador-outbox', daemon=True).start()
+
+def purgar_outbox():
+    """Borra los correos enviados hace más de OUTBOX_RETENCION_DIAS (los fallidos se conservan)"""
+    conn = get_db_connection()
+    try:
+        inicio = time.perf_counter()
+        filas = conn.execute(text("DELETE FROM outbox WHERE estado = 'enviado' AND enviado < :limite"),
+                             {'limite': time.time() - OUTBOX_RETENCION_DIAS * 86400}).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    registrar_ejecucion_tarea('purgar_outbox', filas, (time.perf_counter() - inicio) * 1000)
+    return filas
+
+# Filas muestreadas por índice en ANALYZE (estadísticas aproximadas en pocos milisegundos)
+DB_ANALYZE_LIMITE_FILAS = int(os.environ.get('DB_ANALYZE_LIMITE_FILAS', '1000'))
+# Las estadísticas se refrescan tras cada migración y, a medida que la base crece, una vez al día
+DB_ANALYZE_INTERVALO_SEGUNDOS = int(os.environ.get('DB_ANALYZE_INTERVALO_SEGUNDOS', 86400))
+
+def actualizar_estadisticas():
+    """Refresca las estadísticas del planificador (sqlite_stat1).
+
+    Con estadísticas tomadas cuando ordenes tenía pocas filas, SQLite prefiere ordenar
+    la tabla completa en memoria en lugar de recorrer el índice (fecha, id) de la
+    paginación. PRAGMA analysis_limit acota el muestreo para que no crezca con la base.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
+    try:
+        configurar_conexion_sqlite(conn)
+        conn.execute(f'PRAGMA analysis_limit = {DB_ANALYZE_LIMITE_FILAS}')
+        conn.execute('ANALYZE')
     except Exception as e:
-        print(f"❌ Error al limpiar órdenes antiguas: {e}")
-        conn.rollback()
+        print(f"⚠️ No se pudieron actualizar las estadísticas de SQLite: {e}")
     finally:
         conn.close()
 
+def ejecutar_actualizar_estadisticas():
+    inicio = time.perf_counter()
+    actualizar_estadisticas()
+    registrar_ejecucion_tarea('actualizar_estadisticas', 0, (time.perf_counter() - inicio) * 1000)
+
+# Tareas periódicas: nombre en tareas_mantenimiento -> (función, intervalo en segundos)
+TAREAS_MANTENIMIENTO = {
+    'retencion_ordenes': (ejecutar_retencion_ordenes, RETENCION_INTERVALO_SEGUNDOS),
+    'purgar_idempotencia': (purgar_claves_idempotencia, 3600),
+    'archivar_ordenes': (ejecutar_archivo_ordenes, ARCHIVO_INTERVALO_SEGUNDOS),
+    'purgar_outbox': (purgar_outbox, 3600),
+    'actualizar_estadisticas': (ejecutar_actualizar_estadisticas, DB_ANALYZE_INTERVALO_SEGUNDOS),
+}
+
+def bucle_mantenimiento():
+    """Hilo de cada worker: ejecuta las tareas cuya próxima ejecución ya venció"""
+    while True:
+        time.sleep(MANTENIMIENTO_REVISION_SEGUNDOS * random.uniform(0.5, 1.0))
+        for nombre, (tarea, intervalo) in TAREAS_MANTENIMIENTO.items():
+            try:
+                if reclamar_tarea(nombre, intervalo):
+                    tarea()
+            except Exception as e:
+                print(f"❌ Error en tarea de mantenimiento {nombre}: {e}")
+
+def iniciar_mantenimiento_en_segundo_plano():
+    """Arranca el hilo de mantenimiento (desactivable con MANTENIMIENTO_EN_WEB=0)"""
+    if os.environ.get('MANTENIMIENTO_EN_WEB', '1') != '1':
+        return
+    threading.Thread(target=bucle_mantenimiento, name='mantenimiento', daemon=True).start()
+
+_hilos_fondo_pid = None
+
+def iniciar_hilos_servidor():
+    """Arranca los hilos de fondo del servidor web: mantenimiento y despachador del outbox.
+
+    No se llama al importar el módulo (los comandos CLI, benchmarks, pruebas y
+    mail_worker.py no deben arrancarlos): la llaman el hook post_fork de gunicorn.conf.py
+    en cada worker y `python main_sqlite.py` / `python main.py`. Una sola vez por proceso.
+    """
+    global _hilos_fondo_pid
+    if _hilos_fondo_pid == os.getpid():
+        return
+    _hilos_fondo_pid = os.getpid()
+    iniciar_mantenimiento_en_segundo_plano()
+    iniciar_despachador_outbox()
+
 def enviar_notificacion_orden(orden_data):
     """Envía notificación por correo de nueva orden"""
+    print(f"🔧 Intentando enviar notificación para orden #{orden_data['id']}")
+    return enviar_correo_plantilla('nueva_orden', orden_data, EMAIL_TIENDA)
+
+def enviar_resumen_ordenes(ordenes):
+    """Envía un solo correo al admin con varias órdenes nuevas (una sola va con el aviso normal)"""
+    if len(ordenes) == 1:
+        return enviar_notificacion_orden(ordenes[0])
+    print(f"🔧 Enviando resumen de {len(ordenes)} órdenes (#{ordenes[0]['id']} a #{ordenes[-1]['id']})")
+    return enviar_correo_plantilla('resumen_ordenes', ordenes, EMAIL_TIENDA)
+
+# Resumen de valoraciones calculado desde cero (reconstrucción y verificación)
+COLUMNAS_RESUMEN_VALORACIONES = 'juego_id, suma, total, estrellas_1, estrellas_2, estrellas_3, estrellas_4, estrellas_5'
+SQL_RESUMEN_VALORACIONES_CALCULADO = '''
+    SELECT juego_id, SUM(calificacion), COUNT(*),
+           SUM(calificacion = 1), SUM(calificacion = 2), SUM(calificacion = 3),
+           SUM(calificacion = 4), SUM(calificacion = 5)
+    FROM valoraciones
+    WHERE juego_id IS NOT NULL
+    GROUP BY juego_id
+'''
+
+# Resumen de ventas por (día, juego, estado, método de pago). El monto se acumula en
+# centavos enteros para que las sumas y restas incrementales no acumulen error de redondeo.
+# Sin trigger de borrado: borrar de ordenes es archivar, y las ventas deben seguir contando.
+SQL_CLAVE_VENTAS = (
+    "IFNULL(date({fila}.fecha), ''), IFNULL({fila}.juego_id, 0), "
+    "IFNULL({fila}.estado, ''), IFNULL({fila}.metodo_pago, '')"
+)
+SQL_FILTRO_VENTAS = (
+    "dia = IFNULL(date({fila}.fecha), '') AND juego_id = IFNULL({fila}.juego_id, 0) "
+    "AND estado = IFNULL({fila}.estado, '') AND metodo_pago = IFNULL({fila}.metodo_pago, '')"
+)
+SQL_CENTAVOS_VENTA = 'CAST(ROUND(IFNULL({fila}.monto, 0) * 100) AS INTEGER)'
+COLUMNAS_RESUMEN_VENTAS = 'dia, juego_id, estado, metodo_pago, ordenes, monto_centavos'
+SQL_RESUMEN_VENTAS_CALCULADO = f'''
+    SELECT {SQL_CLAVE_VENTAS.format(fila='o')}, COUNT(*), SUM({SQL_CENTAVOS_VENTA.format(fila='o')})
+    FROM {{tabla}} o
+    GROUP BY 1, 2, 3, 4
+'''
+
+def calcular_resumen_ventas(conn, destino):
+    """Llena la tabla `destino` (mismas columnas que ventas_resumen) con las ventas de las
+    órdenes vivas y de los archivos mensuales. `conn` es una conexión sqlite3."""
+    conn.execute(f'INSERT INTO {destino} ({COLUMNAS_RESUMEN_VENTAS}) '
+                 + SQL_RESUMEN_VENTAS_CALCULADO.format(tabla='main.ordenes'))
+    # Los archivos se leen con su propia conexión: ATTACH no se permite dentro de la
+    # transacción de la migración
+    for _, ruta in meses_archivados():
+        archivo = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(_ruta_consultable(ruta)))}?mode=ro', uri=True)
+        try:
+            filas = archivo.execute(SQL_RESUMEN_VENTAS_CALCULADO.format(tabla='ordenes')).fetchall()
+        finally:
+            archivo.close()
+        conn.executemany(f'''
+            INSERT INTO {destino} ({COLUMNAS_RESUMEN_VENTAS}) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (dia, juego_id, estado, metodo_pago) DO UPDATE SET
+                ordenes = ordenes + excluded.ordenes,
+                monto_centavos = monto_centavos + excluded.monto_centavos
+        ''', filas)
+
+def poblar_resumen_ventas(conn):
+    conn.execute('DELETE FROM ventas_resumen')
+    calcular_resumen_ventas(conn, 'ventas_resumen')
+
+SQL_SUMAR_COMPRA_JUEGO = '''
+    INSERT INTO compras_juegos (usuario_email, juego_id, compras) VALUES ({email}, {juego_id}, 1)
+    ON CONFLICT (usuario_email, juego_id) DO UPDATE SET compras = compras + 1
+'''
+
+def poblar_compras_juegos(conn):
+    """Compras procesadas por usuario y juego, de las órdenes vivas y de los archivos mensuales.
+
+    Dentro de la transacción de la migración no se puede hacer ATTACH: cada archivo se lee
+    con su propia conexión. Una orden que está a la vez viva y archivada (corte a mitad
+    de un archivado) se cuenta solo una vez.
+    """
+    conn.execute('DELETE FROM compras_juegos')
+    conn.execute('''
+        INSERT INTO compras_juegos (usuario_email, juego_id, compras)
+        SELECT usuario_email, juego_id, COUNT(*) FROM ordenes
+        WHERE estado = 'procesado' AND usuario_email IS NOT NULL AND juego_id IS NOT NULL
+        GROUP BY usuario_email, juego_id
+    ''')
+    for _, ruta in meses_archivados():
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(_ruta_consultable(ruta))) + '?mode=ro'
+        archivo = sqlite3.connect(uri, uri=True, timeout=30)
+        try:
+            compras = archivo.execute('''
+                SELECT usuario_email, juego_id, id FROM ordenes
+                WHERE estado = 'procesado' AND usuario_email IS NOT NULL AND juego_id IS NOT NULL
+            ''').fetchall()
+        finally:
+            archivo.close()
+        conn.executemany('''
+            INSERT INTO compras_juegos (usuario_email, juego_id, compras)
+            SELECT ?, ?, 1 WHERE NOT EXISTS (SELECT 1 FROM ordenes WHERE id = ?)
+            ON CONFLICT (usuario_email, juego_id) DO UPDATE SET compras = compras + 1
+        ''', compras)
+
+# Clave de ordenes_conteo para una fila de ordenes (NEW, OLD o un alias)
+SQL_CLAVE_CONTEO_ORDEN = (
+    "IFNULL(date({fila}.fecha), ''), IFNULL({fila}.estado, ''), "
+    "IFNULL({fila}.juego_id, 0), IFNULL({fila}.metodo_pago, '')"
+)
+SQL_FILTRO_CONTEO_ORDEN = (
+    "dia = IFNULL(date({fila}.fecha), '') AND estado = IFNULL({fila}.estado, '') "
+    "AND juego_id = IFNULL({fila}.juego_id, 0) AND metodo_pago = IFNULL({fila}.metodo_pago, '')"
+)
+
+# Eventos conservados en ordenes_cambios (ventana de reconexión del feed SSE)
+ORDENES_CAMBIOS_RETENIDOS = 10000
+
+# MIGRACIONES DE ESQUEMA
+# Cada migración se aplica una sola vez y en orden. La versión actual se guarda en
+# PRAGMA user_version (lectura instantánea en el arranque) y el historial en schema_migraciones.
+# Nunca modificar una migración ya publicada: agregar una nueva al final de la lista.
+MIGRACIONES = [
+    (1, 'Tablas base', [
+        '''
+        CREATE TABLE IF NOT EXISTS juegos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT(100),
+            descripcion TEXT,
+            imagen TEXT(255),
+            categoria TEXT(50) DEFAULT 'juegos',
+            orden INTEGER DEFAULT 0,
+            etiquetas TEXT(255)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS paquetes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            juego_id INTEGER REFERENCES juegos(id),
+            nombre TEXT(100),
+            precio REAL,
+            orden INTEGER DEFAULT 0,
+            imagen TEXT(255)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ordenes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            juego_id INTEGER REFERENCES juegos(id),
+            paquete TEXT(100),
+            monto REAL,
+            usuario_email TEXT(100),
+            usuario_id TEXT(100),
+            usuario_telefono TEXT(20),
+            metodo_pago TEXT(50),
+            referencia_pago TEXT(100),
+            estado TEXT(20) DEFAULT 'procesando',
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            codigo_producto TEXT(255)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS valoraciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            juego_id INTEGER REFERENCES juegos(id) ON DELETE CASCADE,
+            usuario_email TEXT(100) NOT NULL,
+            calificacion INTEGER CHECK (calificacion >= 1 AND calificacion <= 5),
+            comentario TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(juego_id, usuario_email)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS imagenes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT(50),
+            ruta TEXT(255)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS configuracion (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campo TEXT(50) UNIQUE,
+            valor TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT(100) NOT NULL,
+            email TEXT(100) UNIQUE NOT NULL,
+            telefono TEXT(20),
+            password_hash TEXT(255) NOT NULL,
+            es_admin BOOLEAN DEFAULT FALSE,
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS schema_migraciones (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            aplicada_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'Índices para consultas frecuentes', [
+        # retención de órdenes por usuario y get_historial_compras
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_usuario_fecha ON ordenes(usuario_email, fecha)',
+        # crear_valoracion y get_valoracion_usuario
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_juego_usuario_estado ON ordenes(juego_id, usuario_email, estado)',
+        # get_ordenes (ORDER BY fecha DESC)
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_fecha ON ordenes(fecha)',
+        # get_productos y get_productos_publico
+        'CREATE INDEX IF NOT EXISTS idx_paquetes_juego_orden ON paquetes(juego_id, orden)',
+        # serve_image
+        'CREATE INDEX IF NOT EXISTS idx_imagenes_ruta ON imagenes(ruta)',
+        # get_valoraciones_producto (ORDER BY fecha DESC)
+        'CREATE INDEX IF NOT EXISTS idx_valoraciones_juego_fecha ON valoraciones(juego_id, fecha)',
+    ]),
+    (3, 'Versiones de datos para cachés en memoria', [
+        '''
+        CREATE TABLE IF NOT EXISTS versiones_datos (
+            clave TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            actualizado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "INSERT OR IGNORE INTO versiones_datos (clave, version) VALUES ('catalogo', 1)",
+    ] + [
+        # Cualquier escritura en el catálogo (desde cualquier worker) incrementa su versión
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{tabla}_{operacion.lower()}_version_catalogo
+        AFTER {operacion} ON {tabla}
+        BEGIN
+            UPDATE versiones_datos SET version = version + 1, actualizado = CURRENT_TIMESTAMP
+            WHERE clave = 'catalogo';
+        END
+        '''
+        for tabla in ('juegos', 'paquetes', 'valoraciones')
+        for operacion in ('INSERT', 'UPDATE', 'DELETE')
+    ]),
+    (4, 'Versiones de configuración y valoraciones para peticiones condicionales', [
+        "INSERT OR IGNORE INTO versiones_datos (clave, version) VALUES ('config', 1), ('valoraciones', 1)",
+    ] + [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{tabla}_{operacion.lower()}_version_{clave}
+        AFTER {operacion} ON {tabla}
+        BEGIN
+            UPDATE versiones_datos SET version = version + 1, actualizado = CURRENT_TIMESTAMP
+            WHERE clave = '{clave}';
+        END
+        '''
+        for tabla, clave in (('configuracion', 'config'), ('valoraciones', 'valoraciones'))
+        for operacion in ('INSERT', 'UPDATE', 'DELETE')
+    ]),
+    (5, 'Resumen incremental de valoraciones por juego', [
+        '''
+        CREATE TABLE IF NOT EXISTS valoraciones_resumen (
+            juego_id INTEGER PRIMARY KEY,
+            suma INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            estrellas_1 INTEGER NOT NULL DEFAULT 0,
+            estrellas_2 INTEGER NOT NULL DEFAULT 0,
+            estrellas_3 INTEGER NOT NULL DEFAULT 0,
+            estrellas_4 INTEGER NOT NULL DEFAULT 0,
+            estrellas_5 INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # Sin cláusulas OR IGNORE/REPLACE: dentro de un trigger heredarían la política
+        # de conflicto de la sentencia externa (p. ej. INSERT OR REPLACE INTO valoraciones)
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_valoraciones_insert_resumen
+        AFTER INSERT ON valoraciones WHEN NEW.juego_id IS NOT NULL
+        BEGIN
+            INSERT INTO valoraciones_resumen (juego_id)
+            SELECT NEW.juego_id WHERE NOT EXISTS (SELECT 1 FROM valoraciones_resumen WHERE juego_id = NEW.juego_id);
+            UPDATE valoraciones_resumen SET
+                suma = suma + NEW.calificacion, total = total + 1,
+                estrellas_1 = estrellas_1 + (NEW.calificacion = 1), estrellas_2 = estrellas_2 + (NEW.calificacion = 2),
+                estrellas_3 = estrellas_3 + (NEW.calificacion = 3), estrellas_4 = estrellas_4 + (NEW.calificacion = 4),
+                estrellas_5 = estrellas_5 + (NEW.calificacion = 5)
+            WHERE juego_id = NEW.juego_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_valoraciones_delete_resumen
+        AFTER DELETE ON valoraciones WHEN OLD.juego_id IS NOT NULL
+        BEGIN
+            UPDATE valoraciones_resumen SET
+                suma = suma - OLD.calificacion, total = total - 1,
+                estrellas_1 = estrellas_1 - (OLD.calificacion = 1), estrellas_2 = estrellas_2 - (OLD.calificacion = 2),
+                estrellas_3 = estrellas_3 - (OLD.calificacion = 3), estrellas_4 = estrellas_4 - (OLD.calificacion = 4),
+                estrellas_5 = estrellas_5 - (OLD.calificacion = 5)
+            WHERE juego_id = OLD.juego_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_valoraciones_update_resumen
+        AFTER UPDATE OF juego_id, calificacion ON valoraciones
+        BEGIN
+            UPDATE valoraciones_resumen SET
+                suma = suma - OLD.calificacion, total = total - 1,
+                estrellas_1 = estrellas_1 - (OLD.calificacion = 1), estrellas_2 = estrellas_2 - (OLD.calificacion = 2),
+                estrellas_3 = estrellas_3 - (OLD.calificacion = 3), estrellas_4 = estrellas_4 - (OLD.calificacion = 4),
+                estrellas_5 = estrellas_5 - (OLD.calificacion = 5)
+            WHERE juego_id = OLD.juego_id;
+            INSERT INTO valoraciones_resumen (juego_id)
+            SELECT NEW.juego_id WHERE NEW.juego_id IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM valoraciones_resumen WHERE juego_id = NEW.juego_id);
+            UPDATE valoraciones_resumen SET
+                suma = suma + NEW.calificacion, total = total + 1,
+                estrellas_1 = estrellas_1 + (NEW.calificacion = 1), estrellas_2 = estrellas_2 + (NEW.calificacion = 2),
+                estrellas_3 = estrellas_3 + (NEW.calificacion = 3), estrellas_4 = estrellas_4 + (NEW.calificacion = 4),
+                estrellas_5 = estrellas_5 + (NEW.calificacion = 5)
+            WHERE juego_id = NEW.juego_id;
+        END
+        ''',
+        'DELETE FROM valoraciones_resumen',
+        f'INSERT INTO valoraciones_resumen ({COLUMNAS_RESUMEN_VALORACIONES}) {SQL_RESUMEN_VALORACIONES_CALCULADO}',
+    ]),
+    (6, 'Búsqueda de texto completo (FTS5) sobre el catálogo', [
+        # rowid = juegos.id; la columna paquetes concatena los nombres de sus paquetes
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS catalogo_fts USING fts5(
+            nombre, descripcion, etiquetas, paquetes,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_juegos_insert_fts AFTER INSERT ON juegos
+        BEGIN
+            INSERT INTO catalogo_fts (rowid, nombre, descripcion, etiquetas, paquetes)
+            VALUES (NEW.id, NEW.nombre, NEW.descripcion, NEW.etiquetas,
+                    (SELECT group_concat(nombre, ' ') FROM paquetes WHERE juego_id = NEW.id));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_juegos_update_fts AFTER UPDATE ON juegos
+        BEGIN
+            DELETE FROM catalogo_fts WHERE rowid = OLD.id;
+            INSERT INTO catalogo_fts (rowid, nombre, descripcion, etiquetas, paquetes)
+            VALUES (NEW.id, NEW.nombre, NEW.descripcion, NEW.etiquetas,
+                    (SELECT group_concat(nombre, ' ') FROM paquetes WHERE juego_id = NEW.id));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_juegos_delete_fts AFTER DELETE ON juegos
+        BEGIN
+            DELETE FROM catalogo_fts WHERE rowid = OLD.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_paquetes_insert_fts AFTER INSERT ON paquetes
+        BEGIN
+            UPDATE catalogo_fts SET paquetes = (SELECT group_concat(nombre, ' ') FROM paquetes WHERE juego_id = NEW.juego_id)
+            WHERE rowid = NEW.juego_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_paquetes_update_fts AFTER UPDATE OF nombre, juego_id ON paquetes
+        BEGIN
+            UPDATE catalogo_fts SET paquetes = (SELECT group_concat(nombre, ' ') FROM paquetes WHERE juego_id = OLD.juego_id)
+            WHERE rowid = OLD.juego_id;
+            UPDATE catalogo_fts SET paquetes = (SELECT group_concat(nombre, ' ') FROM paquetes WHERE juego_id = NEW.juego_id)
+            WHERE rowid = NEW.juego_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_paquetes_delete_fts AFTER DELETE ON paquetes
+        BEGIN
+            UPDATE catalogo_fts SET paquetes = (SELECT group_concat(nombre, ' ') FROM paquetes WHERE juego_id = OLD.juego_id)
+            WHERE rowid = OLD.juego_id;
+        END
+        ''',
+        'DELETE FROM catalogo_fts',
+        '''
+        INSERT INTO catalogo_fts (rowid, nombre, descripcion, etiquetas, paquetes)
+        SELECT j.id, j.nombre, j.descripcion, j.etiquetas,
+               (SELECT group_concat(p.nombre, ' ') FROM paquetes p WHERE p.juego_id = j.id)
+        FROM juegos j
+        ''',
+    ]),
+    (7, 'Filtros de órdenes del panel: índices y conteos por día', [
+        # get_ordenes: filtros + keyset (fecha, id); el rowid va implícito en cada índice
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_estado_fecha ON ordenes(estado, fecha)',
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_metodo_fecha ON ordenes(metodo_pago, fecha)',
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_juego_fecha ON ordenes(juego_id, fecha)',
+        # Conteos por (día, estado, juego, método): los totales por filtro no recorren ordenes.
+        # Sin NULL en la clave (se guardan como '' o 0) para que la unicidad funcione
+        '''
+        CREATE TABLE IF NOT EXISTS ordenes_conteo (
+            dia TEXT NOT NULL,
+            estado TEXT NOT NULL,
+            juego_id INTEGER NOT NULL,
+            metodo_pago TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, estado, juego_id, metodo_pago)
+        ) WITHOUT ROWID
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_insert_conteo AFTER INSERT ON ordenes
+        BEGIN
+            INSERT INTO ordenes_conteo (dia, estado, juego_id, metodo_pago)
+            SELECT {SQL_CLAVE_CONTEO_ORDEN.format(fila='NEW')}
+            WHERE NOT EXISTS (SELECT 1 FROM ordenes_conteo WHERE {SQL_FILTRO_CONTEO_ORDEN.format(fila='NEW')});
+            UPDATE ordenes_conteo SET total = total + 1 WHERE {SQL_FILTRO_CONTEO_ORDEN.format(fila='NEW')};
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_delete_conteo AFTER DELETE ON ordenes
+        BEGIN
+            UPDATE ordenes_conteo SET total = total - 1 WHERE {SQL_FILTRO_CONTEO_ORDEN.format(fila='OLD')};
+            DELETE FROM ordenes_conteo WHERE total <= 0 AND {SQL_FILTRO_CONTEO_ORDEN.format(fila='OLD')};
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_update_conteo
+        AFTER UPDATE OF fecha, estado, juego_id, metodo_pago ON ordenes
+        BEGIN
+            UPDATE ordenes_conteo SET total = total - 1 WHERE {SQL_FILTRO_CONTEO_ORDEN.format(fila='OLD')};
+            DELETE FROM ordenes_conteo WHERE total <= 0 AND {SQL_FILTRO_CONTEO_ORDEN.format(fila='OLD')};
+            INSERT INTO ordenes_conteo (dia, estado, juego_id, metodo_pago)
+            SELECT {SQL_CLAVE_CONTEO_ORDEN.format(fila='NEW')}
+            WHERE NOT EXISTS (SELECT 1 FROM ordenes_conteo WHERE {SQL_FILTRO_CONTEO_ORDEN.format(fila='NEW')});
+            UPDATE ordenes_conteo SET total = total + 1 WHERE {SQL_FILTRO_CONTEO_ORDEN.format(fila='NEW')};
+        END
+        ''',
+        'DELETE FROM ordenes_conteo',
+        f'''
+        INSERT INTO ordenes_conteo (dia, estado, juego_id, metodo_pago, total)
+        SELECT {SQL_CLAVE_CONTEO_ORDEN.format(fila='o')}, COUNT(*)
+        FROM ordenes o
+        GROUP BY 1, 2, 3, 4
+        ''',
+    ]),
+    (8, 'Registro de cambios de órdenes para el feed SSE del panel', [
+        # id creciente = Last-Event-ID; compartido por todos los workers a través de la base
+        '''
+        CREATE TABLE IF NOT EXISTS ordenes_cambios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            orden_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,
+            estado TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_insert_cambio AFTER INSERT ON ordenes
+        BEGIN
+            INSERT INTO ordenes_cambios (orden_id, tipo, estado) VALUES (NEW.id, 'creada', NEW.estado);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_update_cambio AFTER UPDATE OF estado, codigo_producto ON ordenes
+        WHEN OLD.estado IS NOT NEW.estado OR OLD.codigo_producto IS NOT NEW.codigo_producto
+        BEGIN
+            INSERT INTO ordenes_cambios (orden_id, tipo, estado) VALUES (NEW.id, 'actualizada', NEW.estado);
+        END
+        ''',
+        # Conservar solo los últimos eventos; un cliente más atrasado recibe 'reinicio'
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_cambios_podar AFTER INSERT ON ordenes_cambios
+        BEGIN
+            DELETE FROM ordenes_cambios WHERE id <= NEW.id - {ORDENES_CAMBIOS_RETENIDOS};
+        END
+        ''',
+    ]),
+    (9, 'Tareas de mantenimiento en segundo plano', [
+        # proxima_ejecucion en segundos epoch: el UPDATE condicional reparte cada ejecución
+        # a un solo worker
+        '''
+        CREATE TABLE IF NOT EXISTS tareas_mantenimiento (
+            nombre TEXT PRIMARY KEY,
+            proxima_ejecucion REAL NOT NULL DEFAULT 0,
+            ultima_ejecucion TIMESTAMP,
+            ultima_duracion_ms REAL,
+            ultimas_filas INTEGER,
+            filas_totales INTEGER NOT NULL DEFAULT 0,
+            ejecuciones INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        "INSERT OR IGNORE INTO tareas_mantenimiento (nombre) VALUES ('retencion_ordenes')",
+    ]),
+    (10, 'Claves de idempotencia para POST /orden', [
+        # La clave primaria es el índice único: una clave por usuario
+        '''
+        CREATE TABLE IF NOT EXISTS claves_idempotencia (
+            usuario_email TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            huella TEXT NOT NULL,
+            estado_http INTEGER,
+            respuesta TEXT,
+            creada REAL NOT NULL,
+            PRIMARY KEY (usuario_email, clave)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_claves_idempotencia_creada ON claves_idempotencia(creada)',
+        "INSERT OR IGNORE INTO tareas_mantenimiento (nombre) VALUES ('purgar_idempotencia')",
+    ]),
+    (11, 'Tarea de archivo mensual de órdenes', [
+        "INSERT OR IGNORE INTO tareas_mantenimiento (nombre) VALUES ('archivar_ordenes')",
+    ]),
+    (12, 'Resumen de ventas por día, juego, estado y método de pago', [
+        '''
+        CREATE TABLE IF NOT EXISTS ventas_resumen (
+            dia TEXT NOT NULL,
+            juego_id INTEGER NOT NULL,
+            estado TEXT NOT NULL,
+            metodo_pago TEXT NOT NULL,
+            ordenes INTEGER NOT NULL DEFAULT 0,
+            monto_centavos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, juego_id, estado, metodo_pago)
+        ) WITHOUT ROWID
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_insert_ventas AFTER INSERT ON ordenes
+        BEGIN
+            INSERT INTO ventas_resumen (dia, juego_id, estado, metodo_pago)
+            SELECT {SQL_CLAVE_VENTAS.format(fila='NEW')}
+            WHERE NOT EXISTS (SELECT 1 FROM ventas_resumen WHERE {SQL_FILTRO_VENTAS.format(fila='NEW')});
+            UPDATE ventas_resumen
+            SET ordenes = ordenes + 1, monto_centavos = monto_centavos + {SQL_CENTAVOS_VENTA.format(fila='NEW')}
+            WHERE {SQL_FILTRO_VENTAS.format(fila='NEW')};
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_update_ventas
+        AFTER UPDATE OF fecha, juego_id, estado, metodo_pago, monto ON ordenes
+        WHEN OLD.fecha IS NOT NEW.fecha OR OLD.juego_id IS NOT NEW.juego_id OR OLD.estado IS NOT NEW.estado
+             OR OLD.metodo_pago IS NOT NEW.metodo_pago OR OLD.monto IS NOT NEW.monto
+        BEGIN
+            UPDATE ventas_resumen
+            SET ordenes = ordenes - 1, monto_centavos = monto_centavos - {SQL_CENTAVOS_VENTA.format(fila='OLD')}
+            WHERE {SQL_FILTRO_VENTAS.format(fila='OLD')};
+            DELETE FROM ventas_resumen WHERE ordenes <= 0 AND {SQL_FILTRO_VENTAS.format(fila='OLD')};
+            INSERT INTO ventas_resumen (dia, juego_id, estado, metodo_pago)
+            SELECT {SQL_CLAVE_VENTAS.format(fila='NEW')}
+            WHERE NOT EXISTS (SELECT 1 FROM ventas_resumen WHERE {SQL_FILTRO_VENTAS.format(fila='NEW')});
+            UPDATE ventas_resumen
+            SET ordenes = ordenes + 1, monto_centavos = monto_centavos + {SQL_CENTAVOS_VENTA.format(fila='NEW')}
+            WHERE {SQL_FILTRO_VENTAS.format(fila='NEW')};
+        END
+        ''',
+        poblar_resumen_ventas,
+    ]),
+    (13, 'Índice por referencia de pago para la conciliación de extractos', [
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_referencia_pago ON ordenes(referencia_pago)',
+    ]),
+    (14, 'Outbox de correos con reintentos', [
+        # proximo_intento y reclamado en segundos epoch. Reclamar un correo lo oculta
+        # OUTBOX_VISIBILIDAD_SEGUNDOS: si el worker muere a mitad del envío, vuelve a la cola
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            orden_id INTEGER,
+            destinatario TEXT,
+            datos TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            proximo_intento REAL NOT NULL,
+            reclamado REAL,
+            ultimo_error TEXT,
+            creado REAL NOT NULL,
+            enviado REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_estado_proximo ON outbox(estado, proximo_intento)',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_reclamado ON outbox(reclamado)',
+        "INSERT OR IGNORE INTO tareas_mantenimiento (nombre) VALUES ('purgar_outbox')",
+    ]),
+    (15, 'Tarea de mantenimiento para refrescar las estadísticas del planificador', [
+        "INSERT OR IGNORE INTO tareas_mantenimiento (nombre) VALUES ('actualizar_estadisticas')",
+    ]),
+    (16, 'Compras por usuario y juego (sobreviven al archivado de órdenes)', [
+        # Quién puede valorar un juego: el archivado borra de ordenes pero no toca esta
+        # tabla, así que no hace falta buscar en los archivos mensuales
+        '''
+        CREATE TABLE IF NOT EXISTS compras_juegos (
+            usuario_email TEXT NOT NULL,
+            juego_id INTEGER NOT NULL,
+            compras INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_email, juego_id)
+        ) WITHOUT ROWID
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_insert_compra AFTER INSERT ON ordenes
+        WHEN NEW.estado = 'procesado' AND NEW.usuario_email IS NOT NULL AND NEW.juego_id IS NOT NULL
+        BEGIN
+            {SQL_SUMAR_COMPRA_JUEGO.format(email='NEW.usuario_email', juego_id='NEW.juego_id')};
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_update_compra_quitar
+        AFTER UPDATE OF estado, usuario_email, juego_id ON ordenes
+        WHEN OLD.estado = 'procesado'
+        BEGIN
+            UPDATE compras_juegos SET compras = compras - 1
+            WHERE usuario_email = OLD.usuario_email AND juego_id = OLD.juego_id;
+            DELETE FROM compras_juegos
+            WHERE compras <= 0 AND usuario_email = OLD.usuario_email AND juego_id = OLD.juego_id;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ordenes_update_compra_sumar
+        AFTER UPDATE OF estado, usuario_email, juego_id ON ordenes
+        WHEN NEW.estado = 'procesado' AND NEW.usuario_email IS NOT NULL AND NEW.juego_id IS NOT NULL
+        BEGIN
+            {SQL_SUMAR_COMPRA_JUEGO.format(email='NEW.usuario_email', juego_id='NEW.juego_id')};
+        END
+        ''',
+        poblar_compras_juegos,
+    ]),
+]
+
+ESQUEMA_VERSION = MIGRACIONES[-1][0]
+
+def aplicar_migraciones():
+    """Aplica las migraciones pendientes. Devuelve True si se aplicó alguna.
+
+    Camino rápido: si PRAGMA user_version ya está al día no se ejecuta ningún DDL.
+    Con varios workers arrancando a la vez, BEGIN IMMEDIATE serializa la migración
+    y la versión se vuelve a leer dentro del bloqueo.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
     try:
-        # Configuración del correo
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        email_usuario = "1yorbi1@gmail.com"
-        email_password = os.environ.get('GMAIL_APP_PASSWORD')
-
-        print(f"🔧 Intentando enviar notificación para orden #{orden_data['id']}")
-        print(f"📧 Email configurado: {email_usuario}")
-
-        if not email_password:
-            print("❌ ERROR: No se encontró la contraseña de Gmail en los secretos")
-            print("💡 Solución: Agrega la variable de entorno 'GMAIL_APP_PASSWORD'")
-            print("💡 Usa una contraseña de aplicación de Gmail, no tu contraseña normal")
+        configurar_conexion_sqlite(conn)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= ESQUEMA_VERSION:
             return False
 
-        print("🔑 Contraseña de aplicación encontrada")
-
-        # Crear mensaje
-        mensaje = MIMEMultipart()
-        mensaje['From'] = email_usuario
-        mensaje['To'] = email_usuario  # Enviamos a nosotros mismos
-        mensaje['Subject'] = f"🛒 Nueva Orden #{orden_data['id']} - Inefable Store"
-
-        # Cuerpo del mensaje
-        cuerpo = f"""
-        ¡Nueva orden recibida en Inefable Store!
-
-        📋 Detalles de la Orden:
-        • ID: #{orden_data['id']}
-        • Juego: {orden_data.get('juego_nombre', 'N/A')}
-        • Paquete: {orden_data['paquete']}
-        • Monto: ${orden_data['monto']}
-        • Cliente: {orden_data['usuario_email']}
-        • Teléfono: {orden_data.get('usuario_telefono', 'No especificado')}
-        • ID del Usuario en el Juego: {orden_data.get('usuario_id', 'No especificado')}
-        • Método de Pago: {orden_data['metodo_pago']}
-        • Referencia: {orden_data['referencia_pago']}
-        • Estado: {orden_data['estado']}
-        • Fecha: {orden_data['fecha']}
-
-        🎮 Accede al panel de administración para gestionar esta orden.
-
-        ¡Saludos del equipo de Inefable Store! 🚀
-        """
-
-        mensaje.attach(MIMEText(cuerpo, 'plain'))
-
-        print("📨 Conectando al servidor SMTP...")
-        # Enviar correo
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        print("🔐 Iniciando sesión...")
-        server.login(email_usuario, email_password)
-        print("📤 Enviando correo...")
-        texto = mensaje.as_string()
-        server.sendmail(email_usuario, email_usuario, texto)
-        server.quit()
-
-        print(f"✅ Notificación enviada exitosamente para orden #{orden_data['id']}")
-        print(f"📬 Revisa tu bandeja de entrada en: {email_usuario}")
-        return True
-
-    except smtplib.SMTPAuthenticationError as e:
-        print(f"❌ ERROR DE AUTENTICACIÓN: {str(e)}")
-        print("💡 Verifica que tengas una contraseña de aplicación válida")
-        print("💡 Asegúrate de tener habilitada la verificación en 2 pasos")
-        return False
-    except smtplib.SMTPException as e:
-        print(f"❌ ERROR SMTP: {str(e)}")
-        return False
-    except Exception as e:
-        print(f"❌ Error general al enviar notificación: {str(e)}")
-        print(f"🔍 Tipo de error: {type(e).__name__}")
-        return False
-
-def init_db():
-    """Inicializa las tablas de la base de datos SQLite"""
-    conn = get_db_connection()
-
-    try:
-        # Crear tablas usando SQLAlchemy con sintaxis SQLite
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS juegos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT(100),
-                descripcion TEXT,
-                imagen TEXT(255),
-                categoria TEXT(50) DEFAULT 'juegos',
-                orden INTEGER DEFAULT 0,
-                etiquetas TEXT(255)
-            );
-        '''))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            pendientes = [m for m in MIGRACIONES if m[0] > version]
+
+            for numero, descripcion, pasos in pendientes:
+                print(f"🛠️ Aplicando migración {numero}: {descripcion}")
+                for paso in pasos:
+                    if callable(paso):
+                        paso(conn)
+                    else:
+                        conn.execute(paso)
+                conn.execute('INSERT OR REPLACE INTO schema_migraciones (version, descripcion) VALUES (?, ?)',
+                             (numero, descripcion))
+                conn.execute(f'PRAGMA user_version = {numero}')
+
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if pendientes:
+            print(f"✅ Esquema actualizado a la versión {ESQUEMA_VERSION}")
+        return bool(pendientes)
+    finally:
+        conn.close()
 
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS paquetes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                juego_id INTEGER REFERENCES juegos(id),
-                nombre TEXT(100),
-                precio REAL,
-                orden INTEGER DEFAULT 0,
-                imagen TEXT(255)
-            );
-        '''))
+@app.cli.command('migrar')
+def migrar_command():
+    """Aplica las migraciones de esquema pendientes"""
+    aplicado = aplicar_migraciones()
+    print(f"Esquema en versión {ESQUEMA_VERSION}" + (" (migrado)" if aplicado else " (ya estaba al día)"))
+
+def sembrar_datos_iniciales(conn):
+    """Inserta productos y configuración de ejemplo en una base de datos vacía"""
+    # Verificar si ya hay productos
+    result = conn.execute(text('SELECT COUNT(*) FROM juegos'))
+    product_count = result.fetchone()[0]
+
+    # Insertar productos de ejemplo si no existen
+    if product_count == 0:
+        # Free Fire
+        result = conn.execute(text('''
+            INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
+            VALUES (:nombre, :descripcion, :imagen, :categoria) 
+        '''), {
+            'nombre': 'Free Fire', 
+            'descripcion': 'Juego de batalla real con acción intensa y gráficos increíbles', 
+            'imagen': '/static/images/20250701_212818_free_fire.webp', 
+            'categoria': 'juegos'
+        })
+        
+        ff_id = result.lastrowid
+
+        # Paquetes de Free Fire
+        ff_packages = [
+            ('100 Diamantes', 2.99, 1),
+            ('310 Diamantes', 9.99, 2),
+            ('520 Diamantes', 14.99, 3),
+            ('1080 Diamantes', 29.99, 4),
+            ('2200 Diamantes', 59.99, 5)
+        ]
+
+        for nombre, precio, orden in ff_packages:
+            conn.execute(text('''
+                INSERT INTO paquetes (juego_id, nombre, precio, orden) 
+                VALUES (:juego_id, :nombre, :precio, :orden)
+            '''), {
+                'juego_id': ff_id, 
+                'nombre': nombre, 
+                'precio': precio, 
+                'orden': orden
+            })
 
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS ordenes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                juego_id INTEGER REFERENCES juegos(id),
-                paquete TEXT(100),
-                monto REAL,
-                usuario_email TEXT(100),
-                usuario_id TEXT(100),
-                usuario_telefono TEXT(20),
-                metodo_pago TEXT(50),
-                referencia_pago TEXT(100),
-                estado TEXT(20) DEFAULT 'procesando',
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                codigo_producto TEXT(255)
-            );
-        '''))
+        # PUBG Mobile
+        result = conn.execute(text('''
+            INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
+            VALUES (:nombre, :descripcion, :imagen, :categoria)
+        '''), {
+            'nombre': 'PUBG Mobile', 
+            'descripcion': 'Battle royale de última generación con mecánicas realistas', 
+            'imagen': '/static/images/default-product.jpg', 
+            'categoria': 'juegos'
+        })
 
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS valoraciones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                juego_id INTEGER REFERENCES juegos(id) ON DELETE CASCADE,
-                usuario_email TEXT(100) NOT NULL,
-                calificacion INTEGER CHECK (calificacion >= 1 AND calificacion <= 5),
-                comentario TEXT,
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(juego_id, usuario_email)
-            );
-        '''))
+        pubg_id = result.lastrowid
 
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS imagenes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tipo TEXT(50),
-                ruta TEXT(255)
-            );
-        '''))
+        # Paquetes de PUBG
+        pubg_packages = [
+            ('60 UC', 0.99, 1),
+            ('325 UC', 4.99, 2),
+            ('660 UC', 9.99, 3),
+            ('1800 UC', 24.99, 4),
+            ('3850 UC', 49.99, 5)
+        ]
 
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS configuracion (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                campo TEXT(50) UNIQUE,
-                valor TEXT
-            );
-        '''))
+        for nombre, precio, orden in pubg_packages:
+            conn.execute(text('''
+                INSERT INTO paquetes (juego_id, nombre, precio, orden) 
+                VALUES (:juego_id, :nombre, :precio, :orden)
+            '''), {
+                'juego_id': pubg_id, 
+                'nombre': nombre, 
+                'precio': precio, 
+                'orden': orden
+            })
 
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT(100) NOT NULL,
-                email TEXT(100) UNIQUE NOT NULL,
-                telefono TEXT(20),
-                password_hash TEXT(255) NOT NULL,
-                es_admin BOOLEAN DEFAULT FALSE,
-                fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        '''))
+        # Call of Duty Mobile
+        result = conn.execute(text('''
+            INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
+            VALUES (:nombre, :descripcion, :imagen, :categoria)
+        '''), {
+            'nombre': 'Call of Duty Mobile', 
+            'descripcion': 'FPS de acción con multijugador competitivo y battle royale', 
+            'imagen': '/static/images/default-product.jpg', 
+            'categoria': 'juegos'
+        })
 
-        # Verificar si ya hay productos
-        result = conn.execute(text('SELECT COUNT(*) FROM juegos'))
-        product_count = result.fetchone()[0]
+        cod_id = result.lastrowid
 
-        # Insertar productos de ejemplo si no existen
-        if product_count == 0:
-            # Free Fire
-            result = conn.execute(text('''
-                INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
-                VALUES (:nombre, :descripcion, :imagen, :categoria) 
-            '''), {
-                'nombre': 'Free Fire', 
-                'descripcion': 'Juego de batalla real con acción intensa y gráficos increíbles', 
-                'imagen': '/static/images/20250701_212818_free_fire.webp', 
-                'categoria': 'juegos'
-            })
-            
-            ff_id = result.lastrowid
-
-            # Paquetes de Free Fire
-            ff_packages = [
-                ('100 Diamantes', 2.99, 1),
-                ('310 Diamantes', 9.99, 2),
-                ('520 Diamantes', 14.99, 3),
-                ('1080 Diamantes', 29.99, 4),
-                ('2200 Diamantes', 59.99, 5)
-            ]
-
-            for nombre, precio, orden in ff_packages:
-                conn.execute(text('''
-                    INSERT INTO paquetes (juego_id, nombre, precio, orden) 
-                    VALUES (:juego_id, :nombre, :precio, :orden)
-                '''), {
-                    'juego_id': ff_id, 
-                    'nombre': nombre, 
-                    'precio': precio, 
-                    'orden': orden
-                })
+        # Paquetes de COD
+        cod_packages = [
+            ('80 CP', 0.99, 1),
+            ('400 CP', 4.99, 2),
+            ('800 CP', 9.99, 3),
+            ('2000 CP', 19.99, 4),
+            ('5000 CP', 49.99, 5)
+        ]
 
-            # PUBG Mobile
-            result = conn.execute(text('''
-                INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
-                VALUES (:nombre, :descripcion, :imagen, :categoria)
+        for nombre, precio, orden in cod_packages:
+            conn.execute(text('''
+                INSERT INTO paquetes (juego_id, nombre, precio, orden) 
+                VALUES (:juego_id, :nombre, :precio, :orden)
             '''), {
-                'nombre': 'PUBG Mobile', 
-                'descripcion': 'Battle royale de última generación con mecánicas realistas', 
-                'imagen': '/static/images/default-product.jpg', 
-                'categoria': 'juegos'
+                'juego_id': cod_id, 
+                'nombre': nombre, 
+                'precio': precio, 
+                'orden': orden
             })
 
-            pubg_id = result.lastrowid
+    # Insertar configuración básica si no existe
+    result = conn.execute(text('SELECT COUNT(*) FROM configuracion'))
+    config_count = result.fetchone()[0]
+
+    if config_count == 0:
+        configs = [
+            ('tasa_usd_ves', '36.50'),
+            ('pago_movil', 'Banco: Banesco\nTelefono: 0412-1234567\nCédula: V-12345678\nNombre: Store Admin'),
+            ('binance', 'Email: admin@inefablestore.com\nID Binance: 123456789'),
+            ('carousel1', 'https://via.placeholder.com/800x300/007bff/ffffff?text=🎮+Ofertas+Especiales+Free+Fire'),
+            ('carousel2', 'https://via.placeholder.com/800x300/28a745/ffffff?text=🔥+Mejores+Precios+PUBG'),
+            ('carousel3', 'https://via.placeholder.com/800x300/dc3545/ffffff?text=⚡+Entrega+Inmediata+COD')
+        ]
+
+        for campo, valor in configs:
+            conn.execute(text('''
+                INSERT INTO configuracion (campo, valor) 
+                VALUES (:campo, :valor)
+            '''), {'campo': campo, 'valor': valor})
 
-            # Paquetes de PUBG
-            pubg_packages = [
-                ('60 UC', 0.99, 1),
-                ('325 UC', 4.99, 2),
-                ('660 UC', 9.99, 3),
-                ('1800 UC', 24.99, 4),
-                ('3850 UC', 49.99, 5)
-            ]
+def reconstruir_resumen_valoraciones(solo_verificar=False):
+    """Recalcula valoraciones_resumen desde valoraciones.
 
-            for nombre, precio, orden in pubg_packages:
-                conn.execute(text('''
-                    INSERT INTO paquetes (juego_id, nombre, precio, orden) 
-                    VALUES (:juego_id, :nombre, :precio, :orden)
-                '''), {
-                    'juego_id': pubg_id, 
-                    'nombre': nombre, 
-                    'precio': precio, 
-                    'orden': orden
-                })
+    Devuelve la lista de juego_id cuyo resumen guardado no coincidía con el calculado.
+    Con solo_verificar=True no modifica nada.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
+    try:
+        configurar_conexion_sqlite(conn)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            columnas = COLUMNAS_RESUMEN_VALORACIONES
+            guardado = f'SELECT {columnas} FROM valoraciones_resumen WHERE total > 0'
+            diferencias = conn.execute(f'''
+                SELECT juego_id FROM ({SQL_RESUMEN_VALORACIONES_CALCULADO} EXCEPT {guardado})
+                UNION
+                SELECT juego_id FROM ({guardado} EXCEPT {SQL_RESUMEN_VALORACIONES_CALCULADO})
+            ''').fetchall()
+            diferencias = [fila[0] for fila in diferencias]
+
+            if diferencias and not solo_verificar:
+                conn.execute('DELETE FROM valoraciones_resumen')
+                conn.execute(f'INSERT INTO valoraciones_resumen ({columnas}) {SQL_RESUMEN_VALORACIONES_CALCULADO}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return diferencias
+    finally:
+        conn.close()
 
-            # Call of Duty Mobile
-            result = conn.execute(text('''
-                INSERT INTO juegos (nombre, descripcion, imagen, categoria) 
-                VALUES (:nombre, :descripcion, :imagen, :categoria)
-            '''), {
-                'nombre': 'Call of Duty Mobile', 
-                'descripcion': 'FPS de acción con multijugador competitivo y battle royale', 
-                'imagen': '/static/images/default-product.jpg', 
-                'categoria': 'juegos'
-            })
+@app.cli.command('resumen-valoraciones')
+@click.option('--verificar', is_flag=True, help='Solo comparar, sin reconstruir')
+def resumen_valoraciones_command(verificar):
+    """Verifica o reconstruye la tabla valoraciones_resumen"""
+    diferencias = reconstruir_resumen_valoraciones(solo_verificar=verificar)
+    if not diferencias:
+        print("✅ valoraciones_resumen coincide con valoraciones")
+    elif verificar:
+        print(f"❌ Resumen desincronizado para {len(diferencias)} juegos: {diferencias}")
+        raise SystemExit(1)
+    else:
+        print(f"🔧 Resumen reconstruido; {len(diferencias)} juegos corregidos: {diferencias}")
+
+def reconstruir_resumen_ventas(solo_verificar=False):
+    """Recalcula ventas_resumen desde las órdenes vivas y archivadas.
+
+    Devuelve las claves (dia, juego_id, estado, metodo_pago) que no coincidían.
+    Con solo_verificar=True no modifica nada.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None)
+    try:
+        configurar_conexion_sqlite(conn)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('CREATE TEMP TABLE ventas_calculadas AS SELECT * FROM ventas_resumen WHERE 0')
+            conn.execute('CREATE UNIQUE INDEX temp.idx_ventas_calculadas ON ventas_calculadas (dia, juego_id, estado, metodo_pago)')
+            calcular_resumen_ventas(conn, 'temp.ventas_calculadas')
+            diferencias = conn.execute(f'''
+                SELECT dia, juego_id, estado, metodo_pago FROM (
+                    SELECT {COLUMNAS_RESUMEN_VENTAS} FROM temp.ventas_calculadas
+                    EXCEPT SELECT {COLUMNAS_RESUMEN_VENTAS} FROM ventas_resumen
+                )
+                UNION
+                SELECT dia, juego_id, estado, metodo_pago FROM (
+                    SELECT {COLUMNAS_RESUMEN_VENTAS} FROM ventas_resumen
+                    EXCEPT SELECT {COLUMNAS_RESUMEN_VENTAS} FROM temp.ventas_calculadas
+                )
+            ''').fetchall()
+
+            if diferencias and not solo_verificar:
+                conn.execute('DELETE FROM ventas_resumen')
+                conn.execute(f'INSERT INTO ventas_resumen SELECT {COLUMNAS_RESUMEN_VENTAS} FROM temp.ventas_calculadas')
+            conn.execute('DROP TABLE temp.ventas_calculadas')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return diferencias
+    finally:
+        conn.close()
 
-            cod_id = result.lastrowid
+@app.cli.command('resumen-ventas')
+@click.option('--verificar', is_flag=True, help='Solo comparar, sin reconstruir')
+def resumen_ventas_command(verificar):
+    """Verifica o reconstruye la tabla ventas_resumen"""
+    diferencias = reconstruir_resumen_ventas(solo_verificar=verificar)
+    if not diferencias:
+        print("✅ ventas_resumen coincide con las órdenes vivas y archivadas")
+    elif verificar:
+        print(f"❌ Resumen de ventas desincronizado en {len(diferencias)} claves: {diferencias[:20]}")
+        raise SystemExit(1)
+    else:
+        print(f"🔧 Resumen de ventas reconstruido; {len(diferencias)} claves corregidas")
+
+@app.cli.command('retencion-ordenes')
+@click.option('--maximo', type=int, default=None, help='Órdenes a conservar por usuario')
+def retencion_ordenes_command(maximo):
+    """Aplica ahora la retención de órdenes por usuario (sin esperar al hilo)"""
+    filas, duracion_ms = aplicar_retencion_ordenes(maximo=maximo)
+    registrar_ejecucion_tarea('retencion_ordenes', filas, duracion_ms)
+    print(f"🧹 {filas} órdenes archivadas en {duracion_ms:.0f} ms")
+
+@app.cli.command('archivar-ordenes')
+@click.option('--dias', type=int, default=None, help='Archivar órdenes con más de N días')
+def archivar_ordenes_command(dias):
+    """Mueve ahora las órdenes antiguas a los archivos mensuales y sella los meses cerrados"""
+    filas, duracion_ms = archivar_ordenes_antiguas(dias=dias)
+    registrar_ejecucion_tarea('archivar_ordenes', filas, duracion_ms)
+    print(f"🗄️ {filas} órdenes archivadas en {duracion_ms:.0f} ms en {ARCHIVO_DIRECTORIO}")
 
-            # Paquetes de COD
-            cod_packages = [
-                ('80 CP', 0.99, 1),
-                ('400 CP', 4.99, 2),
-                ('800 CP', 9.99, 3),
-                ('2000 CP', 19.99, 4),
-                ('5000 CP', 49.99, 5)
-            ]
+def init_db():
+    """Inicializa la base de datos SQLite: migraciones pendientes, datos de ejemplo y admin"""
+    migrado = aplicar_migraciones()
+    if migrado:
+        # Solo el proceso que migró: los índices nuevos necesitan estadísticas. Después
+        # las refresca la tarea de mantenimiento, no cada worker en cada arranque
+        actualizar_estadisticas()
 
-            for nombre, precio, orden in cod_packages:
-                conn.execute(text('''
-                    INSERT INTO paquetes (juego_id, nombre, precio, orden) 
-                    VALUES (:juego_id, :nombre, :precio, :orden)
-                '''), {
-                    'juego_id': cod_id, 
-                    'nombre': nombre, 
-                    'precio': precio, 
-                    'orden': orden
-                })
+    conn = get_db_connection()
 
-        # Insertar configuración básica si no existe
-        result = conn.execute(text('SELECT COUNT(*) FROM configuracion'))
-        config_count = result.fetchone()[0]
-
-        if config_count == 0:
-            configs = [
-                ('tasa_usd_ves', '36.50'),
-                ('pago_movil', 'Banco: Banesco\nTelefono: 0412-1234567\nCédula: V-12345678\nNombre: Store Admin'),
-                ('binance', 'Email: admin@inefablestore.com\nID Binance: 123456789'),
-                ('carousel1', 'https://via.placeholder.com/800x300/007bff/ffffff?text=🎮+Ofertas+Especiales+Free+Fire'),
-                ('carousel2', 'https://via.placeholder.com/800x300/28a745/ffffff?text=🔥+Mejores+Precios+PUBG'),
-                ('carousel3', 'https://via.placeholder.com/800x300/dc3545/ffffff?text=⚡+Entrega+Inmediata+COD')
-            ]
-
-            for campo, valor in configs:
-                conn.execute(text('''
-                    INSERT INTO configuracion (campo, valor) 
-                    VALUES (:campo, :valor)
-                '''), {'campo': campo, 'valor': valor})
+    try:
+        if migrado:
+            sembrar_datos_iniciales(conn)
 
         # Crear usuario administrador por defecto si no existe
         admin_email = os.environ.get('ADMIN_EMAIL')
@@ -629,9 +2376,10 @@ def init_db():
 
         if admin_email and admin_password:
             # Verificar si ya existe un admin con ese email
-            result = conn.execute(text('SELECT id FROM usuarios WHERE email = :email'), {'email': admin_email})
+            result = conn.execute(text('SELECT id, es_admin FROM usuarios WHERE email = :email'), {'email': admin_email})
+            admin_existente = result.fetchone()
 
-            if not result.fetchone():
+            if not admin_existente:
                 # Crear usuario administrador
                 password_hash = generate_password_hash(admin_password)
                 conn.execute(text('''
@@ -639,7 +2387,7 @@ def init_db():
                     VALUES (:nombre, :email, :password_hash, :es_admin)
                 '''), {'nombre': 'Administrador', 'email': admin_email, 'password_hash': password_hash, 'es_admin': True})
                 print(f"✅ Usuario administrador creado: {admin_email}")
-            else:
+            elif not admin_existente[1]:
                 # Actualizar usuario existente para que sea admin
                 conn.execute(text('''
                     UPDATE usuarios SET es_admin = :es_admin WHERE email = :email
@@ -696,9 +2444,20 @@ def create_orden():
     # Usar el email del usuario logueado
     usuario_email = session['user_email']
 
+    clave_idempotencia = request.headers.get('Idempotency-Key')
+    if clave_idempotencia is not None and not 0 < len(clave_idempotencia) <= IDEMPOTENCIA_CLAVE_MAXIMA:
+        return jsonify({'error': f'Idempotency-Key debe tener entre 1 y {IDEMPOTENCIA_CLAVE_MAXIMA} caracteres'}), 400
+
     conn = get_db_connection()
 
     try:
+        if clave_idempotencia:
+            # Primera escritura de la transacción: solo una petición con esta clave inserta
+            huella = huella_solicitud(data)
+            if not reclamar_clave_idempotencia(conn, usuario_email, clave_idempotencia, huella):
+                conn.rollback()
+                return respuesta_idempotente_guardada(conn, usuario_email, clave_idempotencia, huella)
+
         # Obtener el teléfono del usuario desde la base de datos
         result_user = conn.execute(text('''
             SELECT telefono FROM usuarios WHERE email = :email
@@ -731,103 +2490,755 @@ def create_orden():
             WHERE o.id = :orden_id
         '''), {'orden_id': orden_id})
 
-        orden_completa = result.fetchone()
-        conn.commit()
+        orden_completa = result.fetchone()
+
+        # La notificación al admin se encola en la misma transacción que la orden
+        if orden_completa:
+            orden_data = {
+                'id': orden_completa[0],
+                'juego_id': orden_completa[1],
+                'paquete': orden_completa[2],
+                'monto': orden_completa[3],
+                'usuario_email': orden_completa[4],
+                'usuario_id': orden_completa[5],
+                'usuario_telefono': orden_completa[6],
+                'metodo_pago': orden_completa[7],
+                'referencia_pago': orden_completa[8],
+                'estado': orden_completa[9],
+                'fecha': orden_completa[10],
+                'juego_nombre': orden_completa[12] if len(orden_completa) > 12 else None
+            }
+            encolar_correo(conn, 'nueva_orden', orden_data)
+
+        respuesta = {'message': 'Orden creada correctamente', 'id': orden_id}
+        if clave_idempotencia:
+            guardar_respuesta_idempotente(conn, usuario_email, clave_idempotencia, respuesta)
+        conn.commit()
+
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+    despertar_despachador()
+    return jsonify(respuesta)
+
+# Decorador para proteger endpoints de admin
+def admin_required(f):
+    def decorated_function(*args, **kwargs):
+        # Verificar si el usuario está logueado
+        if 'user_id' not in session:
+            return jsonify({'error': 'Debes iniciar sesión'}), 401
+
+        # Verificar si el usuario es administrador
+        conn = get_db_connection()
+        try:
+            result = conn.execute(text('SELECT es_admin FROM usuarios WHERE id = :user_id'), {'user_id': session['user_id']})
+            usuario = result.fetchone()
+
+            if not usuario or not usuario[0]:  # es_admin es False
+                return jsonify({'error': 'Acceso denegado. No tienes permisos de administrador.'}), 403
+
+        finally:
+            conn.close()
+
+        return f(*args, **kwargs)
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+# ENDPOINTS PARA ÓRDENES
+ORDENES_LIMITE_POR_DEFECTO = 50
+ORDENES_LIMITE_MAXIMO = 200
+# Filtros exactos de /admin/ordenes; cada uno es también una faceta con conteo
+FILTROS_ORDENES = ('estado', 'categoria', 'metodo_pago')
+# Valor de faceta (y de filtro) para las órdenes sin ese dato (NULL o vacío)
+FACETA_SIN_DEFINIR = 'sin_definir'
+
+def codificar_cursor_orden(orden):
+    """Cursor opaco con la posición (fecha, id) de la última orden entregada"""
+    crudo = json.dumps([orden['fecha'], orden['id']], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(crudo).decode('ascii').rstrip('=')
+
+def decodificar_cursor_orden(cursor):
+    """Devuelve (fecha, id) del cursor o lanza ValueError"""
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        fecha, orden_id = json.loads(crudo)
+        if not isinstance(fecha, str) or not isinstance(orden_id, int):
+            raise ValueError
+    except Exception:
+        raise ValueError('Cursor inválido')
+    return fecha, orden_id
+
+def _fecha_filtro(nombre):
+    """Lee un parámetro de fecha YYYY-MM-DD o lanza ValueError"""
+    valor = request.args.get(nombre) or None
+    if valor is not None:
+        try:
+            datetime.strptime(valor, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError(f'El parámetro {nombre} debe tener el formato YYYY-MM-DD')
+    return valor
+
+def conteos_ordenes(conn, filtros, desde=None, hasta=None):
+    """Totales por estado, categoría y método de pago desde ordenes_conteo.
+
+    Cada faceta respeta el rango de fechas y los demás filtros, pero no el suyo, para que
+    el panel muestre cuántas órdenes hay en cada opción. Recorre filas agregadas por día,
+    no las órdenes.
+    """
+    condiciones = []
+    params = {}
+    if desde:
+        condiciones.append('c.dia >= :desde')
+        params['desde'] = desde
+    if hasta:
+        condiciones.append('c.dia <= :hasta')
+        params['hasta'] = hasta
+    where = ('WHERE ' + ' AND '.join(condiciones)) if condiciones else ''
+
+    result = conn.execute(text(f'''
+        SELECT c.estado, j.categoria, c.metodo_pago, SUM(c.total)
+        FROM ordenes_conteo c
+        LEFT JOIN juegos j ON j.id = c.juego_id
+        {where}
+        GROUP BY c.estado, j.categoria, c.metodo_pago
+    '''), params)
+
+    conteos = {faceta: {} for faceta in FILTROS_ORDENES}
+    total = 0
+    for estado, categoria, metodo_pago, cantidad in result.fetchall():
+        fila = {faceta: valor if valor not in (None, '') else FACETA_SIN_DEFINIR
+                for faceta, valor in (('estado', estado), ('categoria', categoria), ('metodo_pago', metodo_pago))}
+        no_coinciden = [f for f in FILTROS_ORDENES if filtros.get(f) and fila[f] != filtros[f]]
+        if not no_coinciden:
+            total += cantidad
+        for faceta in FILTROS_ORDENES:
+            if all(f == faceta for f in no_coinciden):
+                conteos[faceta][fila[faceta]] = conteos[faceta].get(fila[faceta], 0) + cantidad
+    return conteos, total
+
+def condiciones_filtros_ordenes(filtros, desde=None, hasta=None, archivo=False):
+    """Condiciones SQL (sobre el alias `o`) y parámetros para los filtros del panel.
+
+    En los archivos mensuales la categoría está copiada en la propia fila (`archivo=True`).
+    FACETA_SIN_DEFINIR selecciona las órdenes sin ese dato, como en los conteos.
+    """
+    condiciones = []
+    params = {}
+    for campo in ('estado', 'metodo_pago'):
+        if filtros.get(campo) == FACETA_SIN_DEFINIR:
+            condiciones.append(f"IFNULL(o.{campo}, '') = ''")
+        elif filtros.get(campo):
+            condiciones.append(f'o.{campo} = :{campo}')
+            params[campo] = filtros[campo]
+    if filtros.get('categoria') == FACETA_SIN_DEFINIR:
+        if archivo:
+            condiciones.append("IFNULL(o.categoria, '') = ''")
+        else:
+            # También las órdenes de un juego ya borrado (sin fila en juegos)
+            condiciones.append("NOT EXISTS (SELECT 1 FROM juegos j WHERE j.id = o.juego_id AND IFNULL(j.categoria, '') != '')")
+    elif filtros.get('categoria'):
+        if archivo:
+            condiciones.append('o.categoria = :categoria')
+        else:
+            condiciones.append('o.juego_id IN (SELECT id FROM juegos WHERE categoria = :categoria)')
+        params['categoria'] = filtros['categoria']
+    if desde:
+        condiciones.append('o.fecha >= :desde')
+        params['desde'] = desde
+    if hasta:
+        condiciones.append("o.fecha < date(:hasta, '+1 day')")
+        params['hasta'] = hasta
+    return condiciones, params
+
+@app.route('/admin/ordenes', methods=['GET'])
+@admin_required
+def get_ordenes():
+    """Órdenes paginadas por keyset (fecha, id) DESC con filtros del lado del servidor.
+
+    Parámetros: estado, categoria, metodo_pago, desde y hasta (YYYY-MM-DD, inclusivos),
+    limit (1-200) y after (cursor devuelto en `siguiente`).
+    """
+    filtros = {f: request.args.get(f) or None for f in FILTROS_ORDENES}
+
+    try:
+        limite = int(request.args.get('limit', ORDENES_LIMITE_POR_DEFECTO))
+    except ValueError:
+        return jsonify({'error': 'El parámetro limit debe ser un número'}), 400
+    if limite < 1 or limite > ORDENES_LIMITE_MAXIMO:
+        return jsonify({'error': f'El parámetro limit debe estar entre 1 y {ORDENES_LIMITE_MAXIMO}'}), 400
+
+    try:
+        desde = _fecha_filtro('desde')
+        hasta = _fecha_filtro('hasta')
+        cursor = decodificar_cursor_orden(request.args['after']) if request.args.get('after') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    condiciones, params = condiciones_filtros_ordenes(filtros, desde, hasta)
+    params['limite'] = limite + 1
+    if cursor:
+        condiciones.append('(o.fecha, o.id) < (:cursor_fecha, :cursor_id)')
+        params['cursor_fecha'], params['cursor_id'] = cursor
+    where = ('WHERE ' + ' AND '.join(condiciones)) if condiciones else ''
+
+    conn = get_db_read_connection()
+    try:
+        result = conn.execute(text(f'''
+            SELECT o.id, o.juego_id, o.paquete, o.monto, o.usuario_email, o.usuario_id,
+                   o.usuario_telefono, o.metodo_pago, o.referencia_pago, o.estado, o.fecha,
+                   o.codigo_producto, j.nombre as juego_nombre, j.categoria
+            FROM ordenes o
+            LEFT JOIN juegos j ON o.juego_id = j.id
+            {where}
+            ORDER BY o.fecha DESC, o.id DESC
+            LIMIT :limite
+        '''), params)
+        ordenes = [dict(fila) for fila in result.mappings().fetchall()]
+
+        hay_mas = len(ordenes) > limite
+        ordenes = ordenes[:limite]
+        conteos, total = conteos_ordenes(conn, filtros, desde, hasta)
+
+        return jsonify({
+            'ordenes': ordenes,
+            'siguiente': codificar_cursor_orden(ordenes[-1]) if hay_mas else None,
+            'total': total,
+            'conteos': conteos
+        })
+    except Exception as e:
+        print(f"Error en get_ordenes: {e}")
+        return jsonify({'error': f'Error al obtener órdenes: {str(e)}'}), 500
+    finally:
+        conn.close()
+
+# FEED DE CAMBIOS DE ÓRDENES (Server-Sent Events)
+# Cada stream consulta ordenes_cambios con una conexión prestada por consulta (no la
+# retiene durante la espera) y se cierra tras SSE_DURACION_MAXIMA_SEGUNDOS; EventSource
+# reconecta solo enviando Last-Event-ID, así que un hilo nunca queda ocupado indefinidamente.
+# Limitación conocida (recorte deliberado): el feed NO se sirve fuera de los hilos de
+# petición. Con gthread cada stream abierto ocupa un hilo del worker mientras espera, y
+# liberarlo exige un worker asíncrono para esta ruta (gevent u otro proceso), que hoy no
+# forma parte del despliegue. SSE_STREAMS_MAXIMOS solo acota el daño: por encima de ese
+# número de streams por worker se responde 503 con Retry-After, pero no resuelve el problema.
+SSE_STREAMS_MAXIMOS = int(os.environ.get('SSE_STREAMS_MAXIMOS', 4))
+SSE_REINTENTO_OCUPADO_SEGUNDOS = 30
+_cupos_sse = threading.BoundedSemaphore(SSE_STREAMS_MAXIMOS)
+SSE_INTERVALO_SEGUNDOS = float(os.environ.get('SSE_INTERVALO_SEGUNDOS', 1.0))
+SSE_DURACION_MAXIMA_SEGUNDOS = float(os.environ.get('SSE_DURACION_MAXIMA_SEGUNDOS', 300))
+SSE_LATIDO_SEGUNDOS = 15
+SSE_REINTENTO_MS = 3000
+SSE_LOTE_EVENTOS = 100
+
+def leer_cambios_ordenes(ultimo_id, limite=SSE_LOTE_EVENTOS):
+    """Eventos de ordenes_cambios posteriores a `ultimo_id` con la orden actual adjunta.
+
+    Devuelve (eventos, primer_id_retenido); si el cliente pidió un id anterior a la
+    ventana retenida se perdieron eventos y debe recargar la lista.
+    """
+    conn = get_db_read_connection()
+    try:
+        primer_id = conn.execute(text('SELECT MIN(id) FROM ordenes_cambios')).scalar()
+        result = conn.execute(text('''
+            SELECT c.id as evento_id, c.tipo, c.orden_id as id, o.juego_id, o.paquete, o.monto,
+                   o.usuario_email, o.usuario_id, o.usuario_telefono, o.metodo_pago,
+                   o.referencia_pago, COALESCE(o.estado, c.estado) as estado, o.fecha,
+                   o.codigo_producto, j.nombre as juego_nombre, j.categoria
+            FROM ordenes_cambios c
+            LEFT JOIN ordenes o ON o.id = c.orden_id
+            LEFT JOIN juegos j ON j.id = o.juego_id
+            WHERE c.id > :ultimo_id
+            ORDER BY c.id
+            LIMIT :limite
+        '''), {'ultimo_id': ultimo_id, 'limite': limite})
+        return [dict(fila) for fila in result.mappings().fetchall()], primer_id
+    finally:
+        conn.close()
+
+def ultimo_cambio_ordenes():
+    conn = get_db_read_connection()
+    try:
+        return conn.execute(text('SELECT COALESCE(MAX(id), 0) FROM ordenes_cambios')).scalar()
+    finally:
+        conn.close()
+
+def _evento_sse(datos, evento=None, evento_id=None):
+    lineas = []
+    if evento_id is not None:
+        lineas.append(f'id: {evento_id}')
+    if evento:
+        lineas.append(f'event: {evento}')
+    lineas.append('data: ' + json.dumps(datos, default=str, separators=(',', ':')))
+    return '\n'.join(lineas) + '\n\n'
+
+def stream_cambios_ordenes(ultimo_id, duracion_maxima):
+    """Generador SSE: emite los cambios nuevos hasta agotar la duración máxima"""
+    yield f'retry: {SSE_REINTENTO_MS}\n\n'
+    fin = time.monotonic() + duracion_maxima
+    ultimo_envio = time.monotonic()
+
+    while True:
+        try:
+            eventos, primer_id = leer_cambios_ordenes(ultimo_id)
+        except Exception as e:
+            print(f"Error en feed de órdenes: {e}")
+            return
+
+        if primer_id is not None and ultimo_id < primer_id - 1:
+            # El cliente quedó fuera de la ventana retenida: debe recargar la lista
+            ultimo_id = ultimo_cambio_ordenes()
+            yield _evento_sse({'ultimo_id': ultimo_id}, evento='reinicio', evento_id=ultimo_id)
+            ultimo_envio = time.monotonic()
+            continue
+
+        for evento in eventos:
+            ultimo_id = evento.pop('evento_id')
+            tipo = evento.pop('tipo')
+            yield _evento_sse({'tipo': tipo, 'orden': evento}, evento='orden', evento_id=ultimo_id)
+            ultimo_envio = time.monotonic()
+
+        if len(eventos) == SSE_LOTE_EVENTOS:
+            continue  # quedan eventos pendientes: seguir sin esperar
+
+        ahora = time.monotonic()
+        if ahora >= fin:
+            return
+        if ahora - ultimo_envio >= SSE_LATIDO_SEGUNDOS:
+            # Comentario SSE: mantiene viva la conexión a través de proxies
+            yield ': latido\n\n'
+            ultimo_envio = ahora
+        time.sleep(SSE_INTERVALO_SEGUNDOS)
+
+@app.route('/admin/ordenes/eventos', methods=['GET'])
+@admin_required
+def eventos_ordenes():
+    """Feed SSE de órdenes creadas y cambios de estado (todos los workers).
+
+    Reanuda desde la cabecera Last-Event-ID (o ?ultimo_id=); sin cursor empieza desde
+    el cambio más reciente.
+    """
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('ultimo_id')
+    try:
+        ultimo_id = int(cursor) if cursor else ultimo_cambio_ordenes()
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID inválido'}), 400
+
+    if not _cupos_sse.acquire(blocking=False):
+        response = jsonify({'error': 'Demasiados feeds en vivo abiertos, reintenta más tarde'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_REINTENTO_OCUPADO_SEGUNDOS)
+        return response
+
+    response = Response(stream_cambios_ordenes(ultimo_id, SSE_DURACION_MAXIMA_SEGUNDOS),
+                        mimetype='text/event-stream')
+    # El cupo se libera al cerrar la respuesta: fin del stream o desconexión del cliente
+    response.call_on_close(_cupos_sse.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx/proxies: no acumular el stream
+    return response
+
+@app.route('/admin/mantenimiento', methods=['GET'])
+@admin_required
+def get_mantenimiento():
+    """Estado de las tareas en segundo plano: última ejecución, duración y filas afectadas"""
+    conn = get_db_read_connection()
+    try:
+        result = conn.execute(text('SELECT * FROM tareas_mantenimiento ORDER BY nombre'))
+        return jsonify([dict(fila) for fila in result.mappings().fetchall()])
+    except Exception as e:
+        print(f"Error en get_mantenimiento: {e}")
+        return jsonify({'error': f'Error al obtener tareas de mantenimiento: {str(e)}'}), 500
+    finally:
+        conn.close()
 
-        # Limpiar órdenes antiguas del usuario (mantener solo las últimas 40)
-        limpiar_ordenes_antiguas(usuario_email)
+@app.route('/admin/outbox', methods=['GET'])
+@admin_required
+def get_outbox():
+    """Estado del outbox de correos: cola, reintentos, fallidos y ritmo de envío.
+
+    Los enviados cuentan correos: un resumen de varias órdenes nuevas cuenta como uno.
+    """
+    conn = get_db_read_connection()
+    try:
+        ahora = time.time()
+        fila = conn.execute(text('''
+            SELECT
+                SUM(estado = 'pendiente') AS pendientes,
+                SUM(estado = 'pendiente' AND intentos > 0) AS en_reintento,
+                SUM(estado = 'fallido') AS fallidos,
+                MIN(CASE WHEN estado = 'pendiente' THEN creado END) AS pendiente_mas_antiguo,
+                SUM(estado = 'enviado' AND enviado >= :minuto AND tipo != 'nueva_orden')
+                    + COUNT(DISTINCT CASE WHEN estado = 'enviado' AND enviado >= :minuto
+                                          AND tipo = 'nueva_orden' THEN reclamado END) AS enviados_ultimo_minuto,
+                SUM(estado = 'enviado' AND enviado >= :hora AND tipo != 'nueva_orden')
+                    + COUNT(DISTINCT CASE WHEN estado = 'enviado' AND enviado >= :hora
+                                          AND tipo = 'nueva_orden' THEN reclamado END) AS enviados_ultima_hora
+            FROM outbox
+        '''), {'minuto': ahora - 60, 'hora': ahora - 3600}).mappings().fetchone()
+        errores = conn.execute(text('''
+            SELECT id, tipo, orden_id, estado, intentos, ultimo_error, proximo_intento FROM outbox
+            WHERE ultimo_error IS NOT NULL AND estado != 'enviado'
+            ORDER BY id DESC LIMIT 20
+        ''')).mappings().fetchall()
+        return jsonify({
+            'pendientes': fila['pendientes'] or 0,
+            'en_reintento': fila['en_reintento'] or 0,
+            'fallidos': fila['fallidos'] or 0,
+            'antiguedad_segundos': round(ahora - fila['pendiente_mas_antiguo'], 1) if fila['pendiente_mas_antiguo'] else 0,
+            'enviados_ultimo_minuto': fila['enviados_ultimo_minuto'] or 0,
+            'enviados_ultima_hora': fila['enviados_ultima_hora'] or 0,
+            'cuota_por_minuto': OUTBOX_CUOTA_POR_MINUTO,
+            'max_intentos': OUTBOX_MAX_INTENTOS,
+            'ultimos_errores': [dict(error) for error in errores]
+        })
+    except Exception as e:
+        print(f"Error en get_outbox: {e}")
+        return jsonify({'error': f'Error al obtener el outbox: {str(e)}'}), 500
+    finally:
+        conn.close()
 
+@app.route('/admin/outbox/reintentar', methods=['POST'])
+@admin_required
+def reintentar_outbox():
+    """Vuelve a poner en cola los correos fallidos (p. ej. tras corregir la contraseña SMTP)"""
+    conn = get_db_connection()
+    try:
+        filas = conn.execute(text('''
+            UPDATE outbox SET estado = 'pendiente', intentos = 0, proximo_intento = :ahora
+            WHERE estado = 'fallido'
+        '''), {'ahora': time.time()}).rowcount
+        conn.commit()
     except Exception as e:
         conn.rollback()
-        raise e
+        print(f"Error en reintentar_outbox: {e}")
+        return jsonify({'error': f'Error al reintentar correos: {str(e)}'}), 500
     finally:
         conn.close()
+    despertar_despachador()
+    return jsonify({'reencolados': filas})
 
-    # Enviar notificación por correo en un hilo separado para no bloquear la respuesta
-    if orden_completa:
-        orden_data = {
-            'id': orden_completa[0],
-            'juego_id': orden_completa[1],
-            'paquete': orden_completa[2],
-            'monto': orden_completa[3],
-            'usuario_email': orden_completa[4],
-            'usuario_id': orden_completa[5],
-            'usuario_telefono': orden_completa[6],
-            'metodo_pago': orden_completa[7],
-            'referencia_pago': orden_completa[8],
-            'estado': orden_completa[9],
-            'fecha': orden_completa[10],
-            'juego_nombre': orden_completa[12] if len(orden_completa) > 12 else None
-        }
+@app.route('/admin/ejecutores', methods=['GET'])
+@admin_required
+def get_ejecutores():
+    """Contadores de los ejecutores en segundo plano de este worker (los que ya se usaron)"""
+    return jsonify({nombre: ejecutor.estado() for nombre, ejecutor in list(_ejecutores.items())})
 
-        # Enviar notificación en hilo separado
-        threading.Thread(target=enviar_notificacion_orden, args=(orden_data,)).start()
+@app.route('/admin/ordenes/historial', methods=['GET'])
+@admin_required
+def get_historial_ordenes():
+    """Órdenes vivas y archivadas (ATTACH de los archivos mensuales).
 
-    return jsonify({'message': 'Orden creada correctamente', 'id': orden_id})
+    Filtros: usuario_email, estado, referencia_pago, desde y hasta (YYYY-MM-DD); limit 1-200.
+    """
+    try:
+        limite = int(request.args.get('limit', ORDENES_LIMITE_POR_DEFECTO))
+    except ValueError:
+        return jsonify({'error': 'El parámetro limit debe ser un número'}), 400
+    if limite < 1 or limite > ORDENES_LIMITE_MAXIMO:
+        return jsonify({'error': f'El parámetro limit debe estar entre 1 y {ORDENES_LIMITE_MAXIMO}'}), 400
 
-# Decorador para proteger endpoints de admin
-def admin_required(f):
-    def decorated_function(*args, **kwargs):
-        # Verificar si el usuario está logueado
-        if 'user_id' not in session:
-            return jsonify({'error': 'Debes iniciar sesión'}), 401
+    try:
+        desde = _fecha_filtro('desde')
+        hasta = _fecha_filtro('hasta')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    condiciones = []
+    params = {}
+    for campo in ('usuario_email', 'estado', 'referencia_pago'):
+        if request.args.get(campo):
+            condiciones.append(f'o.{campo} = :{campo}')
+            params[campo] = request.args[campo]
+    if desde:
+        condiciones.append('o.fecha >= :desde')
+        params['desde'] = desde
+    if hasta:
+        condiciones.append("o.fecha < date(:hasta, '+1 day')")
+        params['hasta'] = hasta
 
-        # Verificar si el usuario es administrador
-        conn = get_db_connection()
+    try:
+        ordenes, meses = consultar_historial_ordenes(condiciones, params, limite)
+        return jsonify({'ordenes': ordenes, 'meses_archivo_consultados': meses})
+    except Exception as e:
+        print(f"Error en get_historial_ordenes: {e}")
+        return jsonify({'error': f'Error al consultar el historial: {str(e)}'}), 500
+
+# EXPORTACIÓN DE ÓRDENES (CSV / NDJSON en streaming para contabilidad)
+# Se lee por tandas con keyset (fecha, id) ASC y una consulta corta por tanda (cada una en
+# su propia transacción de lectura): ninguna lectura queda abierta mientras el cliente
+# descarga, así que no se retiene un snapshot del WAL (que impediría los checkpoints) ni,
+# con DB_JOURNAL_MODE=DELETE, se bloquea a los escritores.
+EXPORTACION_LOTE = 1000
+COLUMNAS_EXPORTACION = [c.strip() for c in COLUMNAS_ORDEN.split(',')] + ['juego_nombre', 'categoria', 'archivada']
+FORMATOS_EXPORTACION = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+# Pasadas del keyset: (condición tras el cursor, condición hasta el tope, orden). Las filas
+# sin fecha van primero (como en ORDER BY de SQLite) y por id: la comparación de tuplas con
+# NULL nunca es verdadera y el keyset por (fecha, id) las saltaría. El cursor inicial
+# ('', 0) hace que la primera tanda con fecha sea un rango del índice y no un recorrido.
+PASADAS_EXPORTACION = [
+    ('o.fecha IS NULL AND o.id > :cursor_id', 'o.id <= :tope_id', 'o.id'),
+    ('(o.fecha, o.id) > (:cursor_fecha, :cursor_id)', '(o.fecha, o.id) <= (:tope_fecha, :tope_id)', 'o.fecha, o.id'),
+]
+
+def _clave_exportacion(fila):
+    return (fila['fecha'] or '', fila['id'])
+
+def _leer_tanda_exportacion(conn, origen, condiciones, params, pasada, cursor, tope=None,
+                            limite=EXPORTACION_LOTE):
+    """Hasta `limite` filas de `origen` con clave en (cursor, tope] en una sola consulta"""
+    tras_cursor, hasta_tope, orden = pasada
+    condiciones = condiciones + [tras_cursor] + ([hasta_tope] if tope else [])
+    valores = dict(params, lote=limite, cursor_fecha=cursor[0], cursor_id=cursor[1])
+    if tope:
+        valores.update(tope_fecha=tope[0], tope_id=tope[1])
+    return conn.execute(f'''
+        SELECT {origen}
+        WHERE {' AND '.join(condiciones)}
+        ORDER BY {orden}
+        LIMIT :lote
+    ''', valores).fetchall()
+
+def _tanda_archivo_exportacion(conn, origen, condiciones, params, pasada, cursor, tope, desde, hasta):
+    """Hasta EXPORTACION_LOTE filas archivadas con clave en (cursor, tope], de los meses del rango.
+
+    Los meses se listan en cada tanda: uno que se archive por primera vez durante la
+    exportación también se lee.
+    """
+    sin_fecha = pasada is PASADAS_EXPORTACION[0]
+    filas = []
+    for mes, ruta in reversed(meses_archivados(desde, hasta)):
+        if sin_fecha != (mes == 'sin-fecha'):
+            continue
+        if not sin_fecha and (mes < cursor[0][:7] or (tope and mes > tope[0][:7])):
+            continue
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(_ruta_consultable(ruta))) + '?mode=ro'
+        conn.execute('ATTACH DATABASE ? AS archivo', (uri,))
         try:
-            result = conn.execute(text('SELECT es_admin FROM usuarios WHERE id = :user_id'), {'user_id': session['user_id']})
-            usuario = result.fetchone()
+            filas += _leer_tanda_exportacion(conn, origen, condiciones, params, pasada, cursor, tope,
+                                             limite=EXPORTACION_LOTE - len(filas))
+        finally:
+            conn.execute('DETACH DATABASE archivo')
+        if len(filas) >= EXPORTACION_LOTE:
+            break
+    return filas
+
+def _conectar_exportacion():
+    conn = sqlite3.connect(f'file:{os.path.abspath(DATABASE_PATH)}?mode=ro', uri=True, timeout=30,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    configurar_conexion_sqlite(conn, solo_lectura=True)
+    return conn
+
+def tandas_exportacion_ordenes(filtros, desde=None, hasta=None, incluir_archivo=False):
+    """Genera tandas de filas para exportar en orden (fecha, id); con `incluir_archivo`
+    intercala las órdenes archivadas con las vivas.
+
+    Por cada tramo de claves se leen primero las vivas y después las archivadas del mismo
+    tramo. El archivador copia al archivo antes de borrar de ordenes, así que una orden
+    que se archiva durante la exportación está en una de las dos lecturas (o en ambas, y
+    se deduplica por id dentro del tramo): no se pierde ni sale dos veces.
+    """
+    columnas = ', '.join('o.' + c for c in COLUMNAS_EXPORTACION[:-3])
+    origen_vivas = f'''{columnas}, j.nombre as juego_nombre, j.categoria, 0 as archivada
+        FROM ordenes o LEFT JOIN juegos j ON j.id = o.juego_id'''
+    origen_archivo = f'{columnas}, o.juego_nombre, o.categoria, 1 as archivada FROM archivo.ordenes o'
+    condiciones, params = condiciones_filtros_ordenes(filtros, desde, hasta)
+    condiciones_archivo, params_archivo = condiciones_filtros_ordenes(filtros, desde, hasta, archivo=True)
+
+    conn = _conectar_exportacion()
+    try:
+        for pasada in PASADAS_EXPORTACION:
+            cursor = ('', 0)
+            while True:
+                vivas = _leer_tanda_exportacion(conn, origen_vivas, condiciones, params, pasada, cursor)
+                tope = _clave_exportacion(vivas[-1]) if len(vivas) == EXPORTACION_LOTE else None
+                archivadas = []
+                if incluir_archivo:
+                    archivadas = _tanda_archivo_exportacion(conn, origen_archivo, condiciones_archivo,
+                                                            params_archivo, pasada, cursor, tope, desde, hasta)
+                    if len(archivadas) == EXPORTACION_LOTE:
+                        # El tramo se acorta a lo que cubren las archivadas; las vivas que
+                        # quedan fuera se vuelven a leer (con su archivo) en el siguiente
+                        tope = _clave_exportacion(archivadas[-1])
+                        vivas = [fila for fila in vivas if _clave_exportacion(fila) <= tope]
+                    ids_vivas = {fila['id'] for fila in vivas}
+                    archivadas = [fila for fila in archivadas if fila['id'] not in ids_vivas]
+                tanda = sorted(vivas + archivadas, key=_clave_exportacion) if archivadas else vivas
+                if tanda:
+                    yield tanda
+                if tope is None:
+                    break
+                cursor = tope
+    finally:
+        conn.close()
 
-            if not usuario or not usuario[0]:  # es_admin es False
-                return jsonify({'error': 'Acceso denegado. No tienes permisos de administrador.'}), 403
+def exportar_ordenes_csv(tandas):
+    """Un fragmento de CSV por tanda (la cabecera va en el primero)"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(COLUMNAS_EXPORTACION)
+    for tanda in tandas:
+        escritor.writerows(tuple(fila) for fila in tanda)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def exportar_ordenes_ndjson(tandas):
+    """Un objeto JSON por línea; un fragmento por tanda"""
+    for tanda in tandas:
+        yield ''.join(json.dumps(dict(fila), ensure_ascii=False) + '\n' for fila in tanda)
+
+@app.route('/admin/ordenes/export', methods=['GET'])
+@admin_required
+def exportar_ordenes():
+    """Descarga de órdenes en CSV o NDJSON, transmitida por fragmentos (sin Content-Length).
 
-        finally:
-            conn.close()
+    Parámetros: formato (csv|ndjson), estado, categoria, metodo_pago, desde y hasta
+    (YYYY-MM-DD, inclusivos) y archivadas=1 para incluir los archivos mensuales.
+    """
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS_EXPORTACION:
+        return jsonify({'error': f'Formato no soportado. Usa: {", ".join(FORMATOS_EXPORTACION)}'}), 400
 
-        return f(*args, **kwargs)
-    decorated_function.__name__ = f.__name__
-    return decorated_function
+    try:
+        desde = _fecha_filtro('desde')
+        hasta = _fecha_filtro('hasta')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filtros = {f: request.args.get(f) or None for f in FILTROS_ORDENES}
+    tandas = tandas_exportacion_ordenes(filtros, desde, hasta, request.args.get('archivadas') == '1')
+    mimetype, extension = FORMATOS_EXPORTACION[formato]
+    cuerpo = exportar_ordenes_csv(tandas) if formato == 'csv' else exportar_ordenes_ndjson(tandas)
+
+    nombre = f"ordenes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    response = Response(cuerpo, content_type=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{nombre}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-# ENDPOINTS PARA ÓRDENES
-@app.route('/admin/ordenes', methods=['GET'])
+# ESTADÍSTICAS DE VENTAS (servidas desde ventas_resumen y ordenes_conteo)
+ESTADISTICAS_DIAS_POR_DEFECTO = 30
+ESTADISTICAS_TOP_POR_DEFECTO = 10
+ESTADISTICAS_TOP_MAXIMO = 50
+# La serie diaria se rellena con ceros: el rango tiene techo para acotar su tamaño
+ESTADISTICAS_DIAS_MAXIMO = 366
+
+def _ventas(filas):
+    """Filas con monto_centavos -> dicts con monto en la unidad de la tienda"""
+    ventas = []
+    for fila in filas:
+        venta = dict(fila)
+        venta['monto'] = (venta.pop('monto_centavos') or 0) / 100
+        ventas.append(venta)
+    return ventas
+
+@app.route('/admin/estadisticas', methods=['GET'])
 @admin_required
-def get_ordenes():
-    conn = get_db_connection()
+def get_estadisticas():
+    """Ventas por día, top de juegos y métodos de pago, más los contadores de órdenes vivas.
+
+    Parámetros: desde y hasta (YYYY-MM-DD, inclusivos; por defecto los últimos 30 días,
+    como mucho 366), estado (por defecto 'procesado'; 'todos' para no filtrar) y top (1-50).
+    """
     try:
-        result = conn.execute(text('''
-            SELECT o.*, j.nombre as juego_nombre, j.categoria 
-            FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = j.id 
-            ORDER BY o.fecha DESC
-        '''))
-        ordenes = result.fetchall()
+        top = int(request.args.get('top', ESTADISTICAS_TOP_POR_DEFECTO))
+    except ValueError:
+        return jsonify({'error': 'El parámetro top debe ser un número'}), 400
+    if top < 1 or top > ESTADISTICAS_TOP_MAXIMO:
+        return jsonify({'error': f'El parámetro top debe estar entre 1 y {ESTADISTICAS_TOP_MAXIMO}'}), 400
 
-        # Convertir a lista de diccionarios
-        ordenes_dict = []
-        for orden in ordenes:
-            # Usar índices numéricos en lugar de _mapping para SQLite
-            orden_dict = {
-                'id': orden[0],
-                'juego_id': orden[1],
-                'paquete': orden[2],
-                'monto': orden[3],
-                'usuario_email': orden[4],
-                'usuario_id': orden[5],
-                'usuario_telefono': orden[6],
-                'metodo_pago': orden[7],
-                'referencia_pago': orden[8],
-                'estado': orden[9],
-                'fecha': orden[10],
-                'codigo_producto': orden[11] if len(orden) > 11 else None,
-                'juego_nombre': orden[12] if len(orden) > 12 else None,
-                'categoria': orden[13] if len(orden) > 13 else None
-            }
-            ordenes_dict.append(orden_dict)
+    try:
+        hoy = datetime.now(timezone.utc).date()
+        hasta = _fecha_filtro('hasta') or hoy.isoformat()
+        desde = _fecha_filtro('desde') or (
+            datetime.strptime(hasta, '%Y-%m-%d').date() - timedelta(days=ESTADISTICAS_DIAS_POR_DEFECTO - 1)
+        ).isoformat()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if desde > hasta:
+        return jsonify({'error': 'desde no puede ser posterior a hasta'}), 400
+    dias = (datetime.strptime(hasta, '%Y-%m-%d') - datetime.strptime(desde, '%Y-%m-%d')).days + 1
+    if dias > ESTADISTICAS_DIAS_MAXIMO:
+        return jsonify({'error': f'El rango no puede superar {ESTADISTICAS_DIAS_MAXIMO} días'}), 400
+
+    estado = request.args.get('estado', 'procesado')
+    condiciones = ['v.dia BETWEEN :desde AND :hasta']
+    params = {'desde': desde, 'hasta': hasta, 'top': top}
+    if estado != 'todos':
+        condiciones.append('v.estado = :estado')
+        params['estado'] = estado
+    where = 'WHERE ' + ' AND '.join(condiciones)
+
+    conn = get_db_read_connection()
+    try:
+        por_dia = {fila['dia']: dict(fila) for fila in conn.execute(text(f'''
+            SELECT v.dia, SUM(v.ordenes) as ordenes, SUM(v.monto_centavos) as monto_centavos
+            FROM ventas_resumen v {where}
+            GROUP BY v.dia
+        '''), params).mappings()}
+        top_juegos = _ventas(conn.execute(text(f'''
+            SELECT v.juego_id, j.nombre, j.categoria,
+                   SUM(v.ordenes) as ordenes, SUM(v.monto_centavos) as monto_centavos
+            FROM ventas_resumen v LEFT JOIN juegos j ON j.id = v.juego_id
+            {where}
+            GROUP BY v.juego_id
+            ORDER BY monto_centavos DESC
+            LIMIT :top
+        '''), params).mappings())
+        por_metodo = _ventas(conn.execute(text(f'''
+            SELECT v.metodo_pago, SUM(v.ordenes) as ordenes, SUM(v.monto_centavos) as monto_centavos
+            FROM ventas_resumen v {where}
+            GROUP BY v.metodo_pago
+            ORDER BY monto_centavos DESC
+        '''), params).mappings())
+
+        # Contadores en vivo para la cabecera del panel (órdenes que siguen en la base)
+        contadores = {'por_estado': {}, 'hoy': {}}
+        for dia, estado_orden, total in conn.execute(text('''
+            SELECT CASE WHEN dia = :hoy THEN 'hoy' END, estado, SUM(total)
+            FROM ordenes_conteo
+            GROUP BY 1, 2
+        '''), {'hoy': hoy.isoformat()}).fetchall():
+            estado_orden = estado_orden or FACETA_SIN_DEFINIR
+            contadores['por_estado'][estado_orden] = contadores['por_estado'].get(estado_orden, 0) + total
+            if dia:
+                contadores['hoy'][estado_orden] = total
+
+        # Serie continua: los días sin ventas también aparecen (en cero)
+        serie = []
+        dia = datetime.strptime(desde, '%Y-%m-%d').date()
+        ultimo = datetime.strptime(hasta, '%Y-%m-%d').date()
+        while dia <= ultimo:
+            clave = dia.isoformat()
+            fila = por_dia.get(clave, {'ordenes': 0, 'monto_centavos': 0})
+            serie.append({'dia': clave, 'ordenes': fila['ordenes'], 'monto': fila['monto_centavos'] / 100})
+            dia += timedelta(days=1)
 
-        return jsonify(ordenes_dict)
+        return jsonify({
+            'desde': desde,
+            'hasta': hasta,
+            'estado': estado,
+            'totales': {
+                'ordenes': sum(f['ordenes'] for f in serie),
+                'monto': sum(f['monto_centavos'] for f in por_dia.values()) / 100
+            },
+            'serie': serie,
+            'top_juegos': top_juegos,
+            'por_metodo_pago': por_metodo,
+            'contadores': contadores
+        })
     except Exception as e:
-        print(f"Error en get_ordenes: {e}")
-        return jsonify({'error': f'Error al obtener órdenes: {str(e)}'}), 500
+        print(f"Error en get_estadisticas: {e}")
+        return jsonify({'error': f'Error al obtener estadísticas: {str(e)}'}), 500
     finally:
         conn.close()
 
@@ -863,24 +3274,18 @@ def update_orden(orden_id):
             conn.execute(text('UPDATE ordenes SET estado = :estado WHERE id = :orden_id'), 
                         {'estado': nuevo_estado, 'orden_id': orden_id})
 
-        conn.commit()
-
-        # Convertir orden_info a diccionario para envío de correo
+        # Convertir orden_info a diccionario para el correo
         orden_dict = dict(orden_info._mapping)
         if codigo_producto:
             orden_dict['codigo_producto'] = codigo_producto
 
-        # Si el nuevo estado es "procesado", enviar correo de confirmación al usuario
+        # Si el nuevo estado es "procesado", encolar el correo de confirmación al usuario
+        # (Gift Card con código o recarga) en la misma transacción
         if nuevo_estado == 'procesado':
-            # Verificar si es Gift Card para enviar correo específico
-            es_gift_card = (orden_dict.get('categoria') == 'gift-cards' or 
-                           'gift' in (orden_dict.get('juego_nombre', '')).lower() or
-                           'steam' in (orden_dict.get('juego_nombre', '')).lower())
+            encolar_correo(conn, tipo_correo_por_estado(orden_dict, nuevo_estado), orden_dict)
 
-            if es_gift_card and codigo_producto:
-                threading.Thread(target=enviar_correo_gift_card_completada, args=(orden_dict,)).start()
-            else:
-                threading.Thread(target=enviar_correo_recarga_completada, args=(orden_dict,)).start()
+        conn.commit()
+        despertar_despachador()
 
         return jsonify({'message': 'Estado actualizado correctamente'})
 
@@ -890,6 +3295,425 @@ def update_orden(orden_id):
     finally:
         conn.close()
 
+def es_orden_gift_card(orden_dict):
+    nombre = (orden_dict.get('juego_nombre') or '').lower()
+    return orden_dict.get('categoria') == 'gift-cards' or 'gift' in nombre or 'steam' in nombre
+
+def tipo_correo_por_estado(orden_dict, nuevo_estado):
+    """Tipo de correo del outbox para un cambio de estado (o None si no corresponde)"""
+    if nuevo_estado == 'procesado':
+        if es_orden_gift_card(orden_dict) and orden_dict.get('codigo_producto'):
+            return 'gift_card_completada'
+        return 'recarga_completada'
+    if nuevo_estado == 'rechazado':
+        return 'orden_rechazada'
+    return None
+
+ESTADOS_ORDEN = ('procesando', 'procesado', 'rechazado')
+ORDENES_LOTE_MAXIMO = 500
+
+def actualizar_estado_ordenes(conn, ordenes, estado, ids, codigos=None):
+    """Lleva las órdenes `ids` a `estado` con un solo UPDATE ... WHERE id IN.
+
+    `ordenes` son los dicts ya leídos (id -> orden con juego_nombre y categoria) y se
+    actualizan en el sitio; `codigos` asigna codigo_producto por orden con un CASE.
+    Los correos a clientes se encolan en el outbox en la misma transacción; devuelve cuántos.
+    """
+    codigos = codigos or {}
+    params = {'estado': estado, 'ids': ids}
+    asignar_codigo = ''
+    if codigos:
+        casos = []
+        for n, (orden_id, codigo) in enumerate(codigos.items()):
+            casos.append(f'WHEN :id_{n} THEN :codigo_{n}')
+            params[f'id_{n}'] = orden_id
+            params[f'codigo_{n}'] = codigo
+        asignar_codigo = f", codigo_producto = CASE id {' '.join(casos)} ELSE codigo_producto END"
+    conn.execute(text(
+        f'UPDATE ordenes SET estado = :estado{asignar_codigo} WHERE id IN :ids'
+    ).bindparams(bindparam('ids', expanding=True)), params)
+
+    correos = 0
+    for orden_id in ids:
+        orden = ordenes[orden_id]
+        orden['estado'] = estado
+        if orden_id in codigos:
+            orden['codigo_producto'] = codigos[orden_id]
+        tipo = tipo_correo_por_estado(orden, estado)
+        if tipo:
+            encolar_correo(conn, tipo, orden)
+            correos += 1
+    return correos
+
+@app.route('/admin/ordenes/lote', methods=['PATCH'])
+@admin_required
+def actualizar_ordenes_lote():
+    """Aplica varios cambios de estado en una transacción.
+
+    Cuerpo: {"cambios": [{"orden_id": 1, "estado": "procesado", "codigo_producto": "..."}]}.
+    Un UPDATE ... WHERE id IN por estado destino; los correos a clientes salen en un solo
+    lote al confirmar. Devuelve el resultado de cada orden.
+    """
+    data = request.get_json(silent=True) or {}
+    cambios = data.get('cambios') if isinstance(data, dict) else data
+    if not isinstance(cambios, list) or not cambios:
+        return jsonify({'error': 'Se requiere una lista de cambios'}), 400
+    if len(cambios) > ORDENES_LOTE_MAXIMO:
+        return jsonify({'error': f'Máximo {ORDENES_LOTE_MAXIMO} órdenes por lote'}), 400
+
+    # Validar cada cambio; los inválidos se reportan sin afectar al resto
+    resultados = {}
+    validos = {}
+    for cambio in cambios:
+        cambio = cambio if isinstance(cambio, dict) else {}
+        orden_id = cambio.get('orden_id')
+        estado = cambio.get('estado')
+        if not isinstance(orden_id, int) or isinstance(orden_id, bool):
+            return jsonify({'error': 'Cada cambio requiere un orden_id numérico'}), 400
+        if orden_id in resultados:
+            resultados[orden_id] = {'orden_id': orden_id, 'ok': False, 'error': 'Orden repetida en el lote'}
+            validos.pop(orden_id, None)
+        elif estado not in ESTADOS_ORDEN:
+            resultados[orden_id] = {'orden_id': orden_id, 'ok': False, 'error': f'Estado no válido: {estado}'}
+        else:
+            resultados[orden_id] = None
+            validos[orden_id] = {'estado': estado, 'codigo_producto': cambio.get('codigo_producto')}
+
+    conn = get_db_connection()
+    correos = 0
+    try:
+        ordenes = {}
+        if validos:
+            result = conn.execute(text('''
+                SELECT o.*, j.nombre as juego_nombre, j.categoria
+                FROM ordenes o
+                LEFT JOIN juegos j ON o.juego_id = j.id
+                WHERE o.id IN :ids
+            ''').bindparams(bindparam('ids', expanding=True)), {'ids': list(validos)})
+            ordenes = {fila['id']: dict(fila) for fila in result.mappings().fetchall()}
+
+        # Agrupar por estado destino; las órdenes que ya están así no se tocan
+        por_estado = {}
+        for orden_id, cambio in validos.items():
+            orden = ordenes.get(orden_id)
+            if not orden:
+                resultados[orden_id] = {'orden_id': orden_id, 'ok': False, 'error': 'Orden no encontrada'}
+                continue
+            codigo = cambio['codigo_producto']
+            if orden['estado'] == cambio['estado'] and (codigo is None or codigo == orden['codigo_producto']):
+                resultados[orden_id] = {'orden_id': orden_id, 'ok': True, 'estado': orden['estado'], 'sin_cambios': True}
+                continue
+            por_estado.setdefault(cambio['estado'], []).append(orden_id)
+
+        for estado, ids in por_estado.items():
+            codigos = {i: validos[i]['codigo_producto'] for i in ids if validos[i]['codigo_producto'] is not None}
+            correos += actualizar_estado_ordenes(conn, ordenes, estado, ids, codigos)
+            for orden_id in ids:
+                resultados[orden_id] = {'orden_id': orden_id, 'ok': True, 'estado': estado}
+
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error en actualizar_ordenes_lote: {e}")
+        return jsonify({'error': f'Error al actualizar órdenes: {str(e)}'}), 500
+    finally:
+        conn.close()
+
+    despertar_despachador()
+
+    resultados = list(resultados.values())
+    return jsonify({
+        'actualizadas': sum(1 for r in resultados if r['ok'] and not r.get('sin_cambios')),
+        'errores': sum(1 for r in resultados if not r['ok']),
+        'correos_en_cola': correos,
+        'resultados': resultados
+    })
+
+# CONCILIACIÓN DE PAGOS CONTRA EXTRACTOS (CSV del banco o de Binance)
+CONCILIACION_FILAS_MAXIMAS = 50000
+CONCILIACION_TOLERANCIA = 0.01
+CONCILIACION_COLUMNAS_REFERENCIA = ('referencia', 'referencia_pago', 'reference', 'ref', 'nro_referencia')
+CONCILIACION_COLUMNAS_MONTO = ('monto', 'amount', 'importe', 'total')
+# El IN por referencias va por tandas (SQLite antiguo admite 999 parámetros por sentencia)
+CONCILIACION_LOTE_REFERENCIAS = 500
+
+def separador_decimal(texto):
+    """',' o '.' si el monto deja claro cuál es su separador decimal; None si no lo deja.
+
+    '1.234,56' y '12,5' lo dejan claro; '1,234' no (¿mil doscientos o uno con algo?):
+    un solo separador seguido de exactamente 3 cifras es ambiguo.
+    """
+    limpio = re.sub(r'[^\d,.]', '', texto or '')
+    if ',' in limpio and '.' in limpio:
+        # El separador que aparece último es el decimal
+        return ',' if limpio.rfind(',') > limpio.rfind('.') else '.'
+    for separador, otro in ((',', '.'), ('.', ',')):
+        grupos = limpio.split(separador)
+        if len(grupos) > 2 and all(len(g) == 3 for g in grupos[1:]):
+            return otro  # solo el de miles se repite: '1.234.567'
+        if len(grupos) == 2 and (len(grupos[1]) != 3 or len(grupos[0]) > 3 or grupos[0] in ('', '0')):
+            return separador  # '12,5', '1234,567' o '0,123' no pueden ser miles
+    return None
+
+def monto_extracto(texto, decimal=None):
+    """Convierte '1.234,56', '1,234.56', '$ 12.50' o '-3,5' a float (ValueError si no es un monto).
+
+    Los montos ambiguos como '1,234' usan `decimal` (el separador decimal del resto del
+    extracto) y sin él son ValueError.
+    """
+    limpio = re.sub(r'[^\d,.\-]', '', texto or '')
+    decimal = separador_decimal(limpio) or decimal
+    if decimal is None and (',' in limpio or '.' in limpio):
+        raise ValueError(f'Monto ambiguo (¿separador de miles o decimal?): {texto!r}')
+    miles = '.' if decimal == ',' else ','
+    try:
+        if not re.fullmatch(rf'-?(\d*|\d{{1,3}}(\{miles}\d{{3}})+)(\{decimal or "."}\d*)?', limpio):
+            raise ValueError
+        return float(limpio.replace(miles, '').replace(decimal or '.', '.'))
+    except ValueError:
+        raise ValueError(f'Monto no válido: {texto!r}')
+
+def leer_extracto(contenido, columna_referencia=None, columna_monto=None):
+    """Lee un extracto CSV (separador , ; tab o |). Devuelve (lineas, invalidas).
+
+    Cada línea es {'linea', 'referencia', 'monto'}; las columnas se buscan por nombre
+    (sin distinguir mayúsculas) si no se indican. Lanza ValueError si el archivo no sirve.
+    """
+    try:
+        texto = contenido.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        texto = contenido.decode('latin-1')
+    try:
+        dialecto = csv.Sniffer().sniff(texto[:4096], delimiters=',;\t|')
+    except csv.Error:
+        dialecto = csv.excel
+
+    lector = csv.reader(io.StringIO(texto), dialecto)
+    cabecera = [c.strip().lower() for c in next(lector, [])]
+
+    def columna(pedida, candidatas, nombre):
+        opciones = [pedida.strip().lower()] if pedida else candidatas
+        for opcion in opciones:
+            if opcion in cabecera:
+                return cabecera.index(opcion)
+        raise ValueError(f'El extracto no tiene columna de {nombre} (se buscó: {", ".join(opciones)})')
+
+    indice_referencia = columna(columna_referencia, CONCILIACION_COLUMNAS_REFERENCIA, 'referencia')
+    indice_monto = columna(columna_monto, CONCILIACION_COLUMNAS_MONTO, 'monto')
+
+    filas, invalidas = [], []
+    for numero, fila in enumerate(lector, start=2):
+        if not any(c.strip() for c in fila):
+            continue
+        if len(filas) + len(invalidas) >= CONCILIACION_FILAS_MAXIMAS:
+            raise ValueError(f'El extracto supera el máximo de {CONCILIACION_FILAS_MAXIMAS} filas')
+        referencia = fila[indice_referencia].strip() if indice_referencia < len(fila) else ''
+        texto_monto = fila[indice_monto] if indice_monto < len(fila) else ''
+        if not referencia:
+            invalidas.append({'linea': numero, 'error': 'Sin referencia'})
+            continue
+        filas.append((numero, referencia, texto_monto))
+
+    # Un banco usa el mismo formato en todo el extracto: si las filas que no son ambiguas
+    # coinciden en el separador decimal, con él se leen las ambiguas ('1,234')
+    decimales = {separador_decimal(texto_monto) for _, _, texto_monto in filas} - {None}
+    decimal = decimales.pop() if len(decimales) == 1 else None
+
+    lineas = []
+    for numero, referencia, texto_monto in filas:
+        try:
+            lineas.append({'linea': numero, 'referencia': referencia, 'monto': monto_extracto(texto_monto, decimal)})
+        except ValueError as e:
+            invalidas.append({'linea': numero, 'referencia': referencia, 'error': str(e)})
+    invalidas.sort(key=lambda invalida: invalida['linea'])
+    return lineas, invalidas
+
+def conciliar_pagos(lineas, pendientes, usadas, tolerancia=CONCILIACION_TOLERANCIA, tasa=None):
+    """Cruza por hash las líneas del extracto con las órdenes pendientes, en una pasada.
+
+    `pendientes` son las órdenes en 'procesando'; `usadas` (referencia -> [órdenes]) las
+    que ya no están pendientes pero tienen la misma referencia. Con `tasa` los montos
+    del extracto están en bolívares y se pasan a dólares antes de comparar.
+    """
+    por_referencia = {}
+    for linea in lineas:
+        por_referencia.setdefault(linea['referencia'], []).append(linea)
+    ordenes_por_referencia = {}
+    for orden in pendientes:
+        referencia = (orden['referencia_pago'] or '').strip()
+        if referencia:
+            ordenes_por_referencia.setdefault(referencia, []).append(orden)
+
+    resultado = {'coincidencias': [], 'diferencias_monto': [], 'duplicados': [],
+                 'sin_orden': [], 'ya_procesadas': []}
+    for referencia, lineas_ref in por_referencia.items():
+        ordenes_ref = ordenes_por_referencia.get(referencia, [])
+        previas = usadas.get(referencia, [])
+
+        if len(lineas_ref) > 1 or len(ordenes_ref) > 1 or (ordenes_ref and previas):
+            motivos = []
+            if len(lineas_ref) > 1:
+                motivos.append('repetida_en_extracto')
+            if len(ordenes_ref) > 1:
+                motivos.append('varias_ordenes_pendientes')
+            if ordenes_ref and previas:
+                motivos.append('ya_usada_en_otra_orden')
+            resultado['duplicados'].append({
+                'referencia': referencia,
+                'motivos': motivos,
+                'lineas': [l['linea'] for l in lineas_ref],
+                'ordenes': [o['id'] for o in ordenes_ref],
+                'ordenes_previas': previas
+            })
+            continue
+
+        linea = lineas_ref[0]
+        if not ordenes_ref:
+            destino = 'ya_procesadas' if previas else 'sin_orden'
+            resultado[destino].append(dict(linea, ordenes_previas=previas) if previas else linea)
+            continue
+
+        orden = ordenes_ref[0]
+        monto_pagado = round(linea['monto'] / tasa, 2) if tasa else linea['monto']
+        diferencia = round(monto_pagado - (orden['monto'] or 0), 2)
+        cruce = {
+            'referencia': referencia,
+            'linea': linea['linea'],
+            'orden_id': orden['id'],
+            'monto_orden': orden['monto'],
+            'monto_extracto': linea['monto'],
+            'diferencia': diferencia
+        }
+        destino = 'coincidencias' if abs(diferencia) <= tolerancia + 1e-9 else 'diferencias_monto'
+        resultado[destino].append(cruce)
+
+    resultado['pendientes_sin_pago'] = [
+        o['id'] for o in pendientes if (o['referencia_pago'] or '').strip() not in por_referencia
+    ]
+    return resultado
+
+@app.route('/admin/ordenes/conciliar', methods=['POST'])
+@admin_required
+def conciliar_extracto():
+    """Concilia un extracto CSV contra todas las órdenes en 'procesando'.
+
+    Archivo en el campo `extracto` (multipart) o CSV en el cuerpo. Opciones: columna_referencia,
+    columna_monto, metodo_pago (solo órdenes de ese método), moneda (USD|VES; con VES se usa
+    `tasa` o la tasa_usd_ves configurada), tolerancia, procesar=1 (coincidencias a
+    'procesado', salvo gift cards que necesitan código) y rechazar=1 (diferencias de
+    monto a 'rechazado').
+    """
+    opciones = request.values
+    archivo = request.files.get('extracto')
+    contenido = archivo.read() if archivo else request.get_data()
+    if not contenido:
+        return jsonify({'error': 'Se requiere un extracto CSV'}), 400
+
+    try:
+        tolerancia = float(opciones.get('tolerancia', CONCILIACION_TOLERANCIA))
+        tasa = float(opciones['tasa']) if opciones.get('tasa') else None
+    except ValueError:
+        return jsonify({'error': 'tolerancia y tasa deben ser números'}), 400
+    moneda = opciones.get('moneda', 'USD').upper()
+    if moneda not in ('USD', 'VES'):
+        return jsonify({'error': 'moneda debe ser USD o VES'}), 400
+
+    try:
+        lineas, invalidas = leer_extracto(contenido, opciones.get('columna_referencia'), opciones.get('columna_monto'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = get_db_read_connection()
+    try:
+        if moneda == 'VES' and not tasa:
+            tasa_configurada = conn.execute(text(
+                "SELECT valor FROM configuracion WHERE campo = 'tasa_usd_ves'"
+            )).scalar()
+            try:
+                # Se edita a mano en el panel: admite '36,50' además de '36.50'
+                tasa = monto_extracto(tasa_configurada) if tasa_configurada else None
+            except ValueError:
+                return jsonify({'error': f'La tasa_usd_ves configurada no es un número ({tasa_configurada!r}); '
+                                         'corrígela o envía el parámetro tasa'}), 400
+            if not tasa or tasa < 0:
+                return jsonify({'error': 'No hay tasa_usd_ves configurada; envía el parámetro tasa'}), 400
+
+        condicion_metodo = 'AND o.metodo_pago = :metodo_pago' if opciones.get('metodo_pago') else ''
+        pendientes = [dict(fila) for fila in conn.execute(text(f'''
+            SELECT o.id, o.referencia_pago, o.monto, o.metodo_pago, o.usuario_email, o.fecha,
+                   j.nombre as juego_nombre, j.categoria
+            FROM ordenes o
+            LEFT JOIN juegos j ON o.juego_id = j.id
+            WHERE o.estado = 'procesando' {condicion_metodo}
+        '''), {'metodo_pago': opciones.get('metodo_pago')}).mappings()]
+
+        # Referencias del extracto ya usadas por órdenes no pendientes (índice por referencia)
+        usadas = {}
+        referencias = list({l['referencia'] for l in lineas})
+        for inicio in range(0, len(referencias), CONCILIACION_LOTE_REFERENCIAS):
+            result = conn.execute(text('''
+                SELECT id, referencia_pago, estado FROM ordenes
+                WHERE referencia_pago IN :referencias AND estado != 'procesando'
+            ''').bindparams(bindparam('referencias', expanding=True)),
+                {'referencias': referencias[inicio:inicio + CONCILIACION_LOTE_REFERENCIAS]})
+            for orden_id, referencia, estado in result.fetchall():
+                usadas.setdefault(referencia, []).append({'orden_id': orden_id, 'estado': estado})
+    except Exception as e:
+        print(f"Error en conciliar_extracto: {e}")
+        return jsonify({'error': f'Error al conciliar el extracto: {str(e)}'}), 500
+    finally:
+        conn.close()
+
+    resultado = conciliar_pagos(lineas, pendientes, usadas, tolerancia, tasa if moneda == 'VES' else None)
+    resultado['invalidas'] = invalidas
+
+    pendientes_por_id = {o['id']: o for o in pendientes}
+    for cruce in resultado['coincidencias']:
+        cruce['requiere_codigo'] = es_orden_gift_card(pendientes_por_id[cruce['orden_id']])
+
+    cambios = {}
+    if opciones.get('procesar') == '1':
+        cambios['procesado'] = [c['orden_id'] for c in resultado['coincidencias'] if not c['requiere_codigo']]
+    if opciones.get('rechazar') == '1':
+        cambios['rechazado'] = [c['orden_id'] for c in resultado['diferencias_monto']]
+
+    aplicado = {'procesado': [], 'rechazado': [], 'correos_en_cola': 0}
+    if any(cambios.values()):
+        conn = get_db_connection()
+        correos = 0
+        try:
+            for estado, ids in cambios.items():
+                if not ids:
+                    continue
+                # Solo las que siguen pendientes: otro admin pudo atenderlas mientras tanto
+                result = conn.execute(text('''
+                    SELECT o.*, j.nombre as juego_nombre, j.categoria
+                    FROM ordenes o
+                    LEFT JOIN juegos j ON o.juego_id = j.id
+                    WHERE o.id IN :ids AND o.estado = 'procesando'
+                ''').bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+                ordenes = {fila['id']: dict(fila) for fila in result.mappings().fetchall()}
+                if ordenes:
+                    correos += actualizar_estado_ordenes(conn, ordenes, estado, list(ordenes))
+                    aplicado[estado] = list(ordenes)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error aplicando la conciliación: {e}")
+            return jsonify({'error': f'Error al aplicar la conciliación: {str(e)}'}), 500
+        finally:
+            conn.close()
+        despertar_despachador()
+        aplicado['correos_en_cola'] = correos
+
+    resultado['resumen'] = {
+        'lineas': len(lineas),
+        'ordenes_pendientes': len(pendientes),
+        **{clave: len(valor) for clave, valor in resultado.items() if isinstance(valor, list)}
+    }
+    resultado['aplicado'] = aplicado
+    return jsonify(resultado)
+
 @app.route('/admin/orden/<int:orden_id>/rechazar', methods=['PATCH'])
 @admin_required
 def rechazar_orden(orden_id):
@@ -911,14 +3735,13 @@ def rechazar_orden(orden_id):
         # Actualizar estado a rechazado
         conn.execute(text('UPDATE ordenes SET estado = :estado WHERE id = :orden_id'), 
                     {'estado': 'rechazado', 'orden_id': orden_id})
-        
-        conn.commit()
 
-        # Convertir orden_info a diccionario para envío de correo
+        # Encolar el correo de rechazo al usuario en la misma transacción
         orden_dict = dict(orden_info._mapping)
+        encolar_correo(conn, 'orden_rechazada', orden_dict)
 
-        # Enviar correo de notificación de rechazo al usuario
-        threading.Thread(target=enviar_correo_orden_rechazada, args=(orden_dict,)).start()
+        conn.commit()
+        despertar_despachador()
 
         return jsonify({'message': 'Orden rechazada y correo de notificación enviado al usuario'})
 
@@ -934,45 +3757,45 @@ def rechazar_orden(orden_id):
 def get_productos():
     conn = get_db_connection()
     try:
-        result = conn.execute(text('SELECT * FROM juegos ORDER BY orden ASC, id ASC'))
-        productos = result.fetchall()
-
-        # Convertir a lista de diccionarios y obtener paquetes para cada producto
-        productos_list = []
-        for producto in productos:
-            # Usar índices numéricos para SQLite
-            producto_dict = {
-                'id': producto[0],
-                'nombre': producto[1],
-                'descripcion': producto[2],
-                'imagen': producto[3],
-                'categoria': producto[4],
-                'orden': producto[5],
-                'etiquetas': producto[6]
-            }
+        # Una sola consulta para productos y paquetes (antes 1 + N consultas)
+        result = conn.execute(text('''
+            SELECT
+                j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
+                p.id as paquete_id, p.juego_id as paquete_juego_id, p.nombre as paquete_nombre,
+                p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen
+            FROM juegos j
+            LEFT JOIN paquetes p ON p.juego_id = j.id
+            ORDER BY j.orden ASC, j.id ASC, p.orden ASC, p.id ASC
+        '''))
+        rows = result.fetchall()
 
-            # Obtener paquetes para este producto
-            paquetes_result = conn.execute(text('SELECT * FROM paquetes WHERE juego_id = :juego_id ORDER BY orden ASC, id ASC'), 
-                                         {'juego_id': producto_dict['id']})
-            paquetes = paquetes_result.fetchall()
-            
-            # Convertir paquetes usando índices numéricos
-            paquetes_list = []
-            for paq in paquetes:
-                paquete_dict = {
-                    'id': paq[0],
-                    'juego_id': paq[1],
-                    'nombre': paq[2],
-                    'precio': paq[3],
-                    'orden': paq[4],
-                    'imagen': paq[5] if len(paq) > 5 else None
+        # Agrupar paquetes por producto en una sola pasada
+        productos_dict = {}
+        for row in rows:
+            producto_id = row[0]
+            if producto_id not in productos_dict:
+                productos_dict[producto_id] = {
+                    'id': row[0],
+                    'nombre': row[1],
+                    'descripcion': row[2],
+                    'imagen': row[3],
+                    'categoria': row[4],
+                    'orden': row[5],
+                    'etiquetas': row[6],
+                    'paquetes': []
                 }
-                paquetes_list.append(paquete_dict)
-            
-            producto_dict['paquetes'] = paquetes_list
-            productos_list.append(producto_dict)
 
-        return jsonify(productos_list)
+            if row[7] is not None:
+                productos_dict[producto_id]['paquetes'].append({
+                    'id': row[7],
+                    'juego_id': row[8],
+                    'nombre': row[9],
+                    'precio': row[10],
+                    'orden': row[11],
+                    'imagen': row[12]
+                })
+
+        return jsonify(list(productos_dict.values()))
     except Exception as e:
         print(f"Error en get_productos: {e}")
         return jsonify({'error': f'Error al obtener productos: {str(e)}'}), 500
@@ -1028,6 +3851,7 @@ def create_producto():
             })
 
         conn.commit()
+        cache_catalogo.invalidar()
         return jsonify({'message': 'Producto creado correctamente', 'id': producto_id})
     except Exception as e:
         print(f"❌ Error al crear producto: {str(e)}")
@@ -1081,6 +3905,7 @@ def update_producto(producto_id):
             })
 
         conn.commit()
+        cache_catalogo.invalidar()
         return jsonify({'message': 'Producto actualizado correctamente'})
     except Exception as e:
         conn.rollback()
@@ -1091,105 +3916,325 @@ def update_producto(producto_id):
 @app.route('/admin/producto/<int:producto_id>', methods=['DELETE'])
 @admin_required
 def delete_producto(producto_id):
-    conn = get_db_connection()
-    try:
-        # Eliminar órdenes relacionadas primero
-        conn.execute(text('DELETE FROM ordenes WHERE juego_id = :producto_id'), {'producto_id': producto_id})
-        # Eliminar paquetes
-        conn.execute(text('DELETE FROM paquetes WHERE juego_id = :producto_id'), {'producto_id': producto_id})
-        # Eliminar producto
-        conn.execute(text('DELETE FROM juegos WHERE id = :producto_id'), {'producto_id': producto_id})
+    # Archivar las órdenes del producto (conservan su nombre y categoría) antes de borrarlo.
+    # El archivo usa ATTACH y no cabe en la transacción del borrado: si entra una orden
+    # del producto entre ambos pasos, el borrado se deshace y se vuelve a archivar
+    for _ in range(ELIMINAR_PRODUCTO_INTENTOS):
+        try:
+            archivar_ordenes_producto(producto_id)
+        except Exception as e:
+            return jsonify({'error': f'Error al archivar órdenes del producto: {str(e)}'}), 500
 
-        conn.commit()
-        return jsonify({'message': 'Producto eliminado correctamente'})
+        conn = get_db_connection()
+        try:
+            # Eliminar paquetes
+            conn.execute(text('DELETE FROM paquetes WHERE juego_id = :producto_id'), {'producto_id': producto_id})
+            # Eliminar producto
+            conn.execute(text('DELETE FROM juegos WHERE id = :producto_id'), {'producto_id': producto_id})
+
+            # Tras el primer DELETE la transacción tiene el bloqueo de escritura: este conteo
+            # no puede cambiar hasta el commit
+            restantes = conn.execute(text('SELECT COUNT(*) FROM ordenes WHERE juego_id = :producto_id'),
+                                     {'producto_id': producto_id}).scalar()
+            if restantes:
+                conn.rollback()
+                continue
 
-    except Exception as e:
-        conn.rollback()
-        return jsonify({'error': f'Error al eliminar producto: {str(e)}'}), 500
+            conn.commit()
+            cache_catalogo.invalidar()
+            return jsonify({'message': 'Producto eliminado correctamente'})
+
+        except Exception as e:
+            conn.rollback()
+            return jsonify({'error': f'Error al eliminar producto: {str(e)}'}), 500
+        finally:
+            conn.close()
+
+    return jsonify({'error': 'El producto sigue recibiendo órdenes; inténtalo de nuevo'}), 409
+
+def archivar_ordenes_producto(producto_id):
+    conn = conectar_archivador()
+    try:
+        ids = [fila[0] for fila in conn.execute('SELECT id FROM ordenes WHERE juego_id = ?', (producto_id,))]
+        return archivar_ordenes(conn, ids, 'producto_eliminado')
     finally:
         conn.close()
 
 # ENDPOINT PÚBLICO PARA PRODUCTOS (FRONTEND DE USUARIOS)
-@app.route('/productos', methods=['GET'])
-def get_productos_publico():
-    conn = get_db_connection()
+def construir_catalogo():
+    """Construye la lista pública de productos con sus paquetes y valoraciones"""
+    conn = get_db_read_connection()
     try:
         # Optimización: Una sola consulta con JOIN para obtener productos, paquetes y valoraciones
         result = conn.execute(text('''
             SELECT 
                 j.id, j.nombre, j.descripcion, j.imagen, j.categoria, j.orden, j.etiquetas,
                 p.id as paquete_id, p.nombre as paquete_nombre, p.precio, p.orden as paquete_orden, p.imagen as paquete_imagen,
-                v.promedio_valoracion, v.total_valoraciones
+                CASE WHEN v.total > 0 THEN ROUND(v.suma * 1.0 / v.total, 1) END as promedio_valoracion,
+                CASE WHEN v.total > 0 THEN v.total END as total_valoraciones
             FROM juegos j
             LEFT JOIN paquetes p ON j.id = p.juego_id
-            LEFT JOIN (
-                SELECT 
-                    juego_id,
-                    ROUND(AVG(calificacion), 1) as promedio_valoracion,
-                    COUNT(*) as total_valoraciones
-                FROM valoraciones 
-                GROUP BY juego_id
-            ) v ON j.id = v.juego_id
+            LEFT JOIN valoraciones_resumen v ON j.id = v.juego_id
             ORDER BY j.orden ASC, j.id ASC, p.orden ASC, p.precio ASC
         '''))
 
-        rows = result.fetchall()
-
-        # Agrupar productos con sus paquetes
-        productos_dict = {}
-        for row in rows:
-            row_dict = dict(row._mapping)
-            producto_id = row_dict['id']
+        rows = result.mappings().fetchall()
+    finally:
+        conn.close()
 
-            if producto_id not in productos_dict:
+    # Agrupar productos con sus paquetes
+    productos_dict = {}
+    for row_dict in rows:
+        producto_id = row_dict['id']
+
+        if producto_id not in productos_dict:
+            productos_dict[producto_id] = {
+                'id': row_dict['id'],
+                'nombre': row_dict['nombre'],
+                'descripcion': row_dict['descripcion'],
+                'imagen': row_dict['imagen'],
                 # Asegurar que la categoría no sea None
-                categoria = row_dict['categoria'] or 'juegos'
+                'categoria': row_dict['categoria'] or 'juegos',
+                'orden': row_dict['orden'],
+                'etiquetas': row_dict['etiquetas'],
+                'promedio_valoracion': row_dict['promedio_valoracion'],
+                'total_valoraciones': row_dict['total_valoraciones'],
+                'paquetes': []
+            }
 
-                productos_dict[producto_id] = {
-                    'id': row_dict['id'],
-                    'nombre': row_dict['nombre'],
-                    'descripcion': row_dict['descripcion'],
-                    'imagen': row_dict['imagen'],
-                    'categoria': categoria,
-                    'orden': row_dict['orden'],
-                    'etiquetas': row_dict['etiquetas'],
-                    'promedio_valoracion': row_dict['promedio_valoracion'],
-                    'total_valoraciones': row_dict['total_valoraciones'],
-                    'paquetes': []
-                }
+        # Agregar paquete si existe
+        if row_dict['paquete_id']:
+            productos_dict[producto_id]['paquetes'].append({
+                'id': row_dict['paquete_id'],
+                'nombre': row_dict['paquete_nombre'],
+                'precio': row_dict['precio'],
+                'orden': row_dict['paquete_orden'],
+                'imagen': row_dict['paquete_imagen']
+            })
 
-                # Debug: imprimir categoría de cada producto
-                print(f"📦 Producto: {row_dict['nombre']} | Categoría: {categoria}")
+    # Convertir a lista
+    productos_list = list(productos_dict.values())
 
-            # Agregar paquete si existe
-            if row_dict['paquete_id']:
-                productos_dict[producto_id]['paquetes'].append({
-                    'id': row_dict['paquete_id'],
-                    'nombre': row_dict['paquete_nombre'],
-                    'precio': row_dict['precio'],
-                    'orden': row_dict['paquete_orden'],
-                    'imagen': row_dict['paquete_imagen']
-                })
+    # Debug: contar productos por categoría (solo al reconstruir el snapshot)
+    categorias_count = {}
+    for producto in productos_list:
+        cat = producto['categoria']
+        categorias_count[cat] = categorias_count.get(cat, 0) + 1
+
+    print(f"📊 Catálogo reconstruido. Productos por categoría: {categorias_count}")
+
+    return productos_list
+
+def _clave_orden_producto(producto):
+    """Clave de orden equivalente a ORDER BY j.orden ASC, j.id ASC (NULL primero en SQLite)"""
+    return (producto['orden'] is not None, producto['orden'] or 0, producto['id'])
+
+def indexar_catalogo(productos_list):
+    """Snapshot del catálogo con índices por categoría para paginar sin recorrer la lista"""
+    por_categoria = {}
+    for producto in productos_list:
+        por_categoria.setdefault(producto['categoria'], []).append(producto)
+
+    # Claves de orden precalculadas para la búsqueda binaria del cursor (None = todas)
+    claves = {None: [_clave_orden_producto(p) for p in productos_list]}
+    for categoria, productos in por_categoria.items():
+        claves[categoria] = [_clave_orden_producto(p) for p in productos]
+
+    return {
+        'productos': productos_list,
+        'por_id': {producto['id']: producto for producto in productos_list},
+        'por_categoria': por_categoria,
+        'claves': claves,
+        'totales_categoria': {categoria: len(productos) for categoria, productos in por_categoria.items()},
+    }
+
+# Snapshot del catálogo público; lo invalidan las escrituras de productos y valoraciones
+cache_catalogo = CacheVersionada('catalogo', lambda: indexar_catalogo(construir_catalogo()))
+
+CATALOGO_LIMITE_POR_DEFECTO = 50
+CATALOGO_LIMITE_MAXIMO = 200
+# Solo estos parámetros piden la respuesta paginada; cualquier otro (p. ej. el `_=` que
+# añaden algunos clientes para saltarse la caché) mantiene la lista completa
+PARAMETROS_PAGINACION_CATALOGO = ('categoria', 'limit', 'after', 'fields')
+CAMPOS_PRODUCTO = ('id', 'nombre', 'descripcion', 'imagen', 'categoria', 'orden', 'etiquetas',
+                   'promedio_valoracion', 'total_valoraciones', 'paquetes')
+
+def codificar_cursor(producto):
+    """Cursor opaco y estable con la posición (orden, id) del último producto entregado"""
+    crudo = json.dumps([producto['orden'], producto['id']], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(crudo).decode('ascii').rstrip('=')
+
+def decodificar_cursor(cursor):
+    """Devuelve la clave de orden codificada en el cursor o lanza ValueError"""
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        orden, producto_id = json.loads(crudo)
+        if (orden is not None and not isinstance(orden, int)) or not isinstance(producto_id, int):
+            raise ValueError
+    except Exception:
+        raise ValueError('Cursor inválido')
+    return _clave_orden_producto({'orden': orden, 'id': producto_id})
+
+def pagina_catalogo(catalogo, categoria=None, limite=None, cursor=None, campos=None):
+    """Página del catálogo filtrada por categoría con paginación por keyset (orden, id)"""
+    productos = catalogo['productos'] if categoria is None else catalogo['por_categoria'].get(categoria, [])
+    claves = catalogo['claves'].get(categoria, [])
+
+    inicio = bisect.bisect_right(claves, decodificar_cursor(cursor)) if cursor else 0
+    limite = limite or CATALOGO_LIMITE_POR_DEFECTO
+    pagina = productos[inicio:inicio + limite]
+    hay_mas = inicio + limite < len(productos)
+
+    if campos:
+        pagina = [{campo: producto[campo] for campo in campos} for producto in pagina]
+
+    return {
+        'productos': pagina,
+        'siguiente': codificar_cursor(productos[inicio + limite - 1]) if hay_mas else None,
+        'total': len(productos),
+        'totales_categoria': catalogo['totales_categoria'],
+    }
+
+@app.route('/productos', methods=['GET'])
+def get_productos_publico():
+    version, actualizado = leer_version_datos('catalogo')
 
-        # Convertir a lista
-        productos_list = list(productos_dict.values())
+    # Sin parámetros de paginación: lista completa (compatibilidad con el frontend actual)
+    if not any(parametro in request.args for parametro in PARAMETROS_PAGINACION_CATALOGO):
+        return respuesta_json_cacheada('catalogo', version, actualizado,
+                                       lambda: cache_catalogo.obtener()[0]['productos'])
 
-        # Debug: contar productos por categoría
-        categorias_count = {}
-        for producto in productos_list:
-            cat = producto['categoria']
-            categorias_count[cat] = categorias_count.get(cat, 0) + 1
+    categoria = request.args.get('categoria') or None
+    cursor = request.args.get('after') or None
 
-        print(f"📊 Productos por categoría: {categorias_count}")
+    try:
+        limite = int(request.args.get('limit', CATALOGO_LIMITE_POR_DEFECTO))
+    except ValueError:
+        return jsonify({'error': 'El parámetro limit debe ser un número'}), 400
+    if limite < 1 or limite > CATALOGO_LIMITE_MAXIMO:
+        return jsonify({'error': f'El parámetro limit debe estar entre 1 y {CATALOGO_LIMITE_MAXIMO}'}), 400
+
+    campos = None
+    if request.args.get('fields'):
+        campos = [c.strip() for c in request.args['fields'].split(',') if c.strip()]
+        invalidos = [c for c in campos if c not in CAMPOS_PRODUCTO]
+        if invalidos:
+            return jsonify({'error': f'Campos no válidos: {", ".join(invalidos)}'}), 400
+        if 'id' not in campos:
+            campos.insert(0, 'id')
+
+    if cursor:
+        try:
+            decodificar_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    # Cada combinación de parámetros se cachea como un cuerpo propio de esta versión
+    clave = 'catalogo?' + urllib.parse.urlencode(sorted({
+        'categoria': categoria or '', 'limit': limite, 'after': cursor or '', 'fields': ','.join(campos or [])
+    }.items()))
+    return respuesta_json_cacheada(clave, version, actualizado, lambda: pagina_catalogo(
+        cache_catalogo.obtener()[0], categoria=categoria, limite=limite, cursor=cursor, campos=campos
+    ))
+
+# BÚSQUEDA EN EL CATÁLOGO (FTS5)
+BUSQUEDA_LIMITE_MAXIMO = 50
+# Pesos bm25 por columna: nombre, descripcion, etiquetas, paquetes
+BUSQUEDA_PESOS = '10.0, 1.0, 4.0, 2.0'
+
+def consulta_fts(texto):
+    """Convierte texto libre en una consulta FTS5 segura.
+
+    Cada palabra va entre comillas (sin operadores ni sintaxis del usuario) y la última
+    se busca como prefijo para que funcione mientras se escribe.
+    """
+    palabras = re.findall(r'\w+', texto or '')[:10]
+    if not palabras:
+        return None
+    terminos = [f'"{p}"' for p in palabras]
+    terminos[-1] += '*'
+    return ' '.join(terminos)
+
+def _limite_busqueda(por_defecto):
+    try:
+        limite = int(request.args.get('limit', por_defecto))
+    except ValueError:
+        limite = por_defecto
+    return max(1, min(limite, BUSQUEDA_LIMITE_MAXIMO))
+
+@app.route('/buscar', methods=['GET'])
+def buscar_productos():
+    """Búsqueda ordenada por relevancia sobre nombre, descripción, etiquetas y paquetes"""
+    consulta = consulta_fts(request.args.get('q'))
+    if not consulta:
+        return jsonify({'resultados': [], 'total': 0})
+
+    categoria = request.args.get('categoria') or None
+    limite = _limite_busqueda(20)
+
+    # El JOIN con juegos solo es necesario para filtrar por categoría
+    if categoria:
+        sql = f'''
+            SELECT f.rowid
+            FROM catalogo_fts f
+            JOIN juegos j ON j.id = f.rowid
+            WHERE catalogo_fts MATCH :consulta AND COALESCE(j.categoria, 'juegos') = :categoria
+            ORDER BY bm25(catalogo_fts, {BUSQUEDA_PESOS})
+            LIMIT :limite
+        '''
+    else:
+        sql = f'''
+            SELECT rowid FROM catalogo_fts
+            WHERE catalogo_fts MATCH :consulta
+            ORDER BY bm25(catalogo_fts, {BUSQUEDA_PESOS})
+            LIMIT :limite
+        '''
+
+    conn = get_db_read_connection()
+    try:
+        result = conn.execute(text(sql), {'consulta': consulta, 'categoria': categoria, 'limite': limite})
+        ids = [fila[0] for fila in result.fetchall()]
+    except Exception as e:
+        print(f"Error en búsqueda '{consulta}': {e}")
+        return jsonify({'error': 'Búsqueda no válida'}), 400
+    finally:
+        conn.close()
+
+    # Los datos completos salen del snapshot en memoria del catálogo
+    por_id = cache_catalogo.obtener()[0]['por_id']
+    resultados = [por_id[i] for i in ids if i in por_id]
+    return jsonify({'resultados': resultados, 'total': len(resultados)})
 
-        return jsonify(productos_list)
+@app.route('/buscar/autocompletar', methods=['GET'])
+def autocompletar_productos():
+    """Sugerencias por prefijo sobre el nombre del producto"""
+    consulta = consulta_fts(request.args.get('q'))
+    if not consulta:
+        return jsonify([])
+
+    conn = get_db_read_connection()
+    try:
+        result = conn.execute(text('''
+            SELECT j.id, j.nombre, j.imagen, COALESCE(j.categoria, 'juegos') as categoria
+            FROM catalogo_fts f
+            JOIN juegos j ON j.id = f.rowid
+            WHERE catalogo_fts MATCH :consulta
+            ORDER BY bm25(catalogo_fts, 10.0, 0.0, 0.0, 0.0)
+            LIMIT :limite
+        '''), {'consulta': '{nombre} : (' + consulta + ')', 'limite': _limite_busqueda(8)})
+        sugerencias = [dict(fila._mapping) for fila in result.fetchall()]
+    except Exception as e:
+        print(f"Error en autocompletado '{consulta}': {e}")
+        return jsonify({'error': 'Búsqueda no válida'}), 400
     finally:
         conn.close()
 
+    return jsonify(sugerencias)
+
 # ENDPOINT PÚBLICO PARA CONFIGURACIÓN (FRONTEND DE USUARIOS)
-@app.route('/config', methods=['GET'])
-def get_config_publico():
-    conn = get_db_connection()
+def construir_config():
+    """Lee la tabla configuracion como diccionario campo -> valor"""
+    conn = get_db_read_connection()
     try:
         result = conn.execute(text('SELECT campo, valor FROM configuracion'))
         configs = result.fetchall()
@@ -1199,11 +4244,24 @@ def get_config_publico():
         for config in configs:
             config_dict[config[0]] = config[1]  # campo, valor
 
-        return jsonify(config_dict)
+        return config_dict
     finally:
         conn.close()
 
+cache_config = CacheVersionada('config', construir_config)
+
+@app.route('/config', methods=['GET'])
+def get_config_publico():
+    version, actualizado = leer_version_datos('config')
+    return respuesta_json_cacheada('config', version, actualizado, lambda: cache_config.obtener()[0])
+
 # ENDPOINTS PARA VALORACIONES
+def usuario_compro_juego(conn, usuario_email, juego_id):
+    """True si el usuario tiene alguna orden procesada del juego, viva o archivada (compras_juegos)"""
+    return bool(conn.execute(text('''
+        SELECT compras FROM compras_juegos WHERE usuario_email = :usuario_email AND juego_id = :juego_id
+    '''), {'usuario_email': usuario_email, 'juego_id': juego_id}).scalar())
+
 @app.route('/valoracion', methods=['POST'])
 def crear_valoracion():
     # Verificar si el usuario está logueado
@@ -1226,24 +4284,23 @@ def crear_valoracion():
 
     conn = get_db_connection()
     try:
-        # Verificar que el usuario haya comprado este juego
-        result = conn.execute(text('''
-            SELECT COUNT(*) FROM ordenes 
-            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
-        '''), {'juego_id': juego_id, 'usuario_email': usuario_email})
-
-        compras = result.fetchone()[0]
-
-        if compras == 0:
+        # Verificar que el usuario haya comprado este juego (también órdenes ya archivadas)
+        if not usuario_compro_juego(conn, usuario_email, juego_id):
             return jsonify({'error': 'Solo puedes valorar productos que hayas comprado'}), 403
 
-        # Para SQLite, usamos INSERT OR REPLACE
+        # UPSERT: actualiza la valoración existente (dispara los triggers de UPDATE del resumen)
         conn.execute(text('''
-            INSERT OR REPLACE INTO valoraciones (juego_id, usuario_email, calificacion, comentario, fecha)
+            INSERT INTO valoraciones (juego_id, usuario_email, calificacion, comentario, fecha)
             VALUES (:juego_id, :usuario_email, :calificacion, :comentario, CURRENT_TIMESTAMP)
+            ON CONFLICT(juego_id, usuario_email) DO UPDATE SET
+                calificacion = excluded.calificacion,
+                comentario = excluded.comentario,
+                fecha = excluded.fecha
         '''), {'juego_id': juego_id, 'usuario_email': usuario_email, 'calificacion': calificacion, 'comentario': comentario})
 
         conn.commit()
+        cache_catalogo.invalidar()
+        invalidar_version_datos('valoraciones')
         return jsonify({'message': 'Valoración guardada correctamente'})
 
     except Exception as e:
@@ -1254,7 +4311,13 @@ def crear_valoracion():
 
 @app.route('/valoraciones/<int:juego_id>', methods=['GET'])
 def get_valoraciones_producto(juego_id):
-    conn = get_db_connection()
+    version, actualizado = leer_version_datos('valoraciones')
+    return respuesta_json_cacheada(f'valoraciones-{juego_id}', version, actualizado,
+                                   lambda: construir_valoraciones_producto(juego_id))
+
+def construir_valoraciones_producto(juego_id):
+    """Valoraciones de un producto con sus estadísticas"""
+    conn = get_db_read_connection()
     try:
         # Obtener valoraciones del producto
         result = conn.execute(text('''
@@ -1267,17 +4330,12 @@ def get_valoraciones_producto(juego_id):
 
         valoraciones = result.fetchall()
 
-        # Obtener estadísticas
+        # Obtener estadísticas (mantenidas por triggers en valoraciones_resumen)
         stats_result = conn.execute(text('''
             SELECT 
-                AVG(calificacion) as promedio,
-                COUNT(*) as total,
-                COUNT(CASE WHEN calificacion = 5 THEN 1 END) as estrellas_5,
-                COUNT(CASE WHEN calificacion = 4 THEN 1 END) as estrellas_4,
-                COUNT(CASE WHEN calificacion = 3 THEN 1 END) as estrellas_3,
-                COUNT(CASE WHEN calificacion = 2 THEN 1 END) as estrellas_2,
-                COUNT(CASE WHEN calificacion = 1 THEN 1 END) as estrellas_1
-            FROM valoraciones 
+                CASE WHEN total > 0 THEN suma * 1.0 / total END as promedio,
+                total, estrellas_5, estrellas_4, estrellas_3, estrellas_2, estrellas_1
+            FROM valoraciones_resumen 
             WHERE juego_id = :juego_id
         '''), {'juego_id': juego_id})
 
@@ -1298,14 +4356,17 @@ def get_valoraciones_producto(juego_id):
             valoraciones_list.append(val_dict)
 
         # Preparar estadísticas
-        stats_dict = dict(stats._mapping) if stats else {}
+        stats_dict = dict(stats._mapping) if stats else {
+            'promedio': None, 'total': 0,
+            'estrellas_5': 0, 'estrellas_4': 0, 'estrellas_3': 0, 'estrellas_2': 0, 'estrellas_1': 0
+        }
         if stats_dict.get('promedio'):
             stats_dict['promedio'] = round(float(stats_dict['promedio']), 1)
 
-        return jsonify({
+        return {
             'valoraciones': valoraciones_list,
             'estadisticas': stats_dict
-        })
+        }
 
     finally:
         conn.close()
@@ -1321,12 +4382,7 @@ def get_valoracion_usuario(juego_id):
     conn = get_db_connection()
     try:
         # Verificar si el usuario puede valorar (ha comprado el producto)
-        result = conn.execute(text('''
-            SELECT COUNT(*) FROM ordenes 
-            WHERE juego_id = :juego_id AND usuario_email = :usuario_email AND estado = 'procesado'
-        '''), {'juego_id': juego_id, 'usuario_email': usuario_email})
-
-        puede_valorar = result.fetchone()[0] > 0
+        puede_valorar = usuario_compro_juego(conn, usuario_email, juego_id)
 
         # Obtener valoración existente del usuario
         result = conn.execute(text('''
@@ -1575,6 +4631,7 @@ def update_config():
             '''), {'campo': campo, 'valor': valor})
 
         conn.commit()
+        cache_config.invalidar()
         return jsonify({'message': 'Configuración actualizada correctamente'})
     finally:
         conn.close()
@@ -1627,11 +4684,10 @@ def login():
     if not email or not password:
         return jsonify({'error': 'Email y contraseña son requeridos'}), 400
 
-    conn = get_sqlite_connection()
+    conn = get_db_read_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE email = ?", (email,))
-        user = cursor.fetchone()
+        result = conn.execute(text('SELECT * FROM usuarios WHERE email = :email'), {'email': email})
+        user = result.mappings().fetchone()
 
         if user and user['password_hash'] and check_password_hash(user['password_hash'], password):
             # Guardar sesión permanente con tiempo de expiración
@@ -1654,7 +4710,6 @@ def login():
         else:
             return jsonify({'error': 'Email o contraseña incorrectos'}), 401
     finally:
-        cursor.close()
         conn.close()
 
 @app.route('/logout', methods=['POST'])
@@ -1702,6 +4757,59 @@ def obtener_usuario():
     finally:
         conn.close()
 
+@app.route('/bootstrap')
+def bootstrap():
+    """Datos de arranque del storefront en una sola petición: sesión, configuración y catálogo.
+
+    Si el cliente envía ?catalogo_version=N y coincide con la versión actual, el catálogo se
+    omite (productos = null) y el cliente usa su copia de localStorage. Configuración y
+    catálogo salen de las cachés en memoria; solo la sesión puede requerir una consulta.
+    """
+    usuario = None
+    if 'user_id' in session:
+        conn = get_db_read_connection()
+        try:
+            result = conn.execute(text("""
+                SELECT id, nombre, email, fecha_registro, es_admin 
+                FROM usuarios 
+                WHERE id = :user_id
+            """), {'user_id': session['user_id']})
+            fila = result.fetchone()
+        finally:
+            conn.close()
+
+        if fila:
+            usuario = {
+                'id': fila[0],
+                'nombre': fila[1],
+                'email': fila[2],
+                'fecha_registro': fila[3],
+                'es_admin': fila[4] if fila[4] is not None else False
+            }
+
+    version_config, _ = leer_version_datos('config')
+    version_catalogo, _ = leer_version_datos('catalogo')
+
+    # Se reutilizan los cuerpos ya serializados de /config y /productos
+    config_json = cache_cuerpos.obtener('config', version_config,
+                                        lambda: cache_config.obtener()[0])['identity']
+    if request.args.get('catalogo_version') == str(version_catalogo):
+        productos_json = b'null'
+    else:
+        productos_json = cache_cuerpos.obtener('catalogo', version_catalogo,
+                                               lambda: cache_catalogo.obtener()[0]['productos'])['identity']
+
+    cuerpo = b''.join([
+        b'{"catalogo_version":', str(version_catalogo).encode('ascii'),
+        b',"config":', config_json,
+        b',"productos":', productos_json,
+        b',"usuario":', app.json.dumps(usuario).encode('utf-8'),
+        b'}'
+    ])
+    response = app.response_class(cuerpo, mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/session-status')
 def session_status():
     """Endpoint para verificar el estado de la sesión"""
@@ -1718,34 +4826,39 @@ def session_status():
     print(f"🔍 Estado de sesión: {session_info}")
     return jsonify(session_info)
 
+# Compras que devuelve /usuario/historial (las más recientes, vivas o archivadas)
+HISTORIAL_COMPRAS_LIMITE = 200
+
 @app.route('/usuario/historial', methods=['GET'])
 def get_historial_compras():
     if 'user_id' not in session:
         return jsonify({'error': 'No hay sesión activa'}), 401
 
-    conn = get_db_connection()
     try:
-        # Obtener historial de compras del usuario logueado
-        result = conn.execute(text('''
-            SELECT o.*, j.nombre as juego_nombre, j.imagen as juego_imagen
-            FROM ordenes o 
-            LEFT JOIN juegos j ON o.juego_id = j.id 
-            LEFT JOIN usuarios u ON o.usuario_email = u.email
-            WHERE u.id = :user_id
-            ORDER BY o.fecha DESC
-        '''), {'user_id': session['user_id']})
-
-        historial = result.fetchall()
-
-        # Convertir a lista de diccionarios
-        historial_list = []
-        for compra in historial:
-            compra_dict = dict(compra._mapping)
-            historial_list.append(compra_dict)
-
-        return jsonify(historial_list)
-    finally:
-        conn.close()
+        # Las órdenes antiguas pasan a los archivos mensuales: se consultan también
+        historial, _ = consultar_historial_ordenes(
+            ['o.usuario_email = :usuario_email'], {'usuario_email': session['user_email']},
+            HISTORIAL_COMPRAS_LIMITE
+        )
+    except Exception as e:
+        print(f"Error en get_historial_compras: {e}")
+        return jsonify({'error': f'Error al obtener el historial: {str(e)}'}), 500
+
+    # La imagen no se copia al archivo: se toma del juego si sigue existiendo
+    juegos = list({compra['juego_id'] for compra in historial if compra['juego_id'] is not None})
+    imagenes = {}
+    if juegos:
+        conn = get_db_read_connection()
+        try:
+            imagenes = dict(conn.execute(
+                text('SELECT id, imagen FROM juegos WHERE id IN :juegos').bindparams(bindparam('juegos', expanding=True)),
+                {'juegos': juegos}
+            ).fetchall())
+        finally:
+            conn.close()
+    for compra in historial:
+        compra['juego_imagen'] = imagenes.get(compra['juego_id'])
+    return jsonify(historial)
 
 @app.route('/images/<path:filename>')
 def serve_image(filename):
@@ -1754,10 +4867,14 @@ def serve_image(filename):
     filename = secure_filename(filename)
 
     # Buscar la imagen en la base de datos
-    conn = get_db_connection()
+    conn = get_db_read_connection()
     try:
-        result = conn.execute(text('SELECT ruta FROM imagenes WHERE ruta LIKE :filename'), {'filename': f'%{filename}%'})
+        # Coincidencia exacta primero (usa idx_imagenes_ruta); LIKE solo como respaldo
+        result = conn.execute(text('SELECT ruta FROM imagenes WHERE ruta = :ruta'), {'ruta': f'/static/images/{filename}'})
         imagen = result.fetchone()
+        if not imagen:
+            result = conn.execute(text('SELECT ruta FROM imagenes WHERE ruta LIKE :filename'), {'filename': f'%{filename}%'})
+            imagen = result.fetchone()
 
         if imagen:
             # La ruta ya incluye /static/, así que redirigir directamente
@@ -1780,6 +4897,9 @@ def after_request(response):
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
+    # Número de sentencias SQL de la petición (para pruebas y diagnóstico de N+1)
+    if app.config['CONTAR_CONSULTAS_SQL']:
+        response.headers['X-Consultas-SQL'] = str(g.get('consultas_sql', 0))
     return response
 
 # Inicialización para producción (Gunicorn)
@@ -1795,6 +4915,7 @@ except Exception as e:
 
 if __name__ == '__main__':
     # Solo para desarrollo local
+    iniciar_hilos_servidor()
     port = int(os.environ.get('PORT', 5000))
     print(f'🚀 Iniciando servidor en puerto {port}')
     app.run(host='0.0.0.0', port=port, debug=False)
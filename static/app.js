@@ -33,6 +33,36 @@ function cargarCarritoDesdeStorage() {
     return [];
 }
 
+function generarClaveIdempotencia() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// POST /orden con Idempotency-Key: reintenta errores de red y 5xx con la misma clave,
+// así el servidor devuelve la orden ya creada en lugar de insertar otra
+async function enviarOrdenIdempotente(orden, clave, intentos = 3) {
+    for (let intento = 1; ; intento++) {
+        try {
+            const response = await fetch('/orden', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': clave
+                },
+                body: JSON.stringify(orden)
+            });
+            if ((response.status < 500 && response.status !== 409) || intento >= intentos) {
+                return response;
+            }
+        } catch (error) {
+            if (intento >= intentos) throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * intento));
+    }
+}
+
 function limpiarCarritoStorage() {
     try {
         localStorage.removeItem('inefablestore_carrito');
@@ -51,6 +81,7 @@ let interfazLista = false;
 let configCache = null;
 let productosCache = null;
 let cacheTimestamp = null;
+let catalogoVersionCache = null;
 const CACHE_DURATION = 5 * 60 * 1000; // 5 minutos
 
 // Flag para evitar múltiples cargas simultáneas
@@ -184,12 +215,8 @@ document.addEventListener('DOMContentLoaded', function() {
             mostrarProductos();
         }
         
-        // Cargar datos frescos del servidor en paralelo (especialmente para tasa de cambio)
-        Promise.all([
-            cargarConfiguracionOptimizada(),
-            cargarProductosOptimizado(),
-            verificarSesionOptimizada()
-        ]).then(() => {
+        // Cargar datos frescos del servidor en una sola petición (especialmente para tasa de cambio)
+        cargarBootstrap().then(() => {
             console.log('✅ Carga de datos completada');
             interfazLista = true;
             verificarCargaCompleta();
@@ -302,6 +329,51 @@ function showSlide(n) {
     }
 }
 
+// Carga inicial en una sola petición: sesión, configuración y catálogo.
+// Si el catálogo en localStorage tiene la misma versión, el servidor no lo reenvía.
+async function cargarBootstrap() {
+    try {
+        const params = (productosCache && catalogoVersionCache)
+            ? `?catalogo_version=${encodeURIComponent(catalogoVersionCache)}`
+            : '';
+        const response = await fetch(`/bootstrap${params}`);
+
+        if (!response.ok) {
+            throw new Error(`Error ${response.status}: ${response.statusText}`);
+        }
+
+        const data = await response.json();
+
+        if (data.usuario) {
+            console.log('Usuario logueado encontrado:', data.usuario);
+            actualizarInterfazUsuario(data.usuario);
+        }
+        sesionVerificada = true;
+
+        const listaProductos = data.productos || productosCache;
+        if (!listaProductos) {
+            throw new Error('Catálogo no disponible');
+        }
+        catalogoVersionCache = data.catalogo_version;
+        productos = listaProductos;
+        guardarEnCache(configCache || {}, productos);
+        console.log('Productos cargados:', productos.length, data.productos ? '(servidor)' : '(cache vigente)');
+
+        // Guarda también la configuración en cache (sin la tasa)
+        aplicarConfiguracion(data.config);
+
+        mostrarProductos();
+        productosCargados = true;
+    } catch (error) {
+        console.warn('Bootstrap no disponible, cargando por separado:', error.message || error);
+        await Promise.all([
+            cargarConfiguracionOptimizada(),
+            cargarProductosOptimizado(),
+            verificarSesionOptimizada()
+        ]);
+    }
+}
+
 // Versión optimizada de verificar sesión
 async function verificarSesionOptimizada() {
     try {
@@ -652,40 +724,7 @@ async function cargarConfiguracionOptimizada() {
         }
 
         const nuevaConfiguracion = await response.json();
-
-        console.log('Configuración cargada desde servidor (tasa en tiempo real):', nuevaConfiguracion);
-
-        // SIEMPRE actualizar la tasa desde el servidor (tiempo real)
-        if (nuevaConfiguracion.tasa_usd_ves && parseFloat(nuevaConfiguracion.tasa_usd_ves) > 0) {
-            const nuevaTasa = parseFloat(nuevaConfiguracion.tasa_usd_ves);
-            tasaUSDVES = nuevaTasa;
-            console.log('✅ Tasa de cambio actualizada desde el servidor:', tasaUSDVES);
-            console.log('✅ Verificación: 10 USD = Bs.', (10 * nuevaTasa).toFixed(2));
-        } else {
-            console.warn('Tasa inválida en configuración del servidor, manteniendo tasa actual:', tasaUSDVES);
-        }
-
-        configuracion = nuevaConfiguracion;
-
-        // Actualizar logo inmediatamente
-        actualizarLogo();
-
-        // Actualizar imágenes del carrusel inmediatamente
-        actualizarImagenesCarrusel();
-
-        // Verificar cálculos después de cargar configuración
-        setTimeout(() => {
-            verificarCalculos();
-        }, 500);
-
-        // Guardar en cache OTROS elementos pero NO la tasa (para que siempre sea tiempo real)
-        if (productos && productos.length > 0) {
-            const configParaCache = { ...configuracion };
-            delete configParaCache.tasa_usd_ves; // NO cachear la tasa
-            guardarEnCache(configParaCache, productos);
-        }
-
-        configuracionCargada = true;
+        aplicarConfiguracion(nuevaConfiguracion);
     } catch (error) {
         console.warn('Error al cargar configuración:', error.message || 'Error desconocido');
         // No resetear la tasa en caso de error, solo mantener la actual
@@ -704,6 +743,43 @@ async function cargarConfiguracionOptimizada() {
     }
 }
 
+// Aplicar la configuración recibida del servidor (desde /config o /bootstrap)
+function aplicarConfiguracion(nuevaConfiguracion) {
+    console.log('Configuración cargada desde servidor (tasa en tiempo real):', nuevaConfiguracion);
+
+    // SIEMPRE actualizar la tasa desde el servidor (tiempo real)
+    if (nuevaConfiguracion.tasa_usd_ves && parseFloat(nuevaConfiguracion.tasa_usd_ves) > 0) {
+        const nuevaTasa = parseFloat(nuevaConfiguracion.tasa_usd_ves);
+        tasaUSDVES = nuevaTasa;
+        console.log('✅ Tasa de cambio actualizada desde el servidor:', tasaUSDVES);
+        console.log('✅ Verificación: 10 USD = Bs.', (10 * nuevaTasa).toFixed(2));
+    } else {
+        console.warn('Tasa inválida en configuración del servidor, manteniendo tasa actual:', tasaUSDVES);
+    }
+
+    configuracion = nuevaConfiguracion;
+
+    // Actualizar logo inmediatamente
+    actualizarLogo();
+
+    // Actualizar imágenes del carrusel inmediatamente
+    actualizarImagenesCarrusel();
+
+    // Verificar cálculos después de cargar configuración
+    setTimeout(() => {
+        verificarCalculos();
+    }, 500);
+
+    // Guardar en cache OTROS elementos pero NO la tasa (para que siempre sea tiempo real)
+    if (productos && productos.length > 0) {
+        const configParaCache = { ...configuracion };
+        delete configParaCache.tasa_usd_ves; // NO cachear la tasa
+        guardarEnCache(configParaCache, productos);
+    }
+
+    configuracionCargada = true;
+}
+
 // Cargar configuración del sistema (mantener para compatibilidad)
 async function cargarConfiguracion() {
     return cargarConfiguracionOptimizada();
@@ -884,6 +960,7 @@ async function cargarProductosOptimizado() {
         }
 
         productos = await response.json();
+        catalogoVersionCache = null; // /productos no informa versión; el próximo bootstrap lo reenvía
 
         console.log('Productos cargados desde servidor:', productos.length, 'productos');
 
@@ -912,20 +989,6 @@ async function cargarProductosOptimizado() {
     }
 }
 
-// Función para cargar configuración inicial
-async function cargarConfiguracion() {
-    try {
-        const response = await fetch('/config');
-        if (response.ok) {
-            const config = await response.json();
-            configCache = config;
-            console.log('Configuración cargada:', config);
-        }
-    } catch (error) {
-        console.error('Error al cargar configuración:', error);
-    }
-}
-
 // Función para mostrar productos en el grid
 function mostrarProductos() {
     const productosGrid = document.getElementById('productos-grid');
@@ -2529,8 +2592,15 @@ async function procesarPago() {
             return;
         }
 
-        // Crear una orden por cada item del carrito
+        // Crear una orden por cada item del carrito. Cada item conserva su
+        // Idempotency-Key hasta vaciar el carrito: si el usuario reintenta tras un
+        // corte de red, las órdenes que ya se crearon no se duplican
         for (const item of carrito) {
+            if (!item.claveIdempotencia) {
+                item.claveIdempotencia = generarClaveIdempotencia();
+                guardarCarritoEnStorage();
+            }
+
             const orden = {
                 juego_id: item.productoId,
                 paquete: item.paqueteNombre,
@@ -2541,13 +2611,14 @@ async function procesarPago() {
                 referencia_pago: referencia
             };
 
-            const response = await fetch('/orden', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify(orden)
-            });
+            let response = await enviarOrdenIdempotente(orden, item.claveIdempotencia);
+
+            if (response.status === 422) {
+                // Los datos cambiaron desde el intento anterior (p. ej. otra referencia): es otra orden
+                item.claveIdempotencia = generarClaveIdempotencia();
+                guardarCarritoEnStorage();
+                response = await enviarOrdenIdempotente(orden, item.claveIdempotencia);
+            }
 
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({}));
@@ -4411,6 +4482,7 @@ function guardarEnCache(config, productos) {
         localStorage.setItem('inefablestore_cache', JSON.stringify({
             config: config,
             productos: productos,
+            catalogo_version: catalogoVersionCache,
             timestamp: cacheTimestamp
         }));
     } catch (error) {
@@ -4426,6 +4498,7 @@ function cargarCacheDesdeStorage() {
             const parsed = JSON.parse(cacheData);
             configCache = parsed.config;
             productosCache = parsed.productos;
+            catalogoVersionCache = parsed.catalogo_version || null;
             cacheTimestamp = parsed.timestamp;
             return cacheValido();
         }
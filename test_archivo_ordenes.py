@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Pruebas de las órdenes archivadas: al pasar a los archivos mensuales siguen contando como
+compra para valorar el juego y siguen apareciendo en el historial del cliente
+"""
+
+from sqlalchemy import text
+
+CLIENTE = {'nombre': 'Cliente', 'email': 'cliente@prueba.com', 'telefono': '0000', 'password': 'clave-cliente'}
+
+def crear_juego_con_orden_antigua(main_sqlite):
+    """Un juego y una orden procesada del cliente de hace más de un año"""
+    conn = main_sqlite.get_db_connection()
+    try:
+        juego_id = conn.execute(text('''
+            INSERT INTO juegos (nombre, descripcion, imagen, categoria)
+            VALUES ('Juego archivado', 'Prueba', '/static/images/prueba.webp', 'juegos')
+        ''')).lastrowid
+        orden_id = conn.execute(text('''
+            INSERT INTO ordenes (juego_id, paquete, monto, usuario_email, metodo_pago,
+                                 referencia_pago, estado, fecha)
+            VALUES (:juego_id, '100 Diamantes', 2.99, :email, 'Pago Móvil', 'REF-ARCHIVO',
+                    'procesado', datetime('now', '-400 days'))
+        '''), {'juego_id': juego_id, 'email': CLIENTE['email']}).lastrowid
+        conn.commit()
+        return juego_id, orden_id
+    finally:
+        conn.close()
+
+def test_orden_archivada_permite_valorar_y_sale_en_historial(main_sqlite, cliente):
+    assert cliente.post('/registro', json=CLIENTE).status_code in (200, 201)
+    assert cliente.post('/login', json={'email': CLIENTE['email'], 'password': CLIENTE['password']}).status_code == 200
+
+    juego_id, orden_id = crear_juego_con_orden_antigua(main_sqlite)
+    archivadas, _ = main_sqlite.archivar_ordenes_antiguas(dias=180)
+    assert archivadas >= 1
+
+    conn = main_sqlite.get_db_connection()
+    try:
+        assert conn.execute(text('SELECT COUNT(*) FROM ordenes WHERE id = :id'), {'id': orden_id}).scalar() == 0
+    finally:
+        conn.close()
+
+    respuesta = cliente.get(f'/valoracion/usuario/{juego_id}')
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()['puede_valorar'] is True
+
+    respuesta = cliente.post('/valoracion', json={'juego_id': juego_id, 'calificacion': 5, 'comentario': 'Bien'})
+    assert respuesta.status_code == 200
+
+    historial = cliente.get('/usuario/historial').get_json()
+    compra = next(c for c in historial if c['id'] == orden_id)
+    assert compra['archivada'] == 1
+    assert compra['juego_nombre'] == 'Juego archivado'
+    assert compra['juego_imagen'] == '/static/images/prueba.webp'
+
+def test_sin_compra_no_puede_valorar(main_sqlite, cliente):
+    cliente.post('/registro', json=dict(CLIENTE, email='otro@prueba.com'))
+    assert cliente.post('/login', json={'email': 'otro@prueba.com', 'password': CLIENTE['password']}).status_code == 200
+
+    juego_id, _ = crear_juego_con_orden_antigua(main_sqlite)
+    respuesta = cliente.post('/valoracion', json={'juego_id': juego_id, 'calificacion': 4})
+    assert respuesta.status_code == 403
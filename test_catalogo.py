@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la forma de respuesta de GET /productos: lista completa salvo que se pida
+paginación con categoria, limit, after o fields
+"""
+
+def test_productos_sin_parametros_devuelve_lista(cliente):
+    respuesta = cliente.get('/productos')
+    assert respuesta.status_code == 200
+    assert isinstance(respuesta.get_json(), list)
+
+def test_productos_con_parametro_ajeno_devuelve_lista(cliente):
+    respuesta = cliente.get('/productos?_=123')
+    assert respuesta.status_code == 200
+    assert respuesta.get_json() == cliente.get('/productos').get_json()
+
+def test_productos_con_limit_devuelve_pagina(cliente):
+    respuesta = cliente.get('/productos?limit=1&_=123')
+    assert respuesta.status_code == 200
+    pagina = respuesta.get_json()
+    assert set(pagina) >= {'productos', 'siguiente', 'total', 'totales_categoria'}
+    assert len(pagina['productos']) <= 1
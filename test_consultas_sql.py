@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Prueba del contador de consultas SQL (cabecera X-Consultas-SQL): el listado de productos
+del panel debe ejecutar las mismas sentencias con 10 veces más productos (sin N+1)
+"""
+
+import pytest
+from sqlalchemy import text
+
+PRODUCTOS = 5
+PAQUETES_POR_PRODUCTO = 3
+
+@pytest.fixture
+def contar_consultas(main_sqlite, monkeypatch):
+    monkeypatch.setitem(main_sqlite.app.config, 'CONTAR_CONSULTAS_SQL', True)
+
+def sembrar_productos(main_sqlite, cantidad):
+    """Deja en la base exactamente `cantidad` productos con sus paquetes"""
+    conn = main_sqlite.get_db_connection()
+    try:
+        conn.execute(text('DELETE FROM paquetes'))
+        conn.execute(text('DELETE FROM juegos'))
+        for i in range(cantidad):
+            juego_id = conn.execute(text('''
+                INSERT INTO juegos (nombre, descripcion, categoria, orden)
+                VALUES (:nombre, 'Producto de prueba', 'juegos', :orden)
+            '''), {'nombre': f'Juego {i}', 'orden': i}).lastrowid
+            for j in range(PAQUETES_POR_PRODUCTO):
+                conn.execute(text('''
+                    INSERT INTO paquetes (juego_id, nombre, precio, orden)
+                    VALUES (:juego_id, :nombre, :precio, :orden)
+                '''), {'juego_id': juego_id, 'nombre': f'Paquete {j}', 'precio': 1.5 + j, 'orden': j})
+        conn.commit()
+    finally:
+        conn.close()
+
+def consultas_listado_productos(cliente):
+    respuesta = cliente.get('/admin/productos')
+    assert respuesta.status_code == 200
+    return len(respuesta.get_json()), int(respuesta.headers['X-Consultas-SQL'])
+
+def test_listado_productos_consultas_constantes(main_sqlite, cliente_admin, contar_consultas):
+    sembrar_productos(main_sqlite, PRODUCTOS)
+    productos, consultas = consultas_listado_productos(cliente_admin)
+    assert productos == PRODUCTOS
+
+    sembrar_productos(main_sqlite, PRODUCTOS * 10)
+    productos_10x, consultas_10x = consultas_listado_productos(cliente_admin)
+    assert productos_10x == PRODUCTOS * 10
+
+    assert consultas >= 1
+    assert consultas_10x == consultas